@@ -109,11 +109,48 @@ def traverse(chain):
             yield from traverse(a.addons)
 
 
+def _handlers(addon, name):
+    """
+        Collect the handlers for an event from an addon and its children.
+    """
+    handlers = []
+    for a in traverse([addon]):
+        func = getattr(a, name, None)
+        if func:
+            if callable(func):
+                handlers.append(func)
+            elif not isinstance(func, types.ModuleType):
+                handlers.append(_deferred(a, name))
+            # we gracefully exclude module imports with the same name as hooks.
+            # For example, a user may have "from mitmproxy import log" in an addon,
+            # which has the same name as the "log" hook. In this particular case,
+            # we end up in an error loop because we "log" this error.
+    return handlers
+
+
+def _deferred(addon, name):
+    """
+        Look up a handler attribute that is not callable only when the event
+        fires, so that addons can fix it up after registration.
+    """
+    def handler(*args, **kwargs):
+        func = getattr(addon, name, None)
+        if callable(func):
+            func(*args, **kwargs)
+        elif func and not isinstance(func, types.ModuleType):
+            raise exceptions.AddonManagerError(
+                "Addon handler {} ({}) not callable".format(name, addon)
+            )
+    return handler
+
+
 class AddonManager:
     def __init__(self, master):
         self.lookup = {}
         self.chain = []
         self.master = master
+        # Event name -> [(top-level addon, [handlers])], built on demand.
+        self.dispatch: typing.Dict[str, typing.List[typing.Tuple[typing.Any, typing.List[typing.Callable]]]] = {}
         master.options.changed.connect(self._configure_all)
 
     def _configure_all(self, options, updated):
@@ -127,6 +164,15 @@ class AddonManager:
             self.invoke_addon(a, "done")
         self.lookup = {}
         self.chain = []
+        self.invalidate()
+
+    def invalidate(self):
+        """
+            Discard the event dispatch table. This happens automatically when
+            addons are registered or removed, but must be called by addons
+            that change their addons attribute in any other way.
+        """
+        self.dispatch = {}
 
     def get(self, name):
         """
@@ -159,6 +205,7 @@ class AddonManager:
             self.lookup[name] = a
         for a in traverse([addon]):
             self.master.commands.collect_commands(a)
+        self.invalidate()
         self.master.options.process_deferred()
         return addon
 
@@ -169,6 +216,7 @@ class AddonManager:
         """
         for i in addons:
             self.chain.append(self.register(i))
+            self.invalidate()
 
     def remove(self, addon):
         """
@@ -184,6 +232,7 @@ class AddonManager:
                 raise exceptions.AddonManagerError("No such addon: %s" % n)
             self.chain = [i for i in self.chain if i is not a]
             del self.lookup[_get_name(a)]
+        self.invalidate()
         self.invoke_addon(addon, "done")
 
     def __len__(self):
@@ -231,29 +280,61 @@ class AddonManager:
         """
         if name not in eventsequence.Events:
             raise exceptions.AddonManagerError("Unknown event: %s" % name)
-        for a in traverse([addon]):
-            func = getattr(a, name, None)
-            if func:
-                if callable(func):
-                    func(*args, **kwargs)
-                elif isinstance(func, types.ModuleType):
-                    # we gracefully exclude module imports with the same name as hooks.
-                    # For example, a user may have "from mitmproxy import log" in an addon,
-                    # which has the same name as the "log" hook. In this particular case,
-                    # we end up in an error loop because we "log" this error.
-                    pass
-                else:
-                    raise exceptions.AddonManagerError(
-                        "Addon handler {} ({}) not callable".format(name, a)
-                    )
+        for func in _handlers(addon, name):
+            func(*args, **kwargs)
 
     def trigger(self, name, *args, **kwargs):
         """
             Trigger an event across all addons.
         """
-        for i in self.chain:
+        if name not in eventsequence.Events:
+            ctx.log.error("Addon error: Unknown event: %s" % name)
+            return
+        for addon, handlers in self._dispatch(name):
             try:
                 with safecall():
-                    self.invoke_addon(i, name, *args, **kwargs)
+                    self._call_handlers(addon, name, handlers, *args, **kwargs)
             except exceptions.AddonHalt:
                 return
+
+    def _dispatch(self, name):
+        table = self.dispatch
+        if name not in table:
+            # Build the entry completely before publishing it, connection
+            # threads may look at it concurrently.
+            entry = []
+            for a in self.chain:
+                handlers = _handlers(a, name)
+                if handlers:
+                    entry.append((a, handlers))
+            table[name] = entry
+        return table[name]
+
+    def handles(self, name, message) -> bool:
+        """
+            Check whether handling an event for the message would invoke any
+            addon. This is safe to call from connection threads.
+        """
+        if name not in eventsequence.Events:
+            return True
+        if self._dispatch(name):
+            return True
+        return isinstance(message, flow.Flow) and bool(self._dispatch("update"))
+
+    def _call_handlers(self, addon, name, handlers, *args, **kwargs):
+        """
+            Call the handlers of a top-level addon. If a handler changes the
+            addon tree (for example, the script loader re-ordering its
+            scripts), we continue with the current children of the addon.
+        """
+        called = set()
+        while handlers:
+            dispatch = self.dispatch
+            for func in handlers:
+                func(*args, **kwargs)
+                called.add(func)
+                if self.dispatch is not dispatch:
+                    break
+            else:
+                return
+            handlers = [h for h in _handlers(addon, name) if h not in called]
@@ -2,6 +2,7 @@ from mitmproxy.addons import anticache
 from mitmproxy.addons import anticomp
 from mitmproxy.addons import block
 from mitmproxy.addons import browser
+from mitmproxy.addons import certpregen
 from mitmproxy.addons import check_ca
 from mitmproxy.addons import clientplayback
 from mitmproxy.addons import command_history
@@ -30,6 +31,7 @@ def default_addons():
         anticache.AntiCache(),
         anticomp.AntiComp(),
         check_ca.CheckCA(),
+        certpregen.CertPregen(),
         clientplayback.ClientPlayback(),
         command_history.CommandHistory(),
         cut.Cut(),
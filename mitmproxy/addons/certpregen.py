@@ -0,0 +1,172 @@
+"""
+    Generate certificates in the background for hosts that are likely to be
+    intercepted soon, so that the TLS handshake with the client does not have
+    to wait until a certificate is signed.
+
+    Host names are taken from CONNECT requests, from the SNI of ignored TLS
+    connections, and from a warm-up list of hosts or flows. Optionally, a
+    wildcard certificate is generated for domains with many subdomains.
+"""
+import collections
+import concurrent.futures
+import ipaddress
+import typing
+
+from publicsuffix2 import get_tld
+
+from mitmproxy import ctx
+from mitmproxy import exceptions
+from mitmproxy import io
+from mitmproxy.proxy import protocol
+
+SEEN_CAP = 1000
+"""Number of host names and parent domains that are remembered."""
+
+
+class _Hooks:
+    """
+        The event hooks of CertPregen. They are only part of the addon chain
+        while cert_pregen is enabled, so that the proxy does not have to wait
+        for a next_layer event otherwise.
+    """
+    def __init__(self, pregen: "CertPregen") -> None:
+        self.pregen = pregen
+
+    def http_connect(self, f):
+        self.pregen.predict(f.request.host)
+
+    def next_layer(self, layer):
+        if isinstance(layer, protocol.RawTCPLayer) and layer.ignore and layer.client_conn.sni:
+            self.pregen.predict(layer.client_conn.sni)
+
+
+class CertPregen:
+    def __init__(self):
+        self.hooks = _Hooks(self)
+        self.addons: typing.List[_Hooks] = []
+        self.executor: typing.Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self.warmup: typing.List[str] = []
+        self.is_running = False
+        # The certstore that the seen hosts were generated in.
+        self.store = None
+        # host -> None, least recently seen first.
+        self.seen: typing.Dict[str, None] = collections.OrderedDict()
+        # parent domain -> number of subdomains seen.
+        self.subdomains: typing.Dict[str, int] = collections.OrderedDict()
+
+    def load(self, loader):
+        loader.add_option(
+            "cert_pregen", bool, False,
+            """
+            Generate certificates in the background for hosts that are seen in
+            CONNECT requests or in the SNI of ignored connections.
+            """
+        )
+        loader.add_option(
+            "cert_pregen_hosts", typing.Sequence[str], [],
+            "Generate certificates for these hosts at startup."
+        )
+        loader.add_option(
+            "cert_pregen_flows", typing.Sequence[str], [],
+            "Generate certificates for the hosts in these flow files at startup."
+        )
+        loader.add_option(
+            "cert_pregen_wildcard", int, 0,
+            """
+            Generate a wildcard certificate for a domain once this many of its
+            subdomains have been seen. 0 disables wildcard certificates.
+            """
+        )
+
+    def configure(self, updated):
+        if "cert_pregen" in updated:
+            self.addons = [self.hooks] if ctx.options.cert_pregen else []
+            ctx.master.addons.invalidate()
+        if "cert_pregen_hosts" in updated or "cert_pregen_flows" in updated:
+            hosts = list(ctx.options.cert_pregen_hosts)
+            try:
+                flows = io.read_flows_from_paths(ctx.options.cert_pregen_flows)
+            except exceptions.FlowReadException as e:
+                raise exceptions.OptionsError(str(e))
+            for f in flows:
+                if f.server_conn.sni:
+                    hosts.append(f.server_conn.sni)
+                elif f.server_conn.address:
+                    hosts.append(f.server_conn.address[0])
+            self.warmup = hosts
+            if self.is_running:
+                self.predict_all(self.warmup)
+
+    def running(self):
+        self.is_running = True
+        self.predict_all(self.warmup)
+
+    def done(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def predict_all(self, hosts: typing.Iterable[str]) -> None:
+        for host in hosts:
+            self.predict(host)
+
+    def predict(self, host: str) -> None:
+        certstore = self.certstore()
+        if not ctx.options.cert_pregen or not certstore or not host:
+            return
+        if certstore is not self.store:
+            # A new certstore has none of our certificates.
+            self.store = certstore
+            self.seen.clear()
+            self.subdomains.clear()
+        host = host.lower()
+        if host in self.seen:
+            self.seen.move_to_end(host)  # type: ignore
+            return
+        self.seen[host] = None
+        while len(self.seen) > SEEN_CAP:
+            self.seen.popitem(last=False)  # type: ignore
+
+        try:
+            name = host.encode("idna")
+        except UnicodeError:
+            return
+        # TlsLayer._find_cert picks this up through CertStore.get_generated
+        # for clients that send this host as SNI or connect to it.
+        self.submit(certstore.get_entry, name, [name])
+
+        parent = self.wildcard_parent(host)
+        if parent:
+            self.subdomains[parent] = self.subdomains.pop(parent, 0) + 1
+            while len(self.subdomains) > SEEN_CAP:
+                self.subdomains.popitem(last=False)  # type: ignore
+            if self.subdomains[parent] == ctx.options.cert_pregen_wildcard:
+                self.submit(certstore.add_wildcard, parent.encode("idna"))
+
+    def wildcard_parent(self, host: str) -> typing.Optional[str]:
+        if ctx.options.cert_pregen_wildcard <= 0 or "." not in host:
+            return None
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            pass
+        else:
+            return None
+        parent = host.split(".", 1)[1]
+        # Clients do not accept wildcards for public suffixes such as *.co.uk.
+        if get_tld(parent) == parent:
+            return None
+        return parent
+
+    def certstore(self):
+        server = ctx.master.server
+        config = server and getattr(server, "config", None)
+        return config and config.certstore
+
+    def submit(self, fn, *args) -> None:
+        if not self.executor:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix="CertPregen",
+            )
+        self.executor.submit(fn, *args)
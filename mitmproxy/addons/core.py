@@ -96,6 +96,19 @@ class Core:
         except exceptions.OptionsError as e:
             raise exceptions.CommandError(e) from e
 
+    @command.command("cert.latency")
+    def cert_latency(self) -> str:
+        """
+            Show how long it took to sign the generated certificates, as the
+            number of certificates per latency bucket in seconds.
+        """
+        server = ctx.master.server
+        config = server and getattr(server, "config", None)
+        if not config:
+            raise exceptions.CommandError("The proxy server is not running.")
+        h = config.certstore.generation_latency
+        return "{} certificates, {:.3f}s mean: {}".format(h.count, h.mean, h)
+
     @command.command("flow.resume")
     def resume(self, flows: typing.Sequence[flow.Flow]) -> None:
         """
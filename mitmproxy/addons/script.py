@@ -101,6 +101,8 @@ class Script:
             ns = load_script(self.fullpath)
             ctx.master.addons.register(ns)
             self.ns = ns
+            # Our addons attribute only reflects the new module now.
+            ctx.master.addons.invalidate()
         if self.ns:
             # We're already running, so we have to explicitly register and
             # configure the addon
@@ -201,6 +203,7 @@ class ScriptLoader:
                     newscripts.append(sc)
 
             self.addons = ordered
+            ctx.master.addons.invalidate()
 
             for s in newscripts:
                 ctx.master.addons.register(s)
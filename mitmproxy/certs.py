@@ -1,5 +1,10 @@
+import collections
+import concurrent.futures
+import hashlib
+import multiprocessing
 import os
 import ssl
+import threading
 import time
 import datetime
 import ipaddress
@@ -13,6 +18,7 @@ from pyasn1.error import PyAsn1Error
 import OpenSSL
 
 from mitmproxy.coretypes import serializable
+from mitmproxy.utils import histogram
 
 # Default expiry must not be too long: https://github.com/mitmproxy/mitmproxy/issues/815
 DEFAULT_EXP = 94608000  # = 24 * 60 * 60 * 365 * 3
@@ -127,12 +133,21 @@ def dummy_cert(privkey, cacert, commonname, sans, organization):
     return Cert(cert)
 
 
+class _PendingEntry:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.entry: typing.Optional[CertStoreEntry] = None
+        self.error: typing.Optional[Exception] = None
+
+
 class CertStoreEntry:
 
     def __init__(self, cert, privatekey, chain_file):
         self.cert = cert
         self.privatekey = privatekey
         self.chain_file = chain_file
+        # SSL contexts for this certificate, see mitmproxy.net.tls.cached_server_context
+        self.contexts: typing.Dict[typing.Any, typing.Tuple[OpenSSL.SSL.Context, float]] = {}
 
 
 TCustomCertId = bytes  # manually provided certs (e.g. mitmproxy's --certs)
@@ -144,6 +159,14 @@ class CertStore:
 
     """
         Implements an in-memory certificate store.
+
+        Up to store_cap generated certificates are kept in memory, the least
+        recently used one is dropped first. If cache_dir is set, generated
+        certificates are also saved there, so that they don't need to be
+        signed again after a restart.
+
+        If processes is set, certificates are signed in that many worker
+        processes instead of the calling thread. This class is thread-safe.
     """
     STORE_CAP = 100
 
@@ -152,21 +175,67 @@ class CertStore:
             default_privatekey,
             default_ca,
             default_chain_file,
-            dhparams):
+            dhparams,
+            store_cap: int = STORE_CAP,
+            cache_dir: typing.Optional[str] = None,
+            processes: int = 0):
         self.default_privatekey = default_privatekey
         self.default_ca = default_ca
         self.default_chain_file = default_chain_file
         self.dhparams = dhparams
+        self.store_cap = store_cap
+        self.cache_dir = cache_dir
+        self.processes = processes
+        self.lock = threading.Lock()
         self.certs: typing.Dict[TCertId, CertStoreEntry] = {}
-        self.expire_queue = []
+        self._pending: typing.Dict[TGeneratedCertId, _PendingEntry] = {}
+        self._executor: typing.Optional[concurrent.futures.ProcessPoolExecutor] = None
+        # Seconds it took to sign a certificate.
+        self.generation_latency = histogram.Histogram()
+        # Keys of generated certificates, least recently used first.
+        self.expire_queue: typing.Dict[TCertId, None] = collections.OrderedDict()
+        # Keys of generated wildcard certificates, see add_wildcard.
+        self.wildcards: typing.Set[TCertId] = set()
+
+    def expire(self, key: TCertId) -> None:
+        self.expire_queue[key] = None
+        self.expire_queue.move_to_end(key)  # type: ignore
+        while len(self.expire_queue) > max(self.store_cap, 0):
+            k, _ = self.expire_queue.popitem(last=False)  # type: ignore
+            self.certs.pop(k, None)
+            self.wildcards.discard(k)
+
+    def _cache_path(self, commonname, sans, organization):
+        spec = repr((
+            commonname,
+            tuple(sorted(set(sans))),
+            organization,
+            self.default_ca.digest("sha256"),
+        ))
+        return os.path.join(
+            self.cache_dir,
+            hashlib.sha256(spec.encode()).hexdigest() + ".pem"
+        )
 
-    def expire(self, entry):
-        self.expire_queue.append(entry)
-        if len(self.expire_queue) > self.STORE_CAP:
-            d = self.expire_queue.pop(0)
-            for k, v in list(self.certs.items()):
-                if v == d:
-                    del self.certs[k]
+    def _load_cached(self, path: str) -> typing.Optional["Cert"]:
+        try:
+            with open(path, "rb") as f:
+                cert = Cert.from_pem(f.read())
+        except (OSError, OpenSSL.crypto.Error):
+            return None
+        if cert.has_expired:
+            return None
+        return cert
+
+    def _save_cached(self, path: str, cert: "Cert") -> None:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(cert.to_pem())
+            os.replace(tmp, path)
+        except OSError:
+            pass
 
     @staticmethod
     def load_dhparam(path):
@@ -189,7 +258,7 @@ class CertStore:
             return dh
 
     @classmethod
-    def from_store(cls, path, basename, key_size):
+    def from_store(cls, path, basename, key_size, store_cap=STORE_CAP, cache_dir=None, processes=0):
         ca_path = os.path.join(path, basename + "-ca.pem")
         if not os.path.exists(ca_path):
             key, ca = cls.create_store(path, basename, key_size)
@@ -204,7 +273,7 @@ class CertStore:
                 raw)
         dh_path = os.path.join(path, basename + "-dhparam.pem")
         dh = cls.load_dhparam(dh_path)
-        return cls(key, ca, ca_path, dh)
+        return cls(key, ca, ca_path, dh, store_cap, cache_dir, processes)
 
     @staticmethod
     @contextlib.contextmanager
@@ -296,12 +365,13 @@ class CertStore:
             Adds a cert to the certstore. We register the CN in the cert plus
             any SANs, and also the list of names provided as an argument.
         """
-        if entry.cert.cn:
-            self.certs[entry.cert.cn] = entry
-        for i in entry.cert.altnames:
-            self.certs[i] = entry
-        for i in names:
-            self.certs[i] = entry
+        with self.lock:
+            if entry.cert.cn:
+                self.certs[entry.cert.cn] = entry
+            for i in entry.cert.altnames:
+                self.certs[i] = entry
+            for i in names:
+                self.certs[i] = entry
 
     @staticmethod
     def asterisk_forms(dn: bytes) -> typing.List[bytes]:
@@ -322,7 +392,19 @@ class CertStore:
             organization: typing.Optional[bytes] = None
     ) -> typing.Tuple["Cert", OpenSSL.SSL.PKey, str]:
         """
-            Returns an (cert, privkey, cert_chain) tuple.
+            Returns an (cert, privkey, cert_chain) tuple, see get_entry.
+        """
+        entry = self.get_entry(commonname, sans, organization)
+        return entry.cert, entry.privatekey, entry.chain_file
+
+    def get_entry(
+            self,
+            commonname: typing.Optional[bytes],
+            sans: typing.List[bytes],
+            organization: typing.Optional[bytes] = None
+    ) -> CertStoreEntry:
+        """
+            Returns the store entry for a certificate, generating it if needed.
 
             commonname: Common name for the generated certificate. Must be a
             valid, plain-ASCII, IDNA-encoded domain name.
@@ -331,7 +413,46 @@ class CertStore:
 
             organization: Organization name for the generated certificate.
         """
+        # Callers often collect SANs in a set, whose order differs between runs.
+        sans = sorted(set(sans))
+        key = (commonname, tuple(sans))
+        with self.lock:
+            entry = self._find(commonname, sans)
+            if entry:
+                return entry
+            pending = self._pending.get(key)
+            owner = pending is None
+            if pending is None:
+                pending = self._pending[key] = _PendingEntry()
+
+        # Only one thread generates a certificate, all others wait for it.
+        if not owner:
+            pending.done.wait()
+            if pending.error:
+                raise pending.error
+            assert pending.entry
+            return pending.entry
 
+        try:
+            entry = CertStoreEntry(
+                cert=self._generate(commonname, sans, organization),
+                privatekey=self.default_privatekey,
+                chain_file=self.default_chain_file)
+        except Exception as e:
+            pending.error = e
+            raise
+        else:
+            pending.entry = entry
+            with self.lock:
+                self.certs[key] = entry
+                self.expire(key)
+        finally:
+            with self.lock:
+                del self._pending[key]
+            pending.done.set()
+        return entry
+
+    def _find(self, commonname, sans) -> typing.Optional[CertStoreEntry]:
         potential_keys: typing.List[TCertId] = []
         if commonname:
             potential_keys.extend(self.asterisk_forms(commonname))
@@ -340,26 +461,137 @@ class CertStore:
         potential_keys.append(b"*")
         potential_keys.append((commonname, tuple(sans)))
 
+        # Generated wildcard certificates only cover one level of subdomains.
+        wildcard_keys = self.asterisk_forms(commonname)[:2] if commonname else []
+
         name = next(
-            filter(lambda key: key in self.certs, potential_keys),
+            filter(
+                lambda key: key in self.certs and (key not in self.wildcards or key in wildcard_keys),
+                potential_keys
+            ),
             None
         )
         if name:
-            entry = self.certs[name]
-        else:
-            entry = CertStoreEntry(
-                cert=dummy_cert(
-                    self.default_privatekey,
-                    self.default_ca,
-                    commonname,
-                    sans,
-                    organization),
-                privatekey=self.default_privatekey,
-                chain_file=self.default_chain_file)
-            self.certs[(commonname, tuple(sans))] = entry
-            self.expire(entry)
+            if name in self.expire_queue:
+                self.expire_queue.move_to_end(name)  # type: ignore
+            return self.certs[name]
+        return None
 
-        return entry.cert, entry.privatekey, entry.chain_file
+    def find_entry(
+            self,
+            commonname: typing.Optional[bytes],
+            sans: typing.List[bytes],
+    ) -> typing.Optional[CertStoreEntry]:
+        """
+            Like get_entry, but returns None instead of generating a certificate.
+        """
+        with self.lock:
+            return self._find(commonname, sorted(set(sans)))
+
+    def get_generated(self, name: bytes) -> typing.Optional[CertStoreEntry]:
+        """
+            Returns a certificate that was generated for exactly this host name,
+            or a wildcard certificate from add_wildcard that covers it. Unlike
+            get_entry, this never generates a certificate.
+        """
+        keys: typing.List[TCertId] = [(name, (name,))]
+        keys.extend(self.asterisk_forms(name)[1:2])
+        with self.lock:
+            for key in keys:
+                if key in self.certs and (isinstance(key, tuple) or key in self.wildcards):
+                    if key in self.expire_queue:
+                        self.expire_queue.move_to_end(key)  # type: ignore
+                    return self.certs[key]
+        return None
+
+    def add_wildcard(self, domain: bytes) -> CertStoreEntry:
+        """
+            Generate a certificate for domain and all its direct subdomains,
+            which get_entry returns for any of these subdomains from now on.
+        """
+        name = b"*." + domain
+        entry = self.get_entry(name, [name, domain])
+        with self.lock:
+            self.certs[name] = entry
+            self.wildcards.add(name)
+            self.expire(name)
+        return entry
+
+    def _generate(self, commonname, sans, organization) -> "Cert":
+        cert = None
+        if self.cache_dir:
+            path = self._cache_path(commonname, sans, organization)
+            cert = self._load_cached(path)
+        if cert is None:
+            start = time.time()
+            cert = self._sign(commonname, sans, organization)
+            self.generation_latency.observe(time.time() - start)
+            if self.cache_dir:
+                self._save_cached(path, cert)
+        return cert
+
+    def _sign(self, commonname, sans, organization) -> "Cert":
+        if self.processes > 0:
+            try:
+                pem = self._get_executor().submit(
+                    _dummy_cert_pem, commonname, sans, organization
+                ).result()
+            except RuntimeError:
+                # The pool has been shut down or a worker died.
+                pass
+            else:
+                return Cert.from_pem(pem)
+        return dummy_cert(
+            self.default_privatekey,
+            self.default_ca,
+            commonname,
+            sans,
+            organization)
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self.lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    self.processes,
+                    # Forking a process with many threads is not safe.
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(
+                        OpenSSL.crypto.dump_privatekey(OpenSSL.crypto.FILETYPE_PEM, self.default_privatekey),
+                        OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, self.default_ca),
+                    ),
+                )
+            return self._executor
+
+    def shutdown(self) -> None:
+        """
+            Stop the certificate generation processes, if any.
+        """
+        with self.lock:
+            self.processes = 0
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+_worker_ca: typing.Optional[typing.Tuple[OpenSSL.crypto.PKey, OpenSSL.crypto.X509]] = None
+
+
+def _init_worker(privkey_pem: bytes, cacert_pem: bytes) -> None:  # pragma: no cover
+    global _worker_ca
+    _worker_ca = (
+        OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM, privkey_pem),
+        OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, cacert_pem),
+    )
+
+
+def _dummy_cert_pem(commonname, sans, organization) -> bytes:  # pragma: no cover
+    """
+        Runs in a certificate generation process, see CertStore.processes.
+    """
+    assert _worker_ca
+    privkey, cacert = _worker_ca
+    return dummy_cert(privkey, cacert, commonname, sans, organization).to_pem()
 
 
 class _GeneralName(univ.Choice):
@@ -380,14 +612,59 @@ class _GeneralNames(univ.SequenceOf):
         constraint.ValueSizeConstraint(1, 1024)
 
 
+PARSED_CAP = 1000
+"""Number of distinct certificates whose parsed fields are kept."""
+
+# sha256 digest -> parsed fields, least recently used first.
+_parsed: typing.Dict[bytes, typing.Dict[str, typing.Any]] = collections.OrderedDict()
+_parsed_lock = threading.Lock()
+
+
+def _parsed_fields(x509):
+    """
+        Returns the dict of parsed fields for this certificate, which is
+        shared by all Cert instances for the same certificate.
+    """
+    key = x509.digest("sha256")
+    with _parsed_lock:
+        fields = _parsed.get(key)
+        if fields is None:
+            fields = _parsed[key] = {"digest:sha256": key}
+            while len(_parsed) > PARSED_CAP:
+                _parsed.popitem(last=False)  # type: ignore
+        else:
+            _parsed.move_to_end(key)  # type: ignore
+        return fields
+
+
 class Cert(serializable.Serializable):
+    """
+        A wrapper around an X509 certificate. Certificates are never modified,
+        so parsed fields are computed once and shared between all instances
+        for the same certificate.
+    """
 
     def __init__(self, cert):
-        """
-            Returns a (common name, [subject alternative names]) tuple.
-        """
         self.x509 = cert
 
+    @property
+    def x509(self):
+        return self._x509
+
+    @x509.setter
+    def x509(self, x509):
+        self._x509 = x509
+        self._fields = None
+
+    def _memo(self, name, f):
+        if self._fields is None:
+            self._fields = _parsed_fields(self._x509)
+        try:
+            return self._fields[name]
+        except KeyError:
+            value = self._fields[name] = f()
+            return value
+
     def __eq__(self, other):
         return self.digest("sha256") == other.digest("sha256")
 
@@ -412,25 +689,25 @@ class Cert(serializable.Serializable):
         return cls.from_pem(pem)
 
     def to_pem(self):
-        return OpenSSL.crypto.dump_certificate(
+        return self._memo("pem", lambda: OpenSSL.crypto.dump_certificate(
             OpenSSL.crypto.FILETYPE_PEM,
-            self.x509)
+            self.x509))
 
     def digest(self, name):
-        return self.x509.digest(name)
+        return self._memo("digest:" + name, lambda: self.x509.digest(name))
 
     @property
     def issuer(self):
-        return self.x509.get_issuer().get_components()
+        return list(self._memo("issuer", lambda: self.x509.get_issuer().get_components()))
 
     @property
     def notbefore(self):
-        t = self.x509.get_notBefore()
+        t = self._memo("notbefore", self.x509.get_notBefore)
         return datetime.datetime.strptime(t.decode("ascii"), "%Y%m%d%H%M%SZ")
 
     @property
     def notafter(self):
-        t = self.x509.get_notAfter()
+        t = self._memo("notafter", self.x509.get_notAfter)
         return datetime.datetime.strptime(t.decode("ascii"), "%Y%m%d%H%M%SZ")
 
     @property
@@ -439,14 +716,17 @@ class Cert(serializable.Serializable):
 
     @property
     def subject(self):
-        return self.x509.get_subject().get_components()
+        return list(self._memo("subject", lambda: self.x509.get_subject().get_components()))
 
     @property
     def serial(self):
-        return self.x509.get_serial_number()
+        return self._memo("serial", self.x509.get_serial_number)
 
     @property
     def keyinfo(self):
+        return self._memo("keyinfo", self._keyinfo)
+
+    def _keyinfo(self):
         pk = self.x509.get_pubkey()
         types = {
             OpenSSL.crypto.TYPE_RSA: "RSA",
@@ -459,17 +739,16 @@ class Cert(serializable.Serializable):
 
     @property
     def cn(self):
-        c = None
-        for i in self.subject:
-            if i[0] == b"CN":
-                c = i[1]
-        return c
+        return self._memo("cn", lambda: self._component(b"CN"))
 
     @property
     def organization(self):
+        return self._memo("organization", lambda: self._component(b"O"))
+
+    def _component(self, name):
         c = None
         for i in self.subject:
-            if i[0] == b"O":
+            if i[0] == name:
                 c = i[1]
         return c
 
@@ -479,6 +758,9 @@ class Cert(serializable.Serializable):
         Returns:
             All DNS altnames.
         """
+        return list(self._memo("altnames", self._altnames))
+
+    def _altnames(self):
         # tcp.TCPClient.convert_to_tls assumes that this property only contains DNS altnames for hostname verification.
         altnames = []
         for i in range(self.x509.get_extension_count()):
@@ -493,4 +775,4 @@ class Cert(serializable.Serializable):
                         e = i[0].asOctets()
                         altnames.append(e)
 
-        return altnames
+        return tuple(altnames)
@@ -6,6 +6,7 @@ import uuid
 from mitmproxy import certs
 from mitmproxy import exceptions
 from mitmproxy import stateobject
+from mitmproxy.net import resolver
 from mitmproxy.net import tcp
 from mitmproxy.net import tls
 from mitmproxy.utils import human
@@ -55,10 +56,24 @@ class ClientConnection(tcp.BaseHandler, stateobject.StateObject):
         self.alpn_proto_negotiated = None
         self.tls_version = None
         self.tls_extensions = None
+        self._client_hello: typing.Optional[tls.ClientHello] = None
 
     def connected(self):
         return bool(self.connection) and not self.finished
 
+    def get_client_hello(self) -> tls.ClientHello:
+        """
+            Peek into the connection and parse the ClientHello of the next TLS
+            handshake. The result is cached until the handshake is done, so
+            that all layers share it.
+
+            Raises:
+                TlsProtocolException, if the ClientHello cannot be read.
+        """
+        if self._client_hello is None:
+            self._client_hello = tls.ClientHello.from_file(self.rfile)
+        return self._client_hello
+
     def __repr__(self):
         if self.tls_established:
             tls = "[{}] ".format(self.tls_version)
@@ -136,13 +151,15 @@ class ClientConnection(tcp.BaseHandler, stateobject.StateObject):
         # Unfortunately OpenSSL provides no way to expose all TLS extensions, so we do this dance
         # here and use our Kaitai parser.
         try:
-            client_hello = tls.ClientHello.from_file(self.rfile)
+            client_hello = self.get_client_hello()
         except exceptions.TlsProtocolException:  # pragma: no cover
             pass  # if this fails, we don't want everything to go down.
         else:
             self.tls_extensions = client_hello.extensions
 
         super().convert_to_tls(cert, *args, **kwargs)
+        # A nested TLS connection would start with a new ClientHello.
+        self._client_hello = None
         self.timestamp_tls_setup = time.time()
         self.mitmcert = cert
         sni = self.connection.get_servername()
@@ -180,7 +197,9 @@ class ServerConnection(tcp.TCPClient, stateobject.StateObject):
     """
 
     def __init__(self, address, source_address=None, spoof_source_address=None):
-        tcp.TCPClient.__init__(self, address, source_address, spoof_source_address)
+        tcp.TCPClient.__init__(
+            self, address, source_address, spoof_source_address, resolver.default_resolver
+        )
 
         self.id = str(uuid.uuid4())
         self.alpn_proto_negotiated = None
@@ -23,10 +23,17 @@ class Channel:
         """
         if not self.should_exit.is_set():
             m.reply = Reply(m)
-            asyncio.run_coroutine_threadsafe(
-                self.master.addons.handle_lifecycle(mtype, m),
-                self.loop,
-            )
+            if self.master.addons.handles(mtype, m):
+                asyncio.run_coroutine_threadsafe(
+                    self.master.addons.handle_lifecycle(mtype, m),
+                    self.loop,
+                )
+            else:
+                # No addon is interested in this event, so we acknowledge it
+                # right here instead of taking a round trip through the loop.
+                m.reply.take()
+                m.reply.ack()
+                m.reply.commit()
             g = m.reply.q.get()
             if g == exceptions.Kill:
                 raise exceptions.Kill()
@@ -39,10 +46,11 @@ class Channel:
         """
         if not self.should_exit.is_set():
             m.reply = DummyReply()
-            asyncio.run_coroutine_threadsafe(
-                self.master.addons.handle_lifecycle(mtype, m),
-                self.loop,
-            )
+            if self.master.addons.handles(mtype, m):
+                asyncio.run_coroutine_threadsafe(
+                    self.master.addons.handle_lifecycle(mtype, m),
+                    self.loop,
+                )
 
 
 NO_REPLY = object()  # special object we can distinguish from a valid "None" reply.
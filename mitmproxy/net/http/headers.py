@@ -88,6 +88,27 @@ class Headers(multidict.MultiDict):
         }
         self.update(headers)
 
+    @property
+    def fields(self):
+        return self._fields
+
+    @fields.setter
+    def fields(self, value):
+        self._fields = value
+        self._index = None
+
+    def _get_index(self):
+        """
+        Returns a dict that maps lowercase header names to all their raw values.
+        The index is built on first use and dropped whenever the fields change.
+        """
+        if self._index is None:
+            index = {}
+            for k, v in self._fields:
+                index.setdefault(k.lower(), []).append(v)
+            self._index = index
+        return self._index
+
     @staticmethod
     def _reduce_values(values):
         # Headers can be folded
@@ -112,6 +133,12 @@ class Headers(multidict.MultiDict):
         for x in super().__iter__():
             yield _native(x)
 
+    def __contains__(self, key):
+        return _always_bytes(key).lower() in self._get_index()
+
+    def __len__(self):
+        return len(self._get_index())
+
     def get_all(self, name):
         """
         Like :py:meth:`get`, but does not fold multiple headers into a single one.
@@ -121,7 +148,7 @@ class Headers(multidict.MultiDict):
         name = _always_bytes(name)
         return [
             _native(x) for x in
-            super().get_all(name)
+            self._get_index().get(name.lower(), ())
         ]
 
     def set_all(self, name, values):
@@ -131,6 +158,9 @@ class Headers(multidict.MultiDict):
         """
         name = _always_bytes(name)
         values = [_always_bytes(x) for x in values]
+        if name.lower() not in self._get_index():
+            self.fields = self.fields + tuple((name, value) for value in values)
+            return
         return super().set_all(name, values)
 
     def insert(self, index, key, value):
@@ -326,9 +326,8 @@ def _read_headers(rfile):
             exceptions.HttpSyntaxException
     """
     ret = []
-    while True:
-        line = rfile.readline()
-        if not line or line == b"\r\n" or line == b"\n":
+    for line in _header_lines(rfile):
+        if line == b"\r\n" or line == b"\n":
             break
         if line[0] in b" \t":
             if not ret:
@@ -349,6 +348,19 @@ def _read_headers(rfile):
     return headers.Headers(ret)
 
 
+def _header_lines(rfile):
+    if hasattr(rfile, "read_until_blank_line"):
+        # Read the whole header block at once.
+        block = rfile.read_until_blank_line()
+        start = 0
+        while start < len(block):
+            end = block.find(b"\n", start) + 1 or len(block)
+            yield block[start:end]
+            start = end
+    else:
+        yield from iter(rfile.readline, b"")
+
+
 def _read_chunked(rfile, limit=sys.maxsize):
     """
     Read a HTTP body with chunked transfer encoding.
@@ -0,0 +1,160 @@
+"""
+A process-wide cache for upstream name resolution. TCPClient only uses it
+if it is passed in explicitly, which mitmproxy's server connections do.
+
+socket.getaddrinfo does not tell us the TTL of a DNS record, so results
+are cached for a fixed time. Failed lookups are cached for a (usually
+shorter) negative TTL, and concurrent lookups for the same name wait for
+a single call to getaddrinfo.
+"""
+import collections
+import socket
+import threading
+import time
+import typing
+
+AddrInfo = typing.List[typing.Tuple[socket.AddressFamily, socket.SocketKind, int, str, typing.Tuple]]
+
+
+def _copy_error(e: Exception) -> Exception:
+    # Each caller gets its own exception, so that tracebacks do not pile up on a shared instance.
+    return type(e)(*e.args)
+
+
+class _Lookup:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: AddrInfo = []
+        self.error: typing.Optional[Exception] = None
+
+
+class Resolver:
+    """
+        Caches socket.getaddrinfo results for TCP connections. This class is
+        thread-safe.
+    """
+    def __init__(
+        self,
+        ttl: float = 60,
+        negative_ttl: float = 5,
+        size: int = 1000,
+        hosts: typing.Optional[typing.Dict[str, str]] = None,
+    ) -> None:
+        self.lock = threading.Lock()
+        # (host, port) -> (expires, result or error), least recently used first.
+        self._cache: typing.Dict[
+            typing.Tuple[str, int],
+            typing.Tuple[float, typing.Union[AddrInfo, Exception]]
+        ] = collections.OrderedDict()
+        self._pending: typing.Dict[typing.Tuple[str, int], _Lookup] = {}
+        # host -> address family of the last successful connection.
+        self._families: typing.Dict[str, int] = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.configure(ttl, negative_ttl, size, hosts)
+
+    def configure(
+        self,
+        ttl: float,
+        negative_ttl: float,
+        size: int,
+        hosts: typing.Optional[typing.Dict[str, str]] = None,
+    ) -> None:
+        """
+            Change the cache settings. This drops all cached entries.
+        """
+        with self.lock:
+            self.ttl = ttl
+            self.negative_ttl = negative_ttl
+            self.size = size
+            self.hosts = {k.lower(): v for k, v in (hosts or {}).items()}
+            self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def clear(self) -> None:
+        with self.lock:
+            self._cache.clear()
+
+    def preferred_family(self, host: str) -> typing.Optional[int]:
+        """
+            The address family that the last connection to this host used.
+        """
+        with self.lock:
+            return self._families.get(host)
+
+    def remember_family(self, host: str, family: int) -> None:
+        with self.lock:
+            self._families[host] = family
+            self._families.move_to_end(host)  # type: ignore
+            while len(self._families) > max(self.size, 0):
+                self._families.popitem(last=False)  # type: ignore
+
+    def _lookup(self, host: str, port: int) -> AddrInfo:
+        override = self.hosts.get(host.lower())
+        if override:
+            return socket.getaddrinfo(override, port, 0, socket.SOCK_STREAM, 0, socket.AI_NUMERICHOST)
+        return socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+    def _store(self, key: typing.Tuple[str, int], value: typing.Union[AddrInfo, Exception]) -> None:
+        ttl = self.negative_ttl if isinstance(value, Exception) else self.ttl
+        if ttl <= 0 or self.size <= 0:
+            return
+        self._cache[key] = (time.time() + ttl, value)
+        self._cache.move_to_end(key)  # type: ignore
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)  # type: ignore
+
+    def getaddrinfo(self, host: str, port: int) -> AddrInfo:
+        """
+            Like socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM).
+
+            Raises:
+                socket.gaierror, if the name cannot be resolved.
+        """
+        key = (host, port)
+        with self.lock:
+            cached = self._cache.get(key)
+            if cached:
+                expires, value = cached
+                if expires > time.time():
+                    self.hits += 1
+                    self._cache.move_to_end(key)  # type: ignore
+                    if isinstance(value, Exception):
+                        raise _copy_error(value)
+                    return list(value)
+                del self._cache[key]
+            self.misses += 1
+            lookup = self._pending.get(key)
+            owner = lookup is None
+            if lookup is None:
+                lookup = self._pending[key] = _Lookup()
+
+        if not owner:
+            lookup.done.wait()
+        else:
+            try:
+                lookup.result = self._lookup(host, port)
+            except socket.gaierror as e:
+                lookup.error = e
+            except Exception as e:
+                # Not a resolution failure (e.g. an interrupted call): don't cache it.
+                with self.lock:
+                    del self._pending[key]
+                lookup.error = e
+                lookup.done.set()
+                raise
+            with self.lock:
+                del self._pending[key]
+                self._store(key, lookup.error or lookup.result)
+            lookup.done.set()
+
+        if lookup.error:
+            raise _copy_error(lookup.error)
+        return list(lookup.result)
+
+
+default_resolver = Resolver()
+"""The resolver used for all upstream connections."""
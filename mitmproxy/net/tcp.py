@@ -1,7 +1,12 @@
 import os
+import asyncio
+import collections
 import errno
+import queue
 import select
+import selectors
 import socket
+import struct
 import sys
 import threading
 import time
@@ -149,22 +154,84 @@ class Reader(_FileLike):
         self.add_log(result)
         return result
 
+    def _peek_available(self, length):
+        """
+            Returns up to length bytes that can be read without blocking for
+            long, without consuming them, or None if the underlying file
+            object does not support peeking right now.
+
+            We do not buffer in Python: other layers may take over the raw
+            connection at any time, and must see all unconsumed data.
+        """
+        if isinstance(self.o, socket_fileobject):
+            try:
+                return self.o._sock.recv(length, socket.MSG_PEEK)
+            except socket.timeout:
+                raise exceptions.TcpTimeout()
+            except socket.error as e:
+                raise exceptions.TcpDisconnect(str(e))
+        elif isinstance(self.o, SSL.Connection):
+            try:
+                return self.o.recv(length, socket.MSG_PEEK)
+            except (SSL.WantReadError, SSL.WantWriteError, SSL.ZeroReturnError, SSL.SysCallError):
+                # .read() knows how to handle these.
+                return None
+            except SSL.Error as e:
+                raise exceptions.TlsException(str(e))
+        return None
+
     def readline(self, size=None):
         result = b''
-        bytes_read = 0
-        while True:
-            if size is not None and bytes_read >= size:
+        while size is None or len(result) < size:
+            length = self.BLOCKSIZE if size is None else min(self.BLOCKSIZE, size - len(result))
+            chunk = self._peek_available(length)
+            if chunk:
+                # Consume exactly up to and including the line break.
+                n = chunk.find(b'\n') + 1 or len(chunk)
+            else:
+                n = 1
+            data = self.read(n)
+            if not data:
                 break
-            ch = self.read(1)
-            bytes_read += 1
-            if not ch:
+            result += data
+            if data.endswith(b'\n'):
                 break
-            else:
-                result += ch
-                if ch == b'\n':
-                    break
         return result
 
+    def read_until_blank_line(self):
+        """
+            Reads a block of lines up to and including the first empty line,
+            e.g. HTTP headers. If the connection is closed before, everything
+            up to this point is returned.
+        """
+        result = b''
+        line_start = 0
+        while True:
+            chunk = self._peek_available(self.BLOCKSIZE)
+            if not chunk:
+                line = self.readline()
+                result += line
+                if not line or line == b'\r\n' or line == b'\n':
+                    return result
+                line_start = len(result)
+                continue
+
+            end = None
+            pos = chunk.find(b'\n')
+            while pos != -1:
+                line_length = len(result) - line_start + pos + 1
+                prev = chunk[pos - 1:pos] if pos else result[-1:]
+                if line_length == 1 or (line_length == 2 and prev == b'\r'):
+                    end = pos + 1
+                    break
+                line_start = len(result) + pos + 1
+                pos = chunk.find(b'\n', pos + 1)
+
+            data = self.read(end or len(chunk))
+            result += data
+            if end or not data:
+                return result
+
     def safe_read(self, length):
         """
             Like .read, but is guaranteed to either return length bytes, or
@@ -354,9 +421,34 @@ class ConnectionCloser:
             self.conn.close()
 
 
+def sort_addresses(addresses, preferred_family=None):
+    """
+        Order getaddrinfo results for Happy Eyeballs: alternate between
+        address families, starting with the preferred family (or the family
+        of the first address).
+    """
+    if not addresses:
+        return []
+    first = preferred_family or addresses[0][0]
+    by_family = {}
+    for a in addresses:
+        by_family.setdefault(a[0], []).append(a)
+    families = sorted(by_family, key=lambda f: f != first)
+    ret = []
+    while any(by_family.values()):
+        for f in families:
+            if by_family[f]:
+                ret.append(by_family[f].pop(0))
+    return ret
+
+
 class TCPClient(_Connection):
 
-    def __init__(self, address, source_address=None, spoof_source_address=None):
+    def __init__(self, address, source_address=None, spoof_source_address=None, resolver=None):
+        """
+            resolver: An optional mitmproxy.net.resolver.Resolver that caches
+            host name lookups. By default, every connection asks the system.
+        """
         super().__init__(None)
         self.address = address
         self.source_address = source_address
@@ -364,6 +456,7 @@ class TCPClient(_Connection):
         self.server_certs = []
         self.sni = None
         self.spoof_source_address = spoof_source_address
+        self.resolver = resolver
 
     @property
     def ssl_verification_error(self) -> Optional[exceptions.InvalidCertificateException]:
@@ -386,9 +479,16 @@ class TCPClient(_Connection):
             **sslctx_kwargs
         )
         self.connection = SSL.Connection(context, self.connection)
+        # The context may be shared, see tls.verify_hostname.
+        self.connection.sni = sni
+        self.connection.address = self.address
         if sni:
             self.sni = sni
             self.connection.set_tlsext_host_name(sni.encode("idna"))
+        session_key = (self.address, sni, tuple(alpn_protos or ()), context)
+        cached = tls.default_session_cache.get(session_key)
+        if cached:
+            self.connection.set_session(cached[0])
         self.connection.set_connect_state()
         try:
             self.connection.do_handshake()
@@ -398,6 +498,17 @@ class TCPClient(_Connection):
             else:
                 raise exceptions.TlsException("SSL handshake error: %s" % repr(v))
 
+        resumed = cached is not None and tls.session_reused(self.connection)
+        if resumed:
+            # The verify callback does not run for resumed sessions.
+            self.connection.cert_error = cached[1]
+        tls.default_session_cache.put(
+            session_key,
+            self.connection.get_session(),
+            self.ssl_verification_error,
+            resumed,
+        )
+
         self.cert = certs.Cert(self.connection.get_peer_certificate())
 
         # Keep all server certificates in a list
@@ -408,42 +519,101 @@ class TCPClient(_Connection):
         self.rfile.set_descriptor(self.connection)
         self.wfile.set_descriptor(self.connection)
 
+    happy_eyeballs_delay = 0.25
+    """Seconds to wait for a connection attempt before the next address is tried in parallel."""
+
     def makesocket(self, family, type, proto):
         # some parties (cuckoo sandbox) need to hook this
         return socket.socket(family, type, proto)
 
-    def create_connection(self, timeout=None):
-        # Based on the official socket.create_connection implementation of Python 3.6.
-        # https://github.com/python/cpython/blob/3cc5817cfaf5663645f4ee447eaed603d2ad290a/Lib/socket.py
+    def _socket(self, family, type, proto):
+        sock = self.makesocket(family, type, proto)
+        try:
+            if self.source_address:
+                sock.bind(self.source_address)
+            if self.spoof_source_address:
+                try:
+                    if not sock.getsockopt(socket.SOL_IP, socket.IP_TRANSPARENT):
+                        sock.setsockopt(socket.SOL_IP, socket.IP_TRANSPARENT, 1)  # pragma: windows no cover  pragma: osx no cover
+                except Exception as e:
+                    # socket.IP_TRANSPARENT might not be available on every OS and Python version
+                    raise exceptions.TcpException(
+                        "Failed to spoof the source address: " + str(e)
+                    )
+        except Exception:
+            sock.close()
+            raise
+        return sock
 
+    def create_connection(self, timeout=None):
+        """
+            Connect to self.address using Happy Eyeballs (RFC 8305): If an
+            attempt does not succeed within happy_eyeballs_delay seconds, the
+            next address is tried in parallel, alternating between address
+            families. If an attempt fails, the next address is tried right away.
+            The first established connection wins, and its address family is
+            tried first for the next connection to the same host.
+        """
+        host, port = self.address[0], self.address[1]
+        if self.resolver is not None:
+            addresses = sort_addresses(
+                self.resolver.getaddrinfo(host, port),
+                self.resolver.preferred_family(host)
+            )
+        else:
+            addresses = sort_addresses(socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM))
+        deadline = time.time() + timeout if timeout else None
+        next_attempt = 0.0
+        pending = {}  # socket -> address family
+        # Unlike select.select, selectors also work for file descriptors >= FD_SETSIZE.
+        # On Windows, they report failed connection attempts as writable as well.
+        selector = selectors.DefaultSelector()
         err = None
-        for res in socket.getaddrinfo(self.address[0], self.address[1], 0, socket.SOCK_STREAM):
-            af, socktype, proto, canonname, sa = res
-            sock = None
-            try:
-                sock = self.makesocket(af, socktype, proto)
-                if timeout:
-                    sock.settimeout(timeout)
-                if self.source_address:
-                    sock.bind(self.source_address)
-                if self.spoof_source_address:
+        try:
+            while addresses or pending:
+                now = time.time()
+                if deadline is not None and now >= deadline:
+                    raise socket.timeout("timed out")
+                if addresses and (not pending or now >= next_attempt):
+                    af, socktype, proto, canonname, sa = addresses.pop(0)
                     try:
-                        if not sock.getsockopt(socket.SOL_IP, socket.IP_TRANSPARENT):
-                            sock.setsockopt(socket.SOL_IP, socket.IP_TRANSPARENT, 1)  # pragma: windows no cover  pragma: osx no cover
-                    except Exception as e:
-                        # socket.IP_TRANSPARENT might not be available on every OS and Python version
-                        if sock is not None:
-                            sock.close()
-                        raise exceptions.TcpException(
-                            "Failed to spoof the source address: " + str(e)
-                        )
-                sock.connect(sa)
-                return sock
-
-            except socket.error as _:
-                err = _
-                if sock is not None:
-                    sock.close()
+                        sock = self._socket(af, socktype, proto)
+                    except socket.error as e:
+                        err = e
+                        next_attempt = now
+                        continue
+                    sock.setblocking(False)
+                    ret = sock.connect_ex(sa)
+                    if ret in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        pending[sock] = af
+                        selector.register(sock, selectors.EVENT_WRITE)
+                        next_attempt = now + self.happy_eyeballs_delay
+                    else:
+                        err = socket.error(ret, os.strerror(ret))
+                        sock.close()
+                        next_attempt = now
+                    continue
+
+                wakeup = [t for t in (deadline, next_attempt if addresses else None) if t is not None]
+                wait = max(min(wakeup) - now, 0) if wakeup else None
+                for key, _ in selector.select(wait):
+                    sock = key.fileobj
+                    selector.unregister(sock)
+                    af = pending.pop(sock)
+                    ret = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if ret:
+                        err = socket.error(ret, os.strerror(ret))
+                        sock.close()
+                        next_attempt = now
+                        continue
+                    sock.settimeout(timeout)
+                    if self.resolver is not None:
+                        self.resolver.remember_family(host, af)
+                    return sock
+        finally:
+            selector.close()
+            for sock in pending:
+                sock.close()
 
         if err is not None:
             raise err
@@ -489,17 +659,30 @@ class BaseHandler(_Connection):
         self.server = server
         self.clientcert = None
 
-    def convert_to_tls(self, cert, key, **sslctx_kwargs):
+    def convert_to_tls(self, cert, key, contexts=None, **sslctx_kwargs):
         """
         Convert connection to SSL.
         For a list of parameters, see tls.create_server_context(...)
-        """
 
-        context = tls.create_server_context(
-            cert=cert,
-            key=key,
-            **sslctx_kwargs)
+        contexts: A dict that caches the SSL contexts for this certificate
+        and key, e.g. CertStoreEntry.contexts. See tls.cached_server_context(...)
+        """
+        alpn_select_callback = None
+        if contexts is None:
+            context = tls.create_server_context(
+                cert=cert,
+                key=key,
+                **sslctx_kwargs)
+        else:
+            alpn_select_callback = sslctx_kwargs.pop("alpn_select_callback", None)
+            context = tls.cached_server_context(
+                contexts,
+                cert=cert,
+                key=key,
+                alpn_select_callback=alpn_select_callback,
+                **sslctx_kwargs)
         self.connection = SSL.Connection(context, self.connection)
+        self.connection.alpn_select_callback = alpn_select_callback
         self.connection.set_accept_state()
         try:
             self.connection.do_handshake()
@@ -544,9 +727,147 @@ class Counter:
             self._count -= 1
 
 
+class WorkerPool:
+    """
+        A fixed-size pool of handler threads with a bounded backlog.
+
+        Worker threads are started lazily, up to size. Work that cannot be
+        picked up by a worker right away waits in the backlog. If idle_timeout
+        is given, workers exit after being idle for that many seconds.
+    """
+
+    def __init__(self, name, size, backlog, idle_timeout=None):
+        self.name = name
+        self.size = size
+        self.backlog = backlog
+        self.idle_timeout = idle_timeout
+        self.closed = False
+        self._queue: queue.Queue = queue.Queue()
+        self._cond = threading.Condition()
+        self._workers = []
+        self._started = 0
+        self._idle = 0
+        self._active = 0
+        self._pending = 0
+        self.dispatched = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def queue_depth(self):
+        """
+            Number of work items waiting for a worker.
+        """
+        with self._cond:
+            return self._pending
+
+    @property
+    def active_workers(self):
+        """
+            Number of workers currently processing a work item.
+        """
+        with self._cond:
+            return self._active
+
+    @property
+    def mean_wait(self):
+        """
+            Mean time in seconds work items spent waiting for a worker.
+        """
+        with self._cond:
+            if not self.dispatched:
+                return 0.0
+            return self.total_wait / self.dispatched
+
+    @property
+    def saturated(self):
+        """
+            True if all workers are busy and the backlog is full, i.e. submit
+            would refuse new work.
+        """
+        with self._cond:
+            return len(self._workers) >= self.size and self._pending >= self._idle + self.backlog
+
+    def submit(self, func, *args):
+        """
+            Schedule func(*args) on the pool.
+
+            Returns False if the pool is closed or saturated. This never blocks.
+        """
+        with self._cond:
+            if self.closed:
+                return False
+            if len(self._workers) < self.size and self._idle <= self._pending:
+                t = basethread.BaseThread(
+                    "%s worker %s" % (self.name, self._started),
+                    target=self._run,
+                )
+                t.setDaemon(1)
+                t.start()
+                self._workers.append(t)
+                self._started += 1
+                self._idle += 1
+            if self._pending < self._idle + self.backlog:
+                self._pending += 1
+                self._queue.put((func, args, time.time()))
+                return True
+            return False
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self._cond:
+                    # Only leave if the remaining idle workers cover all pending work.
+                    if self._idle > self._pending:
+                        self._idle -= 1
+                        self._workers.remove(threading.current_thread())
+                        return
+                continue
+            if item is None:
+                return
+            func, args, enqueued = item
+            wait = time.time() - enqueued
+            with self._cond:
+                self._pending -= 1
+                self._idle -= 1
+                self._active += 1
+                self.dispatched += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                func(*args)
+            finally:
+                with self._cond:
+                    self._active -= 1
+                    self._idle += 1
+
+    def shutdown(self):
+        """
+            Stop accepting work and let workers exit once they are idle.
+        """
+        with self._cond:
+            self.closed = True
+            workers = len(self._workers)
+        for _ in range(workers):
+            self._queue.put(None)
+
+
+def reset_socket(sock):
+    """
+        Abort a connection by closing it with a TCP RST.
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+    except socket.error:  # pragma: no cover
+        pass
+    sock.close()
+
+
 class TCPServer:
 
-    def __init__(self, address):
+    def __init__(self, address, reuse_port=False):
         self.address = address
         self.__is_shut_down = threading.Event()
         self.__is_shut_down.set()
@@ -564,6 +885,8 @@ class TCPServer:
             self.socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if reuse_port:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.socket.setsockopt(IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
             self.socket.bind(self.address)
         except socket.error:
@@ -577,6 +900,8 @@ class TCPServer:
                 self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                if reuse_port:
+                    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
                 self.socket.bind(self.address)
             except socket.error:
                 if self.socket:
@@ -588,6 +913,8 @@ class TCPServer:
             self.socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if reuse_port:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.socket.bind(self.address)
 
         self.address = self.socket.getsockname()
@@ -610,34 +937,111 @@ class TCPServer:
             finally:
                 close_socket(connection)
 
+    def process_connection(self, connection, client_address):
+        """
+            Hand an accepted connection over to a new handler thread.
+        """
+        t = basethread.BaseThread(
+            "TCPConnectionHandler (%s: %s:%s -> %s:%s)" % (
+                self.__class__.__name__,
+                client_address[0],
+                client_address[1],
+                self.address[0],
+                self.address[1],
+            ),
+            target=self.connection_thread,
+            args=(connection, client_address),
+        )
+        t.setDaemon(1)
+        try:
+            t.start()
+        except threading.ThreadError:
+            self.handle_error(connection, client_address)
+            connection.close()
+
+    def can_process(self):
+        """
+            Whether process_connection can take a new connection right now.
+            Otherwise, new connections are left waiting in the listen backlog
+            or, with serve_forever_async, on the event loop.
+        """
+        return True
+
     def serve_forever(self, poll_interval=0.1):
         self.__is_shut_down.clear()
         try:
             while not self.__shutdown_request:
+                if not self.can_process():
+                    time.sleep(poll_interval)
+                    continue
                 r, w_, e_ = select.select([self.socket], [], [], poll_interval)
                 if self.socket in r:
                     connection, client_address = self.socket.accept()
-                    t = basethread.BaseThread(
-                        "TCPConnectionHandler (%s: %s:%s -> %s:%s)" % (
-                            self.__class__.__name__,
-                            client_address[0],
-                            client_address[1],
-                            self.address[0],
-                            self.address[1],
-                        ),
-                        target=self.connection_thread,
-                        args=(connection, client_address),
-                    )
-                    t.setDaemon(1)
-                    try:
-                        t.start()
-                    except threading.ThreadError:
-                        self.handle_error(connection, client_address)
-                        connection.close()
+                    self.process_connection(connection, client_address)
         finally:
             self.__shutdown_request = False
             self.__is_shut_down.set()
 
+    def serve_forever_async(self, poll_interval=0.1):
+        """
+            Like serve_forever, but accepts connections on an asyncio event loop.
+
+            Accepted connections are parked on the loop until the client has sent
+            its first data and only then handed to process_connection. Connections
+            that have not been used yet therefore cost a file descriptor, not a
+            thread. Connections are not returned to the loop afterwards, so idle
+            keep-alive connections still occupy a thread.
+        """
+        # The proactor loop on Windows does not support add_reader.
+        loop = asyncio.SelectorEventLoop()
+        parked = {}
+        # Connections with data that wait until we can process them.
+        ready: collections.deque = collections.deque()
+
+        def accept():
+            try:
+                connection, client_address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            connection.setblocking(True)
+            parked[connection.fileno()] = connection
+            loop.add_reader(connection.fileno(), readable, connection, client_address)
+
+        def readable(connection, client_address):
+            loop.remove_reader(connection.fileno())
+            del parked[connection.fileno()]
+            ready.append((connection, client_address))
+            dispatch()
+
+        def dispatch():
+            while ready and self.can_process():
+                self.process_connection(*ready.popleft())
+
+        def check_shutdown():
+            if self.__shutdown_request:
+                loop.stop()
+            else:
+                dispatch()
+                loop.call_later(poll_interval, check_shutdown)
+
+        self.__is_shut_down.clear()
+        self.socket.setblocking(False)
+        try:
+            loop.add_reader(self.socket.fileno(), accept)
+            loop.call_soon(check_shutdown)
+            loop.run_forever()
+        finally:
+            loop.remove_reader(self.socket.fileno())
+            for fd, connection in parked.items():
+                loop.remove_reader(fd)
+                close_socket(connection)
+            for connection, _ in ready:
+                close_socket(connection)
+            loop.close()
+            self.socket.setblocking(True)
+            self.__shutdown_request = False
+            self.__is_shut_down.set()
+
     def shutdown(self):
         self.__shutdown_request = True
         self.__is_shut_down.wait()
@@ -2,20 +2,19 @@
 # then add options to disable certain methods
 # https://bugs.launchpad.net/pyopenssl/+bug/1020632/comments/3
 import binascii
-import io
+import collections
 import os
 import struct
 import threading
+import time
 import typing
 from ssl import match_hostname, CertificateError
 
 import certifi
 from OpenSSL import SSL
-from kaitaistruct import KaitaiStream
 
 import mitmproxy.options  # noqa
 from mitmproxy import exceptions, certs
-from mitmproxy.contrib.kaitaistruct import tls_client_hello
 from mitmproxy.net import check
 
 BASIC_OPTIONS = (
@@ -212,6 +211,73 @@ def _create_ssl_context(
     return context
 
 
+CLIENT_CONTEXT_CACHE_SIZE = 100
+"""Number of client contexts that are kept for reuse, see create_client_context."""
+
+_client_contexts: typing.Dict[typing.Any, SSL.Context] = collections.OrderedDict()
+_client_contexts_lock = threading.Lock()
+
+
+def verify_hostname(
+        conn: SSL.Connection,
+        x509: SSL.X509,
+        errno: int,
+        depth: int,
+        is_cert_verified: bool
+) -> bool:
+    """
+    Verify callback of client contexts. The hostname of the leaf certificate
+    is checked against the sni attribute of the connection, and errors are
+    stored as its cert_error attribute.
+    """
+    sni = getattr(conn, "sni", None)
+    if is_cert_verified and depth == 0:
+        # Verify hostname of leaf certificate, unless we did so recently.
+        key = (x509.digest("sha256"), sni)
+        if default_hostname_cache.get(key):
+            return is_cert_verified
+        cert = certs.Cert(x509)
+        try:
+            crt: typing.Dict[str, typing.Any] = dict(
+                subjectAltName=[("DNS", x.decode("ascii", "strict")) for x in cert.altnames]
+            )
+            if cert.cn:
+                crt["subject"] = [[["commonName", cert.cn.decode("ascii", "strict")]]]
+            if sni:
+                # SNI hostnames allow support of IDN by using ASCII-Compatible Encoding
+                # Conversion algorithm is in RFC 3490 which is implemented by idna codec
+                # https://docs.python.org/3/library/codecs.html#text-encodings
+                # https://tools.ietf.org/html/rfc6066#section-3
+                # https://tools.ietf.org/html/rfc4985#section-3
+                hostname = sni.encode("idna").decode("ascii")
+            else:
+                hostname = "no-hostname"
+            match_hostname(crt, hostname)
+            default_hostname_cache.put(key)
+        except (ValueError, CertificateError) as e:
+            conn.cert_error = exceptions.InvalidCertificateException(
+                "Certificate verification error for {}: {}".format(
+                    sni or repr(getattr(conn, "address", None)),
+                    str(e)
+                )
+            )
+            is_cert_verified = False
+    elif is_cert_verified:
+        pass
+    else:
+        conn.cert_error = exceptions.InvalidCertificateException(
+            "Certificate verification error for {}: {} (errno: {}, depth: {})".format(
+                sni,
+                SSL._ffi.string(SSL._lib.X509_verify_cert_error_string(errno)).decode(),
+                errno,
+                depth
+            )
+        )
+
+    # SSL_VERIFY_NONE: The handshake will be continued regardless of the verification result.
+    return is_cert_verified
+
+
 def create_client_context(
         cert: str = None,
         sni: str = None,
@@ -225,63 +291,32 @@ def create_client_context(
         sni: Server Name Indication. Required for VERIFY_PEER
         address: server address, used for expressive error messages only
         verify: A bit field consisting of OpenSSL.SSL.VERIFY_* values
+
+    Loading the trusted CA certificates is expensive, so contexts are shared
+    by all connections with the same arguments (apart from sni and address).
+    The hostname check happens per connection: sni and address must be set
+    as attributes of each SSL.Connection, see verify_hostname.
     """
 
     if sni is None and verify != SSL.VERIFY_NONE:
         raise exceptions.TlsException("Cannot validate certificate hostname without SNI")
 
-    def verify_callback(
-            conn: SSL.Connection,
-            x509: SSL.X509,
-            errno: int,
-            depth: int,
-            is_cert_verified: bool
-    ) -> bool:
-        if is_cert_verified and depth == 0:
-            # Verify hostname of leaf certificate.
-            cert = certs.Cert(x509)
-            try:
-                crt: typing.Dict[str, typing.Any] = dict(
-                    subjectAltName=[("DNS", x.decode("ascii", "strict")) for x in cert.altnames]
-                )
-                if cert.cn:
-                    crt["subject"] = [[["commonName", cert.cn.decode("ascii", "strict")]]]
-                if sni:
-                    # SNI hostnames allow support of IDN by using ASCII-Compatible Encoding
-                    # Conversion algorithm is in RFC 3490 which is implemented by idna codec
-                    # https://docs.python.org/3/library/codecs.html#text-encodings
-                    # https://tools.ietf.org/html/rfc6066#section-3
-                    # https://tools.ietf.org/html/rfc4985#section-3
-                    hostname = sni.encode("idna").decode("ascii")
-                else:
-                    hostname = "no-hostname"
-                match_hostname(crt, hostname)
-            except (ValueError, CertificateError) as e:
-                conn.cert_error = exceptions.InvalidCertificateException(
-                    "Certificate verification error for {}: {}".format(
-                        sni or repr(address),
-                        str(e)
-                    )
-                )
-                is_cert_verified = False
-        elif is_cert_verified:
-            pass
-        else:
-            conn.cert_error = exceptions.InvalidCertificateException(
-                "Certificate verification error for {}: {} (errno: {}, depth: {})".format(
-                    sni,
-                    SSL._ffi.string(SSL._lib.X509_verify_cert_error_string(errno)).decode(),
-                    errno,
-                    depth
-                )
-            )
-
-        # SSL_VERIFY_NONE: The handshake will be continued regardless of the verification result.
-        return is_cert_verified
+    spec: typing.Any = (cert, verify, log_master_secret) + tuple(
+        (k, tuple(v) if isinstance(v, list) else v) for k, v in sorted(sslctx_kwargs.items())
+    )
+    try:
+        hash(spec)
+    except TypeError:
+        spec = None
+    with _client_contexts_lock:
+        context = _client_contexts.get(spec)
+        if context is not None:
+            _client_contexts.move_to_end(spec)  # type: ignore
+            return context
 
     context = _create_ssl_context(
         verify=verify,
-        verify_callback=verify_callback,
+        verify_callback=verify_hostname,
         **sslctx_kwargs,
     )
 
@@ -292,9 +327,146 @@ def create_client_context(
             context.use_certificate_file(cert)
         except SSL.Error as v:
             raise exceptions.TlsException("SSL client certificate error: %s" % str(v))
+
+    if spec is not None:
+        with _client_contexts_lock:
+            _client_contexts[spec] = context
+            while len(_client_contexts) > CLIENT_CONTEXT_CACHE_SIZE:
+                _client_contexts.popitem(last=False)  # type: ignore
     return context
 
 
+class SessionCache:
+    """
+        A bounded cache of client-side TLS sessions, so that new upstream
+        connections can resume an earlier handshake instead of doing a full
+        one. Sessions are keyed by everything that must match for a resumed
+        session to be valid, i.e. (address, sni, alpn, context). This class
+        is thread-safe.
+    """
+    def __init__(self, size: int = 1000) -> None:
+        self.lock = threading.Lock()
+        # key -> (session, verification error), least recently used first.
+        self._sessions: typing.Dict[
+            typing.Any,
+            typing.Tuple[SSL.Session, typing.Optional[exceptions.InvalidCertificateException]]
+        ] = collections.OrderedDict()
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def configure(self, size: int) -> None:
+        """
+            Change the cache size. This drops all cached sessions.
+        """
+        with self.lock:
+            self.size = size
+            self._sessions.clear()
+
+    def clear(self) -> None:
+        with self.lock:
+            self._sessions.clear()
+
+    def get(self, key):
+        """
+            Returns a (session, verification error) tuple, or None.
+        """
+        with self.lock:
+            entry = self._sessions.get(key)
+            if entry is not None:
+                self._sessions.move_to_end(key)  # type: ignore
+            return entry
+
+    def put(self, key, session, cert_error=None, resumed=False) -> None:
+        """
+            Store the session of a completed handshake. resumed tells whether
+            the handshake resumed a cached session, which counts as a hit.
+        """
+        with self.lock:
+            if resumed:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if self.size <= 0:
+                return
+            self._sessions[key] = (session, cert_error)
+            self._sessions.move_to_end(key)  # type: ignore
+            while len(self._sessions) > self.size:
+                self._sessions.popitem(last=False)  # type: ignore
+
+
+default_session_cache = SessionCache()
+"""The TLS session cache used for all upstream connections."""
+
+
+class HostnameCache:
+    """
+        Remembers for a while which (leaf certificate fingerprint, SNI) pairs
+        passed hostname verification, so that repeated connections to an
+        origin skip it. OpenSSL still verifies the certificate chain on every
+        handshake. This class is thread-safe.
+    """
+    def __init__(self, ttl: float = 300, size: int = 1000) -> None:
+        self.lock = threading.Lock()
+        # key -> expires, least recently used first.
+        self._verified: typing.Dict[typing.Tuple[bytes, typing.Optional[str]], float] = collections.OrderedDict()
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._verified)
+
+    def configure(self, ttl: float, size: int) -> None:
+        """
+            Change the cache settings. This drops all cached entries.
+        """
+        with self.lock:
+            self.ttl = ttl
+            self.size = size
+            self._verified.clear()
+
+    def clear(self) -> None:
+        with self.lock:
+            self._verified.clear()
+
+    def get(self, key) -> bool:
+        """
+            Did the certificate pass hostname verification for this SNI recently?
+        """
+        with self.lock:
+            expires = self._verified.get(key)
+            if expires is not None:
+                if expires > time.time():
+                    self._verified.move_to_end(key)  # type: ignore
+                    self.hits += 1
+                    return True
+                del self._verified[key]
+            self.misses += 1
+            return False
+
+    def put(self, key) -> None:
+        with self.lock:
+            if self.ttl <= 0 or self.size <= 0:
+                return
+            self._verified[key] = time.time() + self.ttl
+            self._verified.move_to_end(key)  # type: ignore
+            while len(self._verified) > self.size:
+                self._verified.popitem(last=False)  # type: ignore
+
+
+default_hostname_cache = HostnameCache()
+"""The hostname verification cache used for all upstream connections."""
+
+
+def session_reused(conn: SSL.Connection) -> bool:
+    return bool(SSL._lib.SSL_session_reused(conn._ssl))
+
+
 def accept_all(
         conn_: SSL.Connection,
         x509: SSL.X509,
@@ -314,12 +486,18 @@ def create_server_context(
         chain_file=None,
         dhparams=None,
         extra_chain_certs: typing.Iterable[certs.Cert] = None,
+        session_timeout: typing.Optional[int] = None,
         **sslctx_kwargs
 ) -> SSL.Context:
     """
         cert: A certs.Cert object or the path to a certificate
         chain file.
 
+        session_timeout: Clients can resume their TLS sessions for this many
+        seconds, using either a session id or a session ticket. 0 disables
+        session resumption, None keeps the OpenSSL defaults. Resumption only
+        works if the context is reused, see cached_server_context(...).
+
         handle_sni: SNI handler, should take a connection object. Server
         name can be retrieved like this:
 
@@ -364,9 +542,62 @@ def create_server_context(
     if dhparams:
         SSL._lib.SSL_CTX_set_tmp_dh(context._context, dhparams)
 
+    if session_timeout == 0:
+        context.set_session_cache_mode(SSL.SESS_CACHE_OFF)
+        context.set_options(SSL.OP_NO_TICKET)
+    elif session_timeout is not None:
+        # Required to resume sessions with client certificates.
+        context.set_session_id(b"mitmproxy")
+        context.set_session_cache_mode(SSL.SESS_CACHE_SERVER)
+        context.set_timeout(session_timeout)
+
     return context
 
 
+def alpn_select_from_connection(conn: SSL.Connection, options: typing.List[bytes]) -> bytes:
+    """
+        ALPN select callback for contexts that are shared by many connections.
+        Defers to the alpn_select_callback attribute of the connection.
+    """
+    return conn.alpn_select_callback(conn, options)
+
+
+def cached_server_context(
+        contexts: typing.Dict[typing.Any, typing.Tuple[SSL.Context, float]],
+        cert: typing.Union[certs.Cert, str],
+        key: SSL.PKey,
+        alpn_select_callback=None,
+        **sslctx_kwargs
+) -> SSL.Context:
+    """
+        Like create_server_context(...), but contexts are reused if they have
+        been created with the same arguments before. contexts must only be
+        used for one certificate and key.
+
+        A context may be shared by many connections, so alpn_select_callback
+        must be set as an attribute of each connection instead, see
+        alpn_select_from_connection(...). Contexts with SNI handlers or extra
+        chain certificates are not cached.
+
+        Each context holds the server-side session cache and a random session
+        ticket key. If session_timeout is set, contexts are replaced after
+        that many seconds, which rotates the ticket key.
+    """
+    if alpn_select_callback is not None:
+        sslctx_kwargs["alpn_select_callback"] = alpn_select_from_connection
+    if not sslctx_kwargs.get("extra_chain_certs"):
+        # An empty chain (e.g. no upstream certificates yet) is the same as none.
+        sslctx_kwargs.pop("extra_chain_certs", None)
+    if sslctx_kwargs.get("handle_sni") or "extra_chain_certs" in sslctx_kwargs:
+        return create_server_context(cert, key, **sslctx_kwargs)
+    spec = tuple(sorted(sslctx_kwargs.items()))
+    cached = contexts.get(spec)
+    lifetime = sslctx_kwargs.get("session_timeout")
+    if cached is None or (lifetime and cached[1] + lifetime <= time.time()):
+        cached = contexts[spec] = (create_server_context(cert, key, **sslctx_kwargs), time.time())
+    return cached[0]
+
+
 def is_tls_record_magic(d):
     """
     Returns:
@@ -415,46 +646,103 @@ def get_client_hello(rfile):
 
 
 class ClientHello:
+    """
+        The parts of a ClientHello message that we need: cipher suites, SNI,
+        ALPN and the raw extensions. The message is parsed in place, extension
+        bodies are memoryview slices of the raw message.
+
+        Raises EOFError if the message is truncated.
+    """
 
     def __init__(self, raw_client_hello):
-        self._client_hello = tls_client_hello.TlsClientHello(
-            KaitaiStream(io.BytesIO(raw_client_hello))
-        )
+        self._raw = memoryview(raw_client_hello)
+        self.cipher_suites: typing.List[int] = []
+        self._extensions: typing.List[typing.Tuple[int, memoryview]] = []
+        self._sni: typing.Optional[bytes] = None
+        self._alpn_protocols: typing.Optional[typing.List[bytes]] = None
+        try:
+            self._parse()
+        except (struct.error, IndexError) as e:
+            raise EOFError("Truncated Client Hello: {}".format(e))
+
+    def _parse(self):
+        data = self._raw
+        # Skip version (2 bytes), random (32 bytes) and session id.
+        offset = 34
+        offset += 1 + data[offset]
+        cipher_suites_len, = struct.unpack_from("!H", data, offset)
+        offset += 2
+        self.cipher_suites = list(struct.unpack_from("!%dH" % (cipher_suites_len // 2), data, offset))
+        offset += cipher_suites_len
+        offset += 1 + data[offset]
+        if offset > len(data):
+            raise IndexError("compression methods")
+
+        if offset < len(data):
+            # The length of the extensions block is not needed, we read until the end.
+            offset += 2
+            while offset < len(data):
+                ext_type, ext_len = struct.unpack_from("!HH", data, offset)
+                offset += 4
+                if offset + ext_len > len(data):
+                    raise IndexError("extension {}".format(ext_type))
+                body = data[offset:offset + ext_len]
+                offset += ext_len
+                self._extensions.append((ext_type, body))
+                if ext_type == 0x00:
+                    sni = self._parse_sni(body)
+                    if self._sni is None and sni:
+                        self._sni = sni
+                elif ext_type == 0x10:
+                    alpn_protocols = self._parse_alpn(body)
+                    if self._alpn_protocols is None:
+                        self._alpn_protocols = alpn_protocols
 
-    @property
-    def cipher_suites(self):
-        return self._client_hello.cipher_suites.cipher_suites
+    @staticmethod
+    def _parse_sni(body: memoryview) -> typing.Optional[bytes]:
+        # server_name_list length, then (name_type, length, host_name) entries
+        if len(body) < 2:
+            raise IndexError("server name list")
+        server_names = []
+        offset = 2
+        while offset < len(body):
+            name_type, length = struct.unpack_from("!BH", body, offset)
+            offset += 3
+            if offset + length > len(body):
+                raise IndexError("server name")
+            server_names.append((name_type, body[offset:offset + length].tobytes()))
+            offset += length
+        if len(server_names) == 1 and server_names[0][0] == 0 and check.is_valid_host(server_names[0][1]):
+            return server_names[0][1]
+        return None
+
+    @staticmethod
+    def _parse_alpn(body: memoryview) -> typing.List[bytes]:
+        # protocol_name_list length, then length-prefixed protocol names
+        if len(body) < 2:
+            raise IndexError("protocol name list")
+        protocols = []
+        offset = 2
+        while offset < len(body):
+            length = body[offset]
+            offset += 1
+            if offset + length > len(body):
+                raise IndexError("protocol name")
+            protocols.append(body[offset:offset + length].tobytes())
+            offset += length
+        return protocols
 
     @property
     def sni(self) -> typing.Optional[bytes]:
-        if self._client_hello.extensions:
-            for extension in self._client_hello.extensions.extensions:
-                is_valid_sni_extension = (
-                    extension.type == 0x00 and
-                    len(extension.body.server_names) == 1 and
-                    extension.body.server_names[0].name_type == 0 and
-                    check.is_valid_host(extension.body.server_names[0].host_name)
-                )
-                if is_valid_sni_extension:
-                    return extension.body.server_names[0].host_name
-        return None
+        return self._sni
 
     @property
-    def alpn_protocols(self):
-        if self._client_hello.extensions:
-            for extension in self._client_hello.extensions.extensions:
-                if extension.type == 0x10:
-                    return list(x.name for x in extension.body.alpn_protocols)
-        return []
+    def alpn_protocols(self) -> typing.List[bytes]:
+        return self._alpn_protocols or []
 
     @property
     def extensions(self) -> typing.List[typing.Tuple[int, bytes]]:
-        ret = []
-        if self._client_hello.extensions:
-            for extension in self._client_hello.extensions.extensions:
-                body = getattr(extension, "_raw_body", extension.body)
-                ret.append((extension.type, body))
-        return ret
+        return [(ext_type, body.tobytes()) for ext_type, body in self._extensions]
 
     @classmethod
     def from_file(cls, client_conn) -> "ClientHello":
@@ -81,6 +81,117 @@ class Options(optmanager.OptManager):
             "listen_port", int, LISTEN_PORT,
             "Proxy service port."
         )
+        self.add_option(
+            "async_accept", bool, False,
+            """
+            Accept client connections on an asyncio event loop. Connections are
+            only handed to a connection thread once the client has sent its
+            first data, so connections that are opened ahead of time and not
+            used yet do not occupy a thread. After that, a connection keeps its
+            thread until it is closed, including while it is idle between
+            keep-alive requests.
+            """
+        )
+        self.add_option(
+            "connection_workers", int, 0,
+            """
+            Handle client connections on a fixed-size pool of worker threads.
+            By default, every client connection gets its own thread.
+            """
+        )
+        self.add_option(
+            "connection_backlog", int, 128,
+            """
+            Number of client connections that may wait for a free worker when
+            all connection workers are busy.
+            """
+        )
+        self.add_option(
+            "connection_overload", str, "queue",
+            """
+            What to do with new client connections if all connection workers
+            are busy and the backlog is full: "queue" leaves them waiting in
+            the operating system's listen backlog (or parked on the event loop
+            with async_accept) until a slot frees up, "reject" answers with 503
+            Service Unavailable, and "reset" aborts the connection.
+            """,
+            choices=["queue", "reject", "reset"],
+        )
+        self.add_option(
+            "workers", int, 1,
+            """
+            Number of proxy processes (mitmdump only). With more than one
+            worker, each process accepts connections on the listen port via
+            SO_REUSEPORT and runs the full addon chain, while output addons
+            run in the main process on the merged flow stream.
+            """
+        )
+        self.add_option(
+            "upstream_pool", bool, False,
+            """
+            Keep idle upstream HTTP/1.1 connections in a pool shared by all
+            clients and reuse them for later requests to the same server.
+            Only applies in regular and reverse proxy mode.
+            """
+        )
+        self.add_option(
+            "upstream_pool_max_idle", int, 100,
+            "Maximum number of idle connections in the upstream connection pool."
+        )
+        self.add_option(
+            "upstream_pool_max_per_host", int, 6,
+            "Maximum number of idle pooled connections to a single server."
+        )
+        self.add_option(
+            "upstream_pool_idle_timeout", int, 30,
+            "Close pooled upstream connections that have been idle for this many seconds."
+        )
+        self.add_option(
+            "upstream_http2_multiplex", bool, False,
+            """
+            Send the HTTPS requests of HTTP/1.1 clients as streams over a
+            shared HTTP/2 connection per server, if the server supports HTTP/2.
+            Only applies in regular and reverse proxy mode.
+            """
+        )
+        self.add_option(
+            "dns_cache_ttl", int, 60,
+            "Cache resolved upstream host names for this many seconds. 0 disables the cache."
+        )
+        self.add_option(
+            "dns_cache_negative_ttl", int, 5,
+            "Cache failed upstream host name lookups for this many seconds."
+        )
+        self.add_option(
+            "dns_cache_size", int, 1000,
+            "Maximum number of host names in the DNS cache."
+        )
+        self.add_option(
+            "dns_hosts", Sequence[str], [],
+            """
+            Resolve upstream host names to fixed addresses instead of asking
+            DNS. Each entry has the form "host=address".
+            """
+        )
+        self.add_option(
+            "upstream_tls_session_cache_size", int, 1000,
+            """
+            Remember the TLS sessions of this many upstream servers, so that
+            new connections can resume them. 0 disables session resumption.
+            """
+        )
+        self.add_option(
+            "upstream_tls_verify_cache_ttl", int, 300,
+            """
+            Skip hostname verification for this many seconds after an upstream
+            certificate was verified for the same SNI. The certificate chain is
+            always verified. 0 disables the cache.
+            """
+        )
+        self.add_option(
+            "upstream_tls_verify_cache_size", int, 1000,
+            "Number of verified upstream certificates to remember."
+        )
         self.add_option(
             "upstream_bind_address", str, "",
             "Address to bind upstream requests to."
@@ -110,6 +221,25 @@ class Options(optmanager.OptManager):
             with misbehaving servers.
             """
         )
+        self.add_option(
+            "http2_max_concurrent_streams", int, 100,
+            """
+            Maximum number of concurrent streams per HTTP/2 client connection.
+            This is also the maximum number of threads that handle the streams
+            of one connection. Idle threads exit after a few seconds.
+            """
+        )
+        self.add_option(
+            "http2_stream_buffer_size", int, 1024 * 1024,
+            """
+            Maximum number of bytes buffered per HTTP/2 stream. The flow control
+            window of a stream is only reopened as buffered data is processed.
+            """
+        )
+        self.add_option(
+            "http2_connection_buffer_size", int, 16 * 1024 * 1024,
+            "Maximum number of bytes buffered for all streams of an HTTP/2 connection."
+        )
         self.add_option(
             "websocket", bool, True,
             "Enable/disable WebSocket support. "
@@ -137,6 +267,14 @@ class Options(optmanager.OptManager):
             """,
             choices=list(tls.VERSION_CHOICES.keys()),
         )
+        self.add_option(
+            "tls_session_timeout_client", int, 300,
+            """
+            Allow clients to resume their TLS sessions for this many seconds,
+            using session ids or session tickets. The session ticket keys are
+            rotated at the same interval. 0 disables session resumption.
+            """
+        )
         self.add_option(
             "ssl_version_server", str, "secure",
             """
@@ -181,5 +319,24 @@ class Options(optmanager.OptManager):
             TLS key size for certificates and CA.
             """
         )
+        self.add_option(
+            "cert_cache_size", int, 100,
+            "Maximum number of generated certificates that are kept in memory."
+        )
+        self.add_option(
+            "cert_processes", int, 0,
+            """
+            Sign generated certificates in this many separate processes, so
+            that other connections are not blocked while signing. 0 signs
+            them in the connection thread.
+            """
+        )
+        self.add_option(
+            "cert_cache_dir", Optional[str], None,
+            """
+            Save generated certificates to this directory, so that they can be
+            reused after a restart.
+            """
+        )
 
         self.update(**kwargs)
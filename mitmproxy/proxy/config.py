@@ -1,5 +1,8 @@
+import collections
+import ipaddress
 import os
 import re
+import threading
 import typing
 
 from OpenSSL import crypto
@@ -7,23 +10,124 @@ from OpenSSL import crypto
 from mitmproxy import certs
 from mitmproxy import exceptions
 from mitmproxy import options as moptions
+from mitmproxy.net import resolver
 from mitmproxy.net import server_spec
+from mitmproxy.net import tls
+from mitmproxy.proxy import connection_pool
+
+
+HOST_MATCHER_CACHE_SIZE = 1000
+"""Number of (host, port) results that are remembered by a HostMatcher."""
+
+# Patterns of the form ^example\.com:443$ or ^(.+\.)?example\.com:443$, where the
+# port may also be \d+ or be left open (^example\.com:), can be matched without a regex.
+_LITERAL = re.compile(
+    r"""
+    \^
+    (?P<subdomains>\(\.\+\\\.\)\?)?
+    (?P<host>(?:[a-zA-Z0-9_-]|\\\.)+)
+    :
+    (?:(?P<port>[0-9]+)\$|\\d\+\$|)
+    \Z
+    """,
+    re.VERBOSE
+)
+# Patterns that cannot be combined into one alternation because they refer to
+# their own groups or set global flags.
+_UNCOMBINABLE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]")
+# Hosts for which the literal patterns match exactly like the regexes they stand for.
+_PLAIN_HOST = re.compile(r"[a-z0-9_.-]*\Z")
+_PLAIN_PORT = re.compile(r"[0-9]+\Z")
 
 
 class HostMatcher:
+    """
+        Matches (host, port) addresses against a list of regexes for "host:port".
+
+        For ignore and tcp matchers, a host matches if any pattern matches.
+        Literal hosts and domains (see _LITERAL) are looked up in a dict, and all
+        other patterns are combined into a single regex. Results are cached.
+        This class is thread-safe.
+    """
     def __init__(self, handle, patterns=tuple()):
         self.handle = handle
         self.patterns = list(patterns)
         self.regexes = [re.compile(p, re.IGNORECASE) for p in self.patterns]
 
+        # (host, port or None) -> None
+        self.hosts: typing.Dict[typing.Tuple[str, typing.Optional[str]], None] = {}
+        # domain -> set of ports (None for any port), for ^(.+\.)?domain:port$
+        self.domains: typing.Dict[str, typing.Set[typing.Optional[str]]] = {}
+        self.literal_regexes = []
+        combinable = []
+        self.other_regexes = []
+        for pattern, rex in zip(self.patterns, self.regexes):
+            m = _LITERAL.match(pattern)
+            if m:
+                host = m.group("host").replace("\\.", ".").lower()
+                if m.group("subdomains"):
+                    self.domains.setdefault(host, set()).add(m.group("port"))
+                else:
+                    self.hosts[(host, m.group("port"))] = None
+                self.literal_regexes.append(rex)
+            elif _UNCOMBINABLE.search(pattern):
+                self.other_regexes.append(rex)
+            else:
+                combinable.append(pattern)
+        if combinable:
+            try:
+                combined = re.compile("|".join("(?:%s)" % p for p in combinable), re.IGNORECASE)
+            except re.error:
+                self.other_regexes.extend(re.compile(p, re.IGNORECASE) for p in combinable)
+            else:
+                self.other_regexes.append(combined)
+
+        self.lock = threading.Lock()
+        # (host, port) -> result, least recently used first.
+        self.cache: typing.Dict[typing.Tuple, bool] = collections.OrderedDict()
+
     def __call__(self, address):
         if not address:
             return False
-        host = "%s:%s" % address
+        key = tuple(address)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)  # type: ignore
+                return self.cache[key]
+        result = self._match(*key)
+        with self.lock:
+            self.cache[key] = result
+            while len(self.cache) > HOST_MATCHER_CACHE_SIZE:
+                self.cache.popitem(last=False)  # type: ignore
+        return result
+
+    def _match(self, host, port):
+        address = "%s:%s" % (host, port)
         if self.handle in ["ignore", "tcp"]:
-            return any(rex.search(host) for rex in self.regexes)
+            return (
+                self._match_literal(str(host), str(port), address) or
+                any(rex.search(address) for rex in self.other_regexes)
+            )
         else:  # self.handle == "allow"
-            return any(not rex.search(host) for rex in self.regexes)
+            return any(not rex.search(address) for rex in self.regexes)
+
+    def _match_literal(self, host, port, address):
+        host = host.lower()
+        if not _PLAIN_HOST.match(host) or not _PLAIN_PORT.match(port):
+            return any(rex.search(address) for rex in self.literal_regexes)
+        if (host, port) in self.hosts or (host, None) in self.hosts:
+            return True
+        if self.domains:
+            # ^(.+\.)?domain matches the domain itself and subdomains with a non-empty first label.
+            i = -1
+            while True:
+                ports = self.domains.get(host[i + 1:])
+                if ports and (port in ports or None in ports):
+                    return True
+                i = host.find(".", max(i + 1, 1))
+                if i < 0:
+                    return False
+        return False
 
     def __bool__(self):
         return bool(self.patterns)
@@ -38,6 +142,8 @@ class ProxyConfig:
         self.check_filter: typing.Optional[HostMatcher] = None
         self.check_tcp: typing.Optional[HostMatcher] = None
         self.upstream_server: typing.Optional[server_spec.ServerSpec] = None
+        self.connection_pool: typing.Optional[connection_pool.ConnectionPool] = None
+        self.multiplex_pool: typing.Optional[connection_pool.MultiplexPool] = None
         self.configure(options, set(options.keys()))
         options.changed.connect(self.configure)
 
@@ -46,45 +152,111 @@ class ProxyConfig:
             raise exceptions.OptionsError("--ignore-hosts and --allow-hosts are mutually "
                                           "exclusive; please choose one.")
 
-        if options.ignore_hosts:
-            self.check_filter = HostMatcher("ignore", options.ignore_hosts)
-        elif options.allow_hosts:
-            self.check_filter = HostMatcher("allow", options.allow_hosts)
-        else:
-            self.check_filter = HostMatcher(False)
+        if {"ignore_hosts", "allow_hosts"} & set(updated):
+            if options.ignore_hosts:
+                self.check_filter = HostMatcher("ignore", options.ignore_hosts)
+            elif options.allow_hosts:
+                self.check_filter = HostMatcher("allow", options.allow_hosts)
+            else:
+                self.check_filter = HostMatcher(False)
         if "tcp_hosts" in updated:
             self.check_tcp = HostMatcher("tcp", options.tcp_hosts)
 
-        certstore_path = os.path.expanduser(options.confdir)
-        if not os.path.exists(os.path.dirname(certstore_path)):
-            raise exceptions.OptionsError(
-                "Certificate Authority parent directory does not exist: %s" %
-                os.path.dirname(certstore_path)
+        # Replacing the store drops all generated certificates.
+        if {"confdir", "key_size", "certs", "cert_cache_size", "cert_cache_dir", "cert_processes"} & set(updated):
+            certstore_path = os.path.expanduser(options.confdir)
+            if not os.path.exists(os.path.dirname(certstore_path)):
+                raise exceptions.OptionsError(
+                    "Certificate Authority parent directory does not exist: %s" %
+                    os.path.dirname(certstore_path)
+                )
+            certstore = certs.CertStore.from_store(
+                certstore_path,
+                moptions.CONF_BASENAME,
+                options.key_size,
+                options.cert_cache_size,
+                options.cert_cache_dir and os.path.expanduser(options.cert_cache_dir),
+                options.cert_processes,
             )
-        key_size = options.key_size
-        self.certstore = certs.CertStore.from_store(
-            certstore_path,
-            moptions.CONF_BASENAME,
-            key_size
-        )
 
-        for c in options.certs:
-            parts = c.split("=", 1)
-            if len(parts) == 1:
-                parts = ["*", parts[0]]
+            for c in options.certs:
+                parts = c.split("=", 1)
+                if len(parts) == 1:
+                    parts = ["*", parts[0]]
+
+                cert = os.path.expanduser(parts[1])
+                if not os.path.exists(cert):
+                    raise exceptions.OptionsError(
+                        "Certificate file does not exist: %s" % cert
+                    )
+                try:
+                    certstore.add_cert_file(parts[0], cert)
+                except crypto.Error:
+                    raise exceptions.OptionsError(
+                        "Invalid certificate format: %s" % cert
+                    )
+            old = getattr(self, "certstore", None)
+            if old is not None:
+                old.shutdown()
+                # Keep the statistics of the previous store.
+                certstore.generation_latency = old.generation_latency
+            self.certstore = certstore
 
-            cert = os.path.expanduser(parts[1])
-            if not os.path.exists(cert):
-                raise exceptions.OptionsError(
-                    "Certificate file does not exist: %s" % cert
-                )
-            try:
-                self.certstore.add_cert_file(parts[0], cert)
-            except crypto.Error:
-                raise exceptions.OptionsError(
-                    "Invalid certificate format: %s" % cert
-                )
         m = options.mode
         if m.startswith("upstream:") or m.startswith("reverse:"):
             _, spec = server_spec.parse_with_mode(options.mode)
             self.upstream_server = spec
+
+        if any(i.startswith("dns_") for i in updated):
+            hosts = {}
+            for entry in options.dns_hosts:
+                host, sep, address = entry.partition("=")
+                try:
+                    ipaddress.ip_address(address)
+                except ValueError:
+                    sep = ""
+                if not host or not sep:
+                    raise exceptions.OptionsError(
+                        "Invalid DNS host override, expected host=address: %s" % entry
+                    )
+                hosts[host] = address
+            resolver.default_resolver.configure(
+                options.dns_cache_ttl,
+                options.dns_cache_negative_ttl,
+                options.dns_cache_size,
+                hosts,
+            )
+
+        if "upstream_tls_session_cache_size" in updated:
+            tls.default_session_cache.configure(options.upstream_tls_session_cache_size)
+
+        if any(i.startswith("upstream_tls_verify_cache_") for i in updated):
+            tls.default_hostname_cache.configure(
+                options.upstream_tls_verify_cache_ttl,
+                options.upstream_tls_verify_cache_size,
+            )
+
+        # Pooled connections were established with the previous settings.
+        pool_settings = any(
+            i.startswith(("upstream_pool", "ssl_", "ciphers_server", "client_certs")) or i == "mode"
+            for i in updated
+        )
+        if pool_settings:
+            if self.connection_pool is not None:
+                self.connection_pool.clear()
+            # Only regular and reverse proxy mode talk to servers directly.
+            if options.upstream_pool and (m == "regular" or m.startswith("reverse:")):
+                self.connection_pool = connection_pool.ConnectionPool(
+                    options.upstream_pool_max_idle,
+                    options.upstream_pool_max_per_host,
+                    options.upstream_pool_idle_timeout,
+                )
+            else:
+                self.connection_pool = None
+        if pool_settings or any(i.startswith(("upstream_http2", "http2")) for i in updated):
+            if self.multiplex_pool is not None:
+                self.multiplex_pool.clear()
+            if options.upstream_http2_multiplex and options.http2 and (m == "regular" or m.startswith("reverse:")):
+                self.multiplex_pool = connection_pool.MultiplexPool()
+            else:
+                self.multiplex_pool = None
@@ -0,0 +1,214 @@
+import collections
+import select
+import threading
+import time
+import typing
+
+from mitmproxy import connections
+
+PoolKey = typing.Tuple[typing.Any, ...]
+
+
+def is_reusable(conn: connections.ServerConnection) -> bool:
+    """
+        An idle connection is only reusable if the server has neither closed
+        it nor sent unsolicited data.
+    """
+    if not conn.connected():
+        return False
+    try:
+        if conn.tls_established and conn.connection.pending():
+            return False
+        readable, _, _ = select.select([conn.connection], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+
+class ConnectionPool:
+    """
+        A pool of idle upstream connections that can be shared across client
+        connections.
+
+        Connections are keyed by everything that makes them interchangeable,
+        i.e. (address, tls, sni, alpn, client certificates). The most recently
+        released connection for a key is handed out first, and the oldest idle
+        connection is closed first if a limit is hit. This class is thread-safe.
+    """
+    def __init__(self, max_idle: int, max_per_host: int, idle_timeout: float) -> None:
+        self.max_idle = max_idle
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+
+        self.lock = threading.Lock()
+        # id(conn) -> (key, conn, released), oldest first.
+        self._idle: typing.Dict[int, typing.Tuple[PoolKey, connections.ServerConnection, float]] = collections.OrderedDict()
+        # key -> [conn], most recently released last.
+        self._by_key: typing.Dict[PoolKey, typing.List[connections.ServerConnection]] = collections.defaultdict(list)
+        self._per_host: typing.Dict[typing.Any, int] = collections.Counter()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._idle)
+
+    def _take(self, conn: connections.ServerConnection) -> None:
+        key, _, _ = self._idle.pop(id(conn))
+        self._by_key[key].remove(conn)
+        if not self._by_key[key]:
+            del self._by_key[key]
+        self._per_host[key[0]] -= 1
+        if not self._per_host[key[0]]:
+            del self._per_host[key[0]]
+
+    def _discard(self, conn: connections.ServerConnection) -> None:
+        self._take(conn)
+        conn.finish()
+        conn.close()
+
+    def _expire(self) -> None:
+        deadline = time.time() - self.idle_timeout
+        while self._idle:
+            _, conn, released = next(iter(self._idle.values()))
+            if released > deadline:
+                break
+            self._discard(conn)
+
+    def get(self, key: PoolKey) -> typing.Optional[connections.ServerConnection]:
+        """
+            Borrow an idle connection for the given key, or return None.
+        """
+        with self.lock:
+            self._expire()
+            while self._by_key.get(key):
+                conn = self._by_key[key][-1]
+                if is_reusable(conn):
+                    self._take(conn)
+                    self.hits += 1
+                    return conn
+                self._discard(conn)
+            self.misses += 1
+            return None
+
+    def put(self, key: PoolKey, conn: connections.ServerConnection) -> bool:
+        """
+            Return an idle connection to the pool. Returns False if the pool is
+            full for this host, in which case the caller keeps ownership.
+        """
+        with self.lock:
+            self._expire()
+            if self._per_host[key[0]] >= self.max_per_host:
+                return False
+            if self.max_idle <= 0:
+                return False
+            while len(self._idle) >= self.max_idle:
+                _, oldest, _ = next(iter(self._idle.values()))
+                self._discard(oldest)
+            self._idle[id(conn)] = (key, conn, time.time())
+            self._by_key[key].append(conn)
+            self._per_host[key[0]] += 1
+            return True
+
+    def clear(self) -> None:
+        """
+            Close all idle connections.
+        """
+        with self.lock:
+            while self._idle:
+                _, conn, _ = next(iter(self._idle.values()))
+                self._discard(conn)
+
+
+class MultiplexPool:
+    """
+        Upstream connections that carry many requests at the same time, e.g.
+        HTTP/2 connections that are shared by HTTP/1.1 clients.
+
+        Connections are keyed like in ConnectionPool and stay in the pool
+        until they are closed. Connections must provide ``closed`` and
+        ``available()``, which tells whether another request fits. The pool
+        also remembers which servers do not support multiplexing, and makes
+        sure that only one connection per key is established at a time.
+        This class is thread-safe.
+    """
+    def __init__(self, max_unsupported: int = 1000) -> None:
+        self.max_unsupported = max_unsupported
+
+        self.lock = threading.Lock()
+        self._conns: typing.Dict[PoolKey, typing.List[typing.Any]] = collections.defaultdict(list)
+        self._connecting: typing.Dict[PoolKey, threading.Event] = {}
+        # key -> None, least recently used first.
+        self._unsupported: typing.Dict[PoolKey, None] = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(conns) for conns in self._conns.values())
+
+    def get(self, key: PoolKey) -> typing.Optional[typing.Any]:
+        """
+            Return an open connection for the given key that can take another
+            request, or None.
+        """
+        with self.lock:
+            conns = [c for c in self._conns.get(key, []) if not c.closed]
+            if conns:
+                self._conns[key] = conns
+            else:
+                self._conns.pop(key, None)
+            for conn in conns:
+                if conn.available():
+                    self.hits += 1
+                    return conn
+            self.misses += 1
+            return None
+
+    def unsupported(self, key: PoolKey) -> bool:
+        """
+            Did the server for this key refuse to multiplex before?
+        """
+        with self.lock:
+            if key in self._unsupported:
+                self._unsupported.move_to_end(key)  # type: ignore
+                return True
+            return False
+
+    def begin_connect(self, key: PoolKey) -> typing.Optional[threading.Event]:
+        """
+            Announce that we are about to establish a connection for the given
+            key. If another thread is already doing so, its event is returned
+            and the caller should wait for it instead. Otherwise, the caller
+            must call end_connect().
+        """
+        with self.lock:
+            if key in self._connecting:
+                return self._connecting[key]
+            self._connecting[key] = threading.Event()
+            return None
+
+    def end_connect(self, key: PoolKey, conn: typing.Any = None, unsupported: bool = False) -> None:
+        """
+            Add the new connection to the pool (if any) and wake up all threads
+            that waited for it.
+        """
+        with self.lock:
+            if conn is not None:
+                self._conns[key].append(conn)
+            if unsupported:
+                self._unsupported[key] = None
+                while len(self._unsupported) > self.max_unsupported:
+                    self._unsupported.popitem(last=False)  # type: ignore
+            self._connecting.pop(key).set()
+
+    def clear(self) -> None:
+        """
+            Close all connections.
+        """
+        with self.lock:
+            conns = [c for cs in self._conns.values() for c in cs]
+            self._conns.clear()
+        for conn in conns:
+            conn.close()
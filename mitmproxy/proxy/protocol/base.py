@@ -1,3 +1,5 @@
+import typing
+
 from mitmproxy import exceptions
 from mitmproxy import connections
 from mitmproxy import controller  # noqa
@@ -93,6 +95,10 @@ class ServerConnectionMixin:
                         self.disconnect()
     """
 
+    # Provided by the Layer this is mixed into.
+    config: "config.ProxyConfig"
+    log: typing.Callable[..., None]
+
     def __init__(self, server_address=None):
         super().__init__()
 
@@ -150,6 +156,36 @@ class ServerConnectionMixin:
 
         self.server_conn = self.__make_server_conn(address)
 
+    def borrow_from_pool(self, key) -> bool:
+        """
+        Takes an idle connection for the given pool key from the upstream
+        connection pool, if there is one. The current server connection must
+        not be connected.
+
+        Returns:
+            True, if a pooled connection is used from now on.
+        """
+        pool = self.config.connection_pool
+        conn = pool.get(key) if pool is not None else None
+        if not conn:
+            return False
+        self.log("serverconnect (pooled)", "debug", [repr(conn.address)])
+        self.server_conn = conn
+        return True
+
+    def return_to_pool(self, key):
+        """
+        Hands the current server connection over to the upstream connection
+        pool. If the pool does not accept it, the connection is closed.
+        """
+        address = self.server_conn.address
+        pool = self.config.connection_pool
+        if pool is not None and pool.put(key, self.server_conn):
+            self.log("serverdisconnect (pooled)", "debug", [repr(address)])
+            self.server_conn = self.__make_server_conn(address)
+        else:
+            self.disconnect()
+
     def connect(self):
         """
         Establishes a server connection.
@@ -50,6 +50,19 @@ class _HttpTransmissionLayer(base.Layer):
     def check_close_connection(self, f):
         raise NotImplementedError()
 
+    def server_conn_reusable(self, f):
+        """
+        Can the server connection be used for other requests after this flow?
+        """
+        return False
+
+    def multiplex_upstream(self, f):
+        """
+        Send this flow over a shared upstream connection instead of our own
+        server connection? If so, f.server_conn is set to the shared connection.
+        """
+        return False
+
 
 class ConnectServerConnection:
 
@@ -329,12 +342,16 @@ class HttpLayer(base.Layer):
                 # allow inline scripts to manipulate the client handshake
                 self.channel.ask("websocket_handshake", f)
 
+            pooled = self.use_connection_pool(f)
             if not f.response:
-                self.establish_server_connection(
-                    f.request.host,
-                    f.request.port,
-                    f.request.scheme
-                )
+                multiplexed = self.multiplex_upstream(f)
+                if not multiplexed:
+                    self.establish_server_connection(
+                        f.request.host,
+                        f.request.port,
+                        f.request.scheme,
+                        pooled
+                    )
 
                 def get_response():
                     self.send_request_headers(f.request)
@@ -398,7 +415,8 @@ class HttpLayer(base.Layer):
 
                 # no further manipulation of self.server_conn beyond this point
                 # we can safely set it as the final attribute value here.
-                f.server_conn = self.server_conn
+                if not multiplexed:
+                    f.server_conn = self.server_conn
             else:
                 # response was set by an inline script.
                 # we now need to emulate the responseheaders hook.
@@ -425,6 +443,9 @@ class HttpLayer(base.Layer):
                 self.send_response_body(f.response, chunks)
                 f.response.timestamp_end = time.time()
 
+            if pooled and self.server_conn.connected() and self.server_conn_reusable(f):
+                self.release_server_conn()
+
             if self.check_close_connection(f):
                 return False
 
@@ -482,7 +503,17 @@ class HttpLayer(base.Layer):
             self.log("Changing upstream proxy to {} (not CONNECTed)".format(repr(address)), "debug")
             self.set_server(address)
 
-    def establish_server_connection(self, host: str, port: int, scheme: str):
+    def use_connection_pool(self, f) -> bool:
+        """
+        Should the server connection for this flow be taken from and returned
+        to the upstream connection pool?
+        """
+        return (
+            self.config.connection_pool is not None and
+            f.request.http_version == "HTTP/1.1"
+        )
+
+    def establish_server_connection(self, host: str, port: int, scheme: str, pooled: bool = False):
         tls = (scheme == "https")
 
         if self.mode is HTTPMode.regular or self.mode is HTTPMode.transparent:
@@ -493,7 +524,8 @@ class HttpLayer(base.Layer):
                 self.set_server_tls(tls, address[0])
             # Establish connection is necessary.
             if not self.server_conn.connected():
-                self.connect()
+                if not (pooled and self.borrow_server_conn()):
+                    self.connect()
         else:
             if not self.server_conn.connected():
                 self.connect()
@@ -1,6 +1,11 @@
+from mitmproxy import connections
+from mitmproxy import exceptions
 from mitmproxy import http
 from mitmproxy.proxy.protocol import http as httpbase
+from mitmproxy.proxy.protocol import http2 as http2layer
+from mitmproxy.net import tls as net_tls
 from mitmproxy.net.http import http1
+from mitmproxy.net.http import status_codes
 from mitmproxy.utils import human
 
 
@@ -9,6 +14,10 @@ class Http1Layer(httpbase._HttpTransmissionLayer):
     def __init__(self, ctx, mode):
         super().__init__(ctx)
         self.mode = mode
+        # The shared HTTP/2 connection for the current flow, see multiplex_upstream.
+        self.upstream = None
+        self.upstream_stream = None
+        self.upstream_request = None
 
     def read_request_headers(self, flow):
         return http.HTTPRequest.wrap(
@@ -24,11 +33,18 @@ class Http1Layer(httpbase._HttpTransmissionLayer):
         )
 
     def send_request_headers(self, request):
+        if self.upstream:
+            self.upstream_request = request
+            self.upstream_stream = self._open_upstream_stream(request)
+            return
         headers = http1.assemble_request_head(request)
         self.server_conn.wfile.write(headers)
         self.server_conn.wfile.flush()
 
     def send_request_body(self, request, chunks):
+        if self.upstream_stream:
+            self.upstream_stream.conn.send_body(self.upstream_stream, chunks)
+            return
         for chunk in http1.assemble_body(request.headers, chunks):
             self.server_conn.wfile.write(chunk)
             self.server_conn.wfile.flush()
@@ -38,10 +54,17 @@ class Http1Layer(httpbase._HttpTransmissionLayer):
         self.server_conn.wfile.flush()
 
     def read_response_headers(self):
+        if self.upstream_stream:
+            return self._read_upstream_response_headers()
         resp = http1.read_response_head(self.server_conn.rfile)
         return http.HTTPResponse.wrap(resp)
 
     def read_response_body(self, request, response):
+        if self.upstream_stream:
+            return self.upstream_stream.conn.read_body(
+                self.upstream_stream,
+                human.parse_size(self.config.options.body_size_limit)
+            )
         expected_size = http1.expected_http_body_size(request, response)
         return http1.read_body(
             self.server_conn.rfile,
@@ -78,6 +101,161 @@ class Http1Layer(httpbase._HttpTransmissionLayer):
             return False
         return close_connection
 
+    def server_conn_reusable(self, flow):
+        return (
+            flow.request.first_line_format != "authority" and
+            flow.response.http_version == "HTTP/1.1" and
+            flow.response.status_code != 101 and
+            not http1.connection_close(flow.request.http_version, flow.request.headers) and
+            not http1.connection_close(flow.response.http_version, flow.response.headers) and
+            http1.expected_http_body_size(flow.request, flow.response) != -1 and
+            self.server_conn.get_alpn_proto_negotiated() != b"h2"
+        )
+
+    def multiplex_upstream(self, f):
+        self._release_upstream()
+        pool = self.config.multiplex_pool
+        multiplex = (
+            pool is not None and
+            self.mode in (httpbase.HTTPMode.regular, httpbase.HTTPMode.transparent) and
+            f.request.scheme == "https" and
+            f.request.http_version == "HTTP/1.1" and
+            "upgrade" not in f.request.headers and
+            not f.metadata.get("websocket") and
+            not self.server_conn.connected() and
+            not self.config.options.spoof_source_address
+        )
+        if not multiplex:
+            return False
+        address = (f.request.host, f.request.port)
+        # Same SNI as HttpLayer.establish_server_connection would use.
+        sni = self.server_sni if address == self.server_conn.address else f.request.host
+        key = (address, sni, self.config.options.client_certs)
+        if pool.unsupported(key):
+            return False
+        self.upstream = self._get_upstream(pool, key)
+        if self.upstream is None:
+            return False
+        f.server_conn = self.upstream.server_conn
+        return True
+
+    def _get_upstream(self, pool, key):
+        while True:
+            conn = pool.get(key)
+            if conn or pool.unsupported(key):
+                return conn
+            connecting = pool.begin_connect(key)
+            if connecting:
+                connecting.wait()
+                continue
+            try:
+                conn = self._connect_upstream(*key[:2])
+            except:
+                pool.end_connect(key)
+                raise
+            pool.end_connect(key, conn, unsupported=conn is None)
+            return conn
+
+    def _connect_upstream(self, address, sni):
+        """
+        Establish a new shared HTTP/2 connection.
+
+        TLS is negotiated like in TlsLayer._establish_tls_with_server, but
+        without a TlsLayer: the connection is shared by many clients, so we
+        always offer h2 and http/1.1 and do not pass through the cipher list
+        of one particular client.
+
+        Every "serverconnect" event is followed by a "serverdisconnect" event,
+        either here if the connection fails or by Http2UpstreamConnection.close.
+
+        Returns:
+            None, if the server does not support HTTP/2.
+        """
+        server_conn = connections.ServerConnection(address, (self.config.options.upstream_bind_address, 0))
+        self.log("serverconnect (HTTP/2 multiplexed)", "debug", [repr(address)])
+        self.channel.ask("serverconnect", server_conn)
+        try:
+            try:
+                server_conn.connect()
+            except exceptions.TcpException as e:
+                raise exceptions.ProtocolException(
+                    "Server connection to {} failed: {}".format(repr(address), str(e))
+                )
+            try:
+                server_conn.establish_tls(
+                    sni=sni,
+                    alpn_protos=[b"h2", b"http/1.1"],
+                    **net_tls.client_arguments_from_options(self.config.options)
+                )
+            except exceptions.InvalidCertificateException as e:
+                raise exceptions.InvalidServerCertificate(str(e))
+            except exceptions.TlsException as e:
+                raise exceptions.TlsProtocolException(
+                    "Cannot establish TLS with {host}:{port} (sni: {sni}): {e}".format(
+                        host=address[0], port=address[1], sni=sni, e=repr(e)
+                    )
+                )
+        except exceptions.ProtocolException:
+            server_conn.close()
+            self.channel.tell("serverdisconnect", server_conn)
+            raise
+        if server_conn.ssl_verification_error is not None:
+            self.log(str(server_conn.ssl_verification_error), "warn")
+            self.log("Ignoring server verification error, continuing with connection", "warn")
+        if server_conn.alpn_proto_negotiated != b"h2":
+            self.log("{} does not support HTTP/2, not multiplexing.".format(repr(address)), "debug")
+            server_conn.finish()
+            server_conn.close()
+            self.channel.tell("serverdisconnect", server_conn)
+            return None
+        conn = http2layer.Http2UpstreamConnection(server_conn, self.config.options, self.channel)
+        conn.initiate()
+        return conn
+
+    def _open_upstream_stream(self, request):
+        end_stream = not request.stream and not request.data.content
+        pool = self.config.multiplex_pool
+        while self.upstream:
+            stream = self.upstream.open_stream(request, end_stream)
+            if stream:
+                return stream
+            # All streams are taken, use (or open) another connection.
+            key = (self.upstream.server_conn.address, self.upstream.server_conn.sni, self.config.options.client_certs)
+            self.upstream = self._get_upstream(pool, key) if pool is not None else None
+        raise exceptions.Http2ProtocolException("No HTTP/2 connection to server available.")
+
+    def _read_upstream_response_headers(self):
+        stream = self.upstream_stream
+        headers = stream.conn.read_response_headers(stream)
+        status_code = int(headers.pop(":status", 502))
+        no_body = (
+            self.upstream_request.method == "HEAD" or
+            100 <= status_code < 200 or
+            status_code in (204, 304)
+        )
+        if not no_body and "content-length" not in headers:
+            # Our client speaks HTTP/1.1, so it needs to know where the body ends.
+            headers["transfer-encoding"] = "chunked"
+        return http.HTTPResponse(
+            http_version=b"HTTP/1.1",
+            status_code=status_code,
+            reason=status_codes.RESPONSES.get(status_code, "Unknown").encode(),
+            headers=headers,
+            content=None,
+            timestamp_start=stream.timestamp_start,
+            timestamp_end=stream.timestamp_end,
+        )
+
+    def _release_upstream(self):
+        if self.upstream_stream:
+            self.upstream_stream.conn.close_stream(self.upstream_stream)
+        self.upstream = None
+        self.upstream_stream = None
+        self.upstream_request = None
+
     def __call__(self):
         layer = httpbase.HttpLayer(self, self.mode)
-        layer()
+        try:
+            layer()
+        finally:
+            self._release_upstream()
@@ -1,25 +1,30 @@
 import threading
 import time
 import functools
-from typing import Dict, Callable, Any, List, Optional  # noqa
+from typing import Dict, Callable, Any, List, Optional, Tuple  # noqa
 
 import h2.exceptions
 from h2 import connection
 from h2 import events
+from h2 import settings
 import queue
 
 from mitmproxy import connections  # noqa
 from mitmproxy import exceptions
 from mitmproxy import http
+from mitmproxy.coretypes import basethread
 from mitmproxy.proxy.protocol import base
 from mitmproxy.proxy.protocol import http as httpbase
 import mitmproxy.net.http
 from mitmproxy.net import tcp
-from mitmproxy.coretypes import basethread
-from mitmproxy.net.http import http2, headers
+from mitmproxy.net.http import http2, headers, url
 from mitmproxy.utils import human
 
 
+STREAM_WORKER_IDLE_TIMEOUT = 5
+"""Seconds after which an idle stream worker thread of a connection exits."""
+
+
 class SafeH2Connection(connection.H2Connection):
 
     def __init__(self, conn, *args, **kwargs):
@@ -93,29 +98,63 @@ class Http2Layer(base.Layer):
         self.streams: Dict[int, Http2SingleStreamLayer] = dict()
         self.server_to_client_stream_ids: Dict[int, int] = dict([(0, 0)])
         self.connections: Dict[object, SafeH2Connection] = {}
+        self.max_buffered_bytes = 0
+
+        # Streams are handled by at most max_streams threads per connection,
+        # which are only kept while there are streams to handle.
+        # We advertise the same limit to the client, so that streams only wait
+        # for a thread in the short time between the end of a stream on the
+        # wire and the end of its handler.
+        max_streams = self.config.options.http2_max_concurrent_streams
+        self.stream_pool = tcp.WorkerPool(
+            "Http2SingleStreamLayer", max_streams, max_streams,
+            idle_timeout=STREAM_WORKER_IDLE_TIMEOUT
+        )
+        self.connections[self.client_conn] = self._new_connection(self.client_conn, False, max_streams)
 
+    def _new_connection(self, conn, client_side, max_streams=100):
         config = h2.config.H2Configuration(
-            client_side=False,
+            client_side=client_side,
             header_encoding=False,
             validate_outbound_headers=False,
             validate_inbound_headers=False)
-        self.connections[self.client_conn] = SafeH2Connection(self.client_conn, config=config)
+        h2_conn = SafeH2Connection(conn, config=config)
+        # Received data is only acknowledged once a stream has processed it,
+        # so the flow control windows are our buffer limits.
+        h2_conn.local_settings = settings.Settings(
+            client=client_side,
+            initial_values={
+                settings.SettingCodes.MAX_CONCURRENT_STREAMS: max_streams,
+                settings.SettingCodes.MAX_HEADER_LIST_SIZE: SafeH2Connection.DEFAULT_MAX_HEADER_LIST_SIZE,
+                settings.SettingCodes.INITIAL_WINDOW_SIZE: self.config.options.http2_stream_buffer_size,
+            }
+        )
+        return h2_conn
+
+    def _open_connection_window(self, conn):
+        increment = self.config.options.http2_connection_buffer_size - self.connections[conn].inbound_flow_control_window
+        if increment > 0:
+            self.connections[conn].increment_flow_control_window(increment)
+
+    @property
+    def buffered_bytes(self) -> int:
+        """
+        Number of received bytes that have not been processed by their stream yet.
+        """
+        return sum(s.request_buffered_bytes + s.response_buffered_bytes for s in list(self.streams.values()))
 
     def _initiate_server_conn(self):
         if self.server_conn.connected():
-            config = h2.config.H2Configuration(
-                client_side=True,
-                header_encoding=False,
-                validate_outbound_headers=False,
-                validate_inbound_headers=False)
-            self.connections[self.server_conn] = SafeH2Connection(self.server_conn, config=config)
+            self.connections[self.server_conn] = self._new_connection(self.server_conn, True)
         self.connections[self.server_conn].initiate_connection()
+        self._open_connection_window(self.server_conn)
         self.server_conn.send(self.connections[self.server_conn].data_to_send())
 
     def _complete_handshake(self):
         preamble = self.client_conn.rfile.read(24)
         self.connections[self.client_conn].initiate_connection()
         self.connections[self.client_conn].receive_data(preamble)
+        self._open_connection_window(self.client_conn)
         self.client_conn.send(self.connections[self.client_conn].data_to_send())
 
     def next_layer(self):  # pragma: no cover
@@ -171,8 +210,8 @@ class Http2Layer(base.Layer):
             self.streams[eid].priority_depends_on = event.priority_updated.depends_on
             self.streams[eid].priority_weight = event.priority_updated.weight
             self.streams[eid].handled_priority_event = event.priority_updated
-        self.streams[eid].start()
         self.streams[eid].request_arrived.set()
+        self._start_stream(self.streams[eid])
         return True
 
     def _handle_response_received(self, eid, event):
@@ -184,21 +223,37 @@ class Http2Layer(base.Layer):
         return True
 
     def _handle_data_received(self, eid, event, source_conn):
+        stream = self.streams[eid]
         bsl = human.parse_size(self.config.options.body_size_limit)
-        if bsl and self.streams[eid].queued_data_length > bsl:
-            self.streams[eid].kill()
+        if bsl and stream.queued_data_length > bsl:
+            stream.kill()
             self.connections[source_conn].safe_reset_stream(
                 event.stream_id,
                 h2.errors.ErrorCodes.REFUSED_STREAM
             )
+            self.connections[source_conn].safe_acknowledge_received_data(
+                event.flow_controlled_length,
+                event.stream_id
+            )
             self.log("HTTP body too large. Limit is {}.".format(bsl), "info")
-        else:
-            self.streams[eid].data_queue.put(event.data)
-            self.streams[eid].queued_data_length += len(event.data)
+        elif stream.zombie:
+            # Nobody is going to process this anymore.
             self.connections[source_conn].safe_acknowledge_received_data(
                 event.flow_controlled_length,
                 event.stream_id
             )
+        else:
+            # The data is acknowledged once the stream has processed it,
+            # see Http2SingleStreamLayer._dequeue.
+            item = (event.data, event.flow_controlled_length, event.stream_id)
+            if source_conn == self.server_conn:
+                stream.response_data_queue.put(item)
+                stream.response_buffered_bytes += len(event.data)
+            else:
+                stream.request_data_queue.put(item)
+                stream.request_buffered_bytes += len(event.data)
+            stream.queued_data_length += len(event.data)
+            self.max_buffered_bytes = max(self.max_buffered_bytes, self.buffered_bytes)
         return True
 
     def _handle_stream_ended(self, eid):
@@ -220,6 +275,14 @@ class Http2Layer(base.Layer):
 
     def _handle_remote_settings_changed(self, event, other_conn):
         new_settings = dict([(key, cs.new_value) for (key, cs) in event.changed_settings.items()])
+        max_streams = settings.SettingCodes.MAX_CONCURRENT_STREAMS
+        if other_conn == self.client_conn and max_streams in new_settings:
+            # Never allow more streams than our stream pool can handle.
+            new_settings[max_streams] = min(new_settings[max_streams], self.stream_pool.size)
+        window_size = settings.SettingCodes.INITIAL_WINDOW_SIZE
+        if window_size in new_settings:
+            # Never buffer more than our limit.
+            new_settings[window_size] = min(new_settings[window_size], self.config.options.http2_stream_buffer_size)
         self.connections[other_conn].safe_update_settings(new_settings)
         return True
 
@@ -264,9 +327,18 @@ class Http2Layer(base.Layer):
         self.streams[event.pushed_stream_id].timestamp_end = time.time()
         self.streams[event.pushed_stream_id].request_arrived.set()
         self.streams[event.pushed_stream_id].request_data_finished.set()
-        self.streams[event.pushed_stream_id].start()
+        self._start_stream(self.streams[event.pushed_stream_id])
         return True
 
+    def _start_stream(self, stream):
+        if not self.stream_pool.submit(stream.run):
+            self.log("HTTP/2 stream {} refused: too many concurrent streams.".format(stream.client_stream_id), "info")
+            stream.kill()
+            self.connections[self.client_conn].safe_reset_stream(
+                stream.client_stream_id,
+                h2.errors.ErrorCodes.REFUSED_STREAM
+            )
+
     def _handle_priority_updated(self, eid, event):
         if not self.config.options.http2_priority:
             self.log("HTTP/2 PRIORITY frame suppressed. Use --http2-priority to enable forwarding.", "debug")
@@ -324,6 +396,15 @@ class Http2Layer(base.Layer):
             stream.kill()
 
     def __call__(self):
+        try:
+            self._run()
+        finally:
+            self.stream_pool.shutdown()
+            self.log("HTTP/2 connection closed, max. buffered: {}".format(
+                human.pretty_size(self.max_buffered_bytes)
+            ), "debug")
+
+    def _run(self):
         self._initiate_server_conn()
         self._complete_handshake()
 
@@ -375,12 +456,14 @@ def detect_zombie_stream(func):  # pragma: no cover
     return wrapper
 
 
-class Http2SingleStreamLayer(httpbase._HttpTransmissionLayer, basethread.BaseThread):
+class Http2SingleStreamLayer(httpbase._HttpTransmissionLayer):
+    """
+    Handles a single HTTP/2 stream. Streams run on the worker pool of their
+    Http2Layer, see Http2Layer._start_stream.
+    """
 
     def __init__(self, ctx, h2_connection, stream_id: int, request_headers: mitmproxy.net.http.Headers) -> None:
-        super().__init__(
-            ctx, name="Http2SingleStreamLayer-{}".format(stream_id)
-        )
+        super().__init__(ctx)
         self.h2_connection = h2_connection
         self.zombie: Optional[float] = None
         self.client_stream_id: int = stream_id
@@ -392,14 +475,17 @@ class Http2SingleStreamLayer(httpbase._HttpTransmissionLayer, basethread.BaseThr
         self.timestamp_start: Optional[float] = None
         self.timestamp_end: Optional[float] = None
 
+        # The data queues hold (data, flow controlled length, stream id) tuples.
         self.request_arrived = threading.Event()
-        self.request_data_queue: queue.Queue[bytes] = queue.Queue()
+        self.request_data_queue: queue.Queue[Tuple[bytes, int, int]] = queue.Queue()
         self.request_queued_data_length = 0
+        self.request_buffered_bytes = 0
         self.request_data_finished = threading.Event()
 
         self.response_arrived = threading.Event()
-        self.response_data_queue: queue.Queue[bytes] = queue.Queue()
+        self.response_data_queue: queue.Queue[Tuple[bytes, int, int]] = queue.Queue()
         self.response_queued_data_length = 0
+        self.response_buffered_bytes = 0
         self.response_data_finished = threading.Event()
 
         self.no_body = False
@@ -431,13 +517,6 @@ class Http2SingleStreamLayer(httpbase._HttpTransmissionLayer, basethread.BaseThr
         # RFC 7540 8.1: An HTTP request/response exchange fully consumes a single stream.
         return True
 
-    @property
-    def data_queue(self):
-        if self.response_arrived.is_set():
-            return self.response_data_queue
-        else:
-            return self.request_data_queue
-
     @property
     def queued_data_length(self):
         if self.response_arrived.is_set():
@@ -486,23 +565,61 @@ class Http2SingleStreamLayer(httpbase._HttpTransmissionLayer, basethread.BaseThr
             timestamp_end=self.timestamp_end,
         )
 
-    @detect_zombie_stream
-    def read_request_body(self, request):
-        if not request.stream:
-            self.request_data_finished.wait()
-
+    def _dequeue(self, data_queue, conn, timeout=None) -> bytes:
+        """
+        Take a chunk of data from one of our data queues and let the peer
+        send more.
+        """
+        data, flow_controlled_length, stream_id = data_queue.get(timeout=timeout)
+        h2_conn = self.connections[conn]
+        with h2_conn.lock:
+            if conn == self.client_conn:
+                self.request_buffered_bytes -= len(data)
+            else:
+                self.response_buffered_bytes -= len(data)
+            try:
+                h2_conn.safe_acknowledge_received_data(flow_controlled_length, stream_id)
+            except exceptions.TcpException:
+                raise exceptions.Http2ZombieException("Connection already dead")
+        return data
+
+    def _read_body(self, data_queue, data_finished, conn):
+        # We do not wait for the end of the body before we read it, otherwise
+        # the sender would run out of flow control window.
         while True:
             try:
-                yield self.request_data_queue.get(timeout=0.1)
+                yield self._dequeue(data_queue, conn, timeout=0.1)
             except queue.Empty:  # pragma: no cover
                 pass
-            if self.request_data_finished.is_set():
+            if data_finished.is_set():
                 self.raise_zombie()
-                while self.request_data_queue.qsize() > 0:
-                    yield self.request_data_queue.get()
+                while data_queue.qsize() > 0:
+                    yield self._dequeue(data_queue, conn)
                 break
             self.raise_zombie()
 
+    def _release_buffers(self):
+        """
+        Acknowledge all data that has not been processed, so that the
+        connection's flow control window does not shrink for other streams.
+        Must be called after kill().
+        """
+        buffers = [(self.client_conn, self.request_data_queue), (self.server_conn, self.response_data_queue)]
+        for conn, data_queue in buffers:
+            if conn not in self.connections:  # pragma: no cover
+                continue
+            # Holding the connection lock, no more data can be queued while we drain.
+            with self.connections[conn].lock:
+                try:
+                    while data_queue.qsize() > 0:
+                        self._dequeue(data_queue, conn)
+                except exceptions.Http2ZombieException:  # pragma: no cover
+                    pass
+
+    @detect_zombie_stream
+    def read_request_body(self, request):
+        yield from self._read_body(self.request_data_queue, self.request_data_finished, self.client_conn)
+
     @detect_zombie_stream
     def send_request_headers(self, request):
         if self.pushed:
@@ -603,17 +720,7 @@ class Http2SingleStreamLayer(httpbase._HttpTransmissionLayer, basethread.BaseThr
 
     @detect_zombie_stream
     def read_response_body(self, request, response):
-        while True:
-            try:
-                yield self.response_data_queue.get(timeout=0.1)
-            except queue.Empty:  # pragma: no cover
-                pass
-            if self.response_data_finished.is_set():
-                self.raise_zombie()
-                while self.response_data_queue.qsize() > 0:
-                    yield self.response_data_queue.get()
-                break
-            self.raise_zombie()
+        yield from self._read_body(self.response_data_queue, self.response_data_finished, self.server_conn)
 
     @detect_zombie_stream
     def send_response_headers(self, response):
@@ -635,7 +742,7 @@ class Http2SingleStreamLayer(httpbase._HttpTransmissionLayer, basethread.BaseThr
         )
 
     def __call__(self):  # pragma: no cover
-        raise EnvironmentError('Http2SingleStreamLayer must be run as thread')
+        raise EnvironmentError('Http2SingleStreamLayer must be run on the stream pool')
 
     def run(self):
         layer = httpbase.HttpLayer(self, self.mode)
@@ -652,3 +759,261 @@ class Http2SingleStreamLayer(httpbase._HttpTransmissionLayer, basethread.BaseThr
             self.log("Connection killed", "info")
 
         self.kill()
+        self._release_buffers()
+
+
+# Connection-specific headers must not be sent over HTTP/2, see RFC 7540 8.1.2.2.
+CONNECTION_SPECIFIC_HEADERS = {b"connection", b"host", b"keep-alive", b"proxy-connection", b"transfer-encoding", b"upgrade"}
+
+
+class Http2UpstreamStream:
+    """
+    A request of an HTTP/1.1 client that is sent as a stream over a shared
+    Http2UpstreamConnection.
+    """
+
+    def __init__(self, conn: "Http2UpstreamConnection", stream_id: int) -> None:
+        self.conn = conn
+        self.stream_id = stream_id
+        self.request_ended = False
+        self.error: Optional[str] = None
+
+        self.response_headers: Optional[mitmproxy.net.http.Headers] = None
+        self.response_arrived = threading.Event()
+        # (data, flow controlled length) tuples
+        self.data_queue: queue.Queue[Tuple[bytes, int]] = queue.Queue()
+        self.data_finished = threading.Event()
+
+        self.timestamp_start: Optional[float] = None
+        self.timestamp_end: Optional[float] = None
+
+    def fail(self, error: str) -> None:
+        if self.error is None:
+            self.error = error
+        self.response_arrived.set()
+        self.data_finished.set()
+
+    def raise_error(self, pre_command=None):
+        if self.error is not None:
+            if pre_command is not None:
+                pre_command()
+            raise exceptions.Http2ProtocolException(self.error)
+
+
+def upstream_request_headers(request: http.HTTPRequest) -> List[Tuple[bytes, bytes]]:
+    """
+    Translate the headers of an HTTP/1.1 request to HTTP/2.
+    """
+    authority = None
+    fields = []
+    for name, value in request.headers.fields:
+        name = name.lower()
+        if name == b"host":
+            authority = authority or value
+        elif name in CONNECTION_SPECIFIC_HEADERS or (name == b"te" and value.lower() != b"trailers"):
+            continue
+        else:
+            fields.append((name, value))
+    if authority is None:
+        authority = url.hostport(request.data.scheme, request.data.host, request.port)
+    return [
+        (b":method", request.data.method),
+        (b":scheme", request.data.scheme),
+        (b":authority", authority),
+        (b":path", request.data.path),
+    ] + fields
+
+
+class Http2UpstreamConnection(basethread.BaseThread):
+    """
+    An HTTP/2 connection to a server that is shared by many HTTP/1.1 client
+    connections, see Http1Layer.multiplex_upstream. Every request is a
+    separate stream. The connection's thread reads all frames from the server
+    and dispatches them to the streams. Once the connection is closed, a
+    "serverdisconnect" event is sent on the channel.
+    """
+
+    def __init__(self, server_conn: connections.ServerConnection, options, channel) -> None:
+        super().__init__("Http2UpstreamConnection({})".format(repr(server_conn.address)))
+        self.daemon = True
+        self.server_conn = server_conn
+        self.channel = channel
+        self.idle_timeout = options.upstream_pool_idle_timeout
+        self.connection_buffer_size = options.http2_connection_buffer_size
+
+        config = h2.config.H2Configuration(
+            client_side=True,
+            header_encoding=False,
+            validate_outbound_headers=False,
+            validate_inbound_headers=False)
+        self.h2_conn = SafeH2Connection(server_conn, config=config)
+        self.h2_conn.local_settings = settings.Settings(
+            client=True,
+            initial_values={
+                settings.SettingCodes.ENABLE_PUSH: 0,
+                settings.SettingCodes.MAX_HEADER_LIST_SIZE: SafeH2Connection.DEFAULT_MAX_HEADER_LIST_SIZE,
+                settings.SettingCodes.INITIAL_WINDOW_SIZE: options.http2_stream_buffer_size,
+            }
+        )
+
+        self.streams: Dict[int, Http2UpstreamStream] = {}
+        # False once no new streams may be opened, e.g. after a GOAWAY.
+        self.accepting = True
+        self.closed = False
+        self.last_active = time.time()
+
+    def initiate(self):
+        with self.h2_conn.lock:
+            self.h2_conn.initiate_connection()
+            increment = self.connection_buffer_size - self.h2_conn.inbound_flow_control_window
+            if increment > 0:
+                self.h2_conn.increment_flow_control_window(increment)
+            self.server_conn.send(self.h2_conn.data_to_send())
+        self.start()
+
+    def available(self) -> bool:
+        with self.h2_conn.lock:
+            return (
+                self.accepting and
+                self.h2_conn.open_outbound_streams < self.h2_conn.remote_settings.max_concurrent_streams
+            )
+
+    def open_stream(self, request: http.HTTPRequest, end_stream: bool) -> Optional[Http2UpstreamStream]:
+        """
+        Send the request headers on a new stream.
+
+        Returns:
+            None, if the connection cannot take another stream.
+        """
+        with self.h2_conn.lock:
+            if not self.available():
+                return None
+            try:
+                stream = Http2UpstreamStream(self, self.h2_conn.get_next_available_stream_id())
+            except h2.exceptions.NoAvailableStreamIDError:  # pragma: no cover
+                self.accepting = False
+                return None
+            self.streams[stream.stream_id] = stream
+            self.last_active = time.time()
+            try:
+                self.h2_conn.send_headers(stream.stream_id, upstream_request_headers(request), end_stream=end_stream)
+                self.server_conn.send(self.h2_conn.data_to_send())
+            except (h2.exceptions.H2Error, exceptions.TcpException) as e:
+                self.streams.pop(stream.stream_id, None)
+                raise exceptions.Http2ProtocolException(repr(e))
+            stream.request_ended = end_stream
+            return stream
+
+    def send_body(self, stream: Http2UpstreamStream, chunks):
+        if stream.request_ended:
+            return
+        try:
+            self.h2_conn.safe_send_body(stream.raise_error, stream.stream_id, chunks)
+        except (h2.exceptions.H2Error, exceptions.TcpException) as e:
+            raise exceptions.Http2ProtocolException(repr(e))
+        stream.request_ended = True
+
+    def read_response_headers(self, stream):
+        stream.response_arrived.wait()
+        stream.raise_error()
+        return stream.response_headers.copy()
+
+    def read_body(self, stream: Http2UpstreamStream, limit: Optional[int] = None):
+        received = 0
+        while True:
+            try:
+                data, flow_controlled_length = stream.data_queue.get(timeout=0.1)
+            except queue.Empty:
+                if stream.data_finished.is_set() and stream.data_queue.empty():
+                    break
+                continue
+            try:
+                self.h2_conn.safe_acknowledge_received_data(flow_controlled_length, stream.stream_id)
+            except exceptions.TcpException as e:
+                raise exceptions.Http2ProtocolException(repr(e))
+            received += len(data)
+            if limit is not None and received > limit:
+                raise exceptions.HttpException("HTTP Body too large. Limit is {}.".format(limit))
+            yield data
+        stream.raise_error()
+
+    def close_stream(self, stream: Http2UpstreamStream) -> None:
+        """
+        Release a stream once its flow is done. An unfinished stream is
+        cancelled, and data that has not been read is acknowledged.
+        """
+        with self.h2_conn.lock:
+            self.last_active = time.time()
+            if self.streams.pop(stream.stream_id, None) is not None and not self.closed:
+                try:
+                    self.h2_conn.safe_reset_stream(stream.stream_id, h2.errors.ErrorCodes.CANCEL)
+                except exceptions.TcpException:  # pragma: no cover
+                    pass
+            stream.fail("Stream closed")
+            while not stream.data_queue.empty():
+                _, flow_controlled_length = stream.data_queue.get()
+                try:
+                    self.h2_conn.safe_acknowledge_received_data(flow_controlled_length, stream.stream_id)
+                except exceptions.TcpException:  # pragma: no cover
+                    break
+
+    def close(self, error: str = "Connection closed") -> None:
+        with self.h2_conn.lock:
+            if self.closed:
+                return
+            self.accepting = False
+            self.closed = True
+            for stream in self.streams.values():
+                stream.fail(error)
+            self.streams.clear()
+        self.server_conn.finish()
+        self.server_conn.close()
+        self.channel.tell("serverdisconnect", self.server_conn)
+
+    def _handle_event(self, event):
+        stream = self.streams.get(getattr(event, "stream_id", 0))
+        if isinstance(event, events.ResponseReceived) and stream:
+            stream.timestamp_start = time.time()
+            stream.response_headers = mitmproxy.net.http.Headers([[k, v] for k, v in event.headers])
+            stream.response_arrived.set()
+        elif isinstance(event, events.DataReceived):
+            if stream:
+                stream.data_queue.put((event.data, event.flow_controlled_length))
+            else:
+                self.h2_conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, events.StreamEnded) and stream:
+            self.streams.pop(event.stream_id)
+            stream.timestamp_end = time.time()
+            stream.data_finished.set()
+        elif isinstance(event, events.StreamReset) and stream:
+            self.streams.pop(event.stream_id)
+            stream.fail("Stream reset by server, error code {}.".format(event.error_code))
+        elif isinstance(event, events.ConnectionTerminated):
+            # Streams up to last_stream_id are still processed by the server.
+            self.accepting = False
+            for stream_id in [i for i in self.streams if i > event.last_stream_id]:
+                self.streams.pop(stream_id).fail("Connection terminated by server, error code {}.".format(event.error_code))
+
+    def run(self):
+        error = "Connection closed"
+        try:
+            while True:
+                with self.h2_conn.lock:
+                    if self.closed or not (self.accepting or self.streams):
+                        break
+                    if not self.streams and time.time() - self.last_active > self.idle_timeout:
+                        self.accepting = False
+                        self.h2_conn.close_connection()
+                        self.server_conn.send(self.h2_conn.data_to_send())
+                        break
+                if not tcp.ssl_read_select([self.server_conn.connection], 0.1):
+                    continue
+                with self.h2_conn.lock:
+                    raw_frame = b''.join(http2.read_raw_frame(self.server_conn.rfile))
+                    for event in self.h2_conn.receive_data(raw_frame):
+                        self._handle_event(event)
+                    self.server_conn.send(self.h2_conn.data_to_send())
+        except Exception as e:
+            error = "HTTP/2 connection to server failed: {}".format(repr(e))
+        finally:
+            self.close(error)
@@ -1,3 +1,5 @@
+import os
+import select
 import socket
 
 from OpenSSL import SSL
@@ -9,8 +11,53 @@ from mitmproxy import exceptions
 from mitmproxy.proxy.protocol import base
 
 
+def can_splice(*conns) -> bool:
+    """
+    Can data between these connections be moved with os.splice (Linux only)?
+    """
+    return hasattr(os, "splice") and not any(isinstance(c, SSL.Connection) for c in conns)
+
+
+def forward(src, dst, buf: memoryview) -> int:
+    """
+    Reads one chunk from src and writes it to dst.
+
+    Returns:
+        The number of bytes forwarded, 0 if src has been closed.
+    """
+    size = src.recv_into(buf, len(buf))
+    if size:
+        if isinstance(dst, SSL.Connection):
+            dst.sendall(buf[:size].tobytes())
+        else:
+            dst.sendall(buf[:size])
+    return size
+
+
+def splice(src, dst, pipe, size: int) -> int:
+    """
+    Like forward(), but moves the data through a pipe in the kernel.
+    src must be ready for reading.
+    """
+    r, w = pipe
+    try:
+        n = os.splice(src.fileno(), w, size, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)  # type: ignore
+    except BlockingIOError:
+        return -1
+    sent = 0
+    while sent < n:
+        try:
+            sent += os.splice(r, dst.fileno(), n - sent, flags=os.SPLICE_F_MOVE)  # type: ignore
+        except BlockingIOError:
+            # Sockets with a timeout are non-blocking on the OS level.
+            if not select.select([], [dst], [], dst.gettimeout())[1]:
+                raise exceptions.TcpTimeout()
+    return n
+
+
 class RawTCPLayer(base.Layer):
     chunk_size = 4096
+    passthrough_chunk_size = 65536
 
     def __init__(self, ctx, ignore=False):
         self.ignore = ignore
@@ -19,9 +66,11 @@ class RawTCPLayer(base.Layer):
     def __call__(self):
         self.connect()
 
-        if not self.ignore:
-            f = tcp.TCPFlow(self.client_conn, self.server_conn, self)
-            self.channel.ask("tcp_start", f)
+        if self.ignore:
+            return self.passthrough()
+
+        f = tcp.TCPFlow(self.client_conn, self.server_conn, self)
+        self.channel.ask("tcp_start", f)
 
         buf = memoryview(bytearray(self.chunk_size))
 
@@ -51,15 +100,58 @@ class RawTCPLayer(base.Layer):
                         continue
 
                     tcp_message = tcp.TCPMessage(dst == server, buf[:size].tobytes())
-                    if not self.ignore:
-                        f.messages.append(tcp_message)
-                        self.channel.ask("tcp_message", f)
+                    f.messages.append(tcp_message)
+                    self.channel.ask("tcp_message", f)
                     dst.sendall(tcp_message.content)
 
         except (socket.error, exceptions.TcpException, SSL.Error) as e:
-            if not self.ignore:
-                f.error = flow.Error("TCP connection closed unexpectedly: {}".format(repr(e)))
-                self.channel.tell("tcp_error", f)
+            f.error = flow.Error("TCP connection closed unexpectedly: {}".format(repr(e)))
+            self.channel.tell("tcp_error", f)
+        finally:
+            self.channel.tell("tcp_end", f)
+
+    def passthrough(self):
+        """
+        Forward an ignored connection without looking at the data.
+        Plain sockets are spliced on Linux, so that the data never enters Python.
+        Otherwise, we use a large buffer that is reused for all chunks.
+        """
+        client = self.client_conn.connection
+        server = self.server_conn.connection
+        conns = [client, server]
+        received = {client: 0, server: 0}
+
+        pipes = {}
+        if can_splice(client, server):
+            pipes = {client: os.pipe(), server: os.pipe()}
+        buf = memoryview(bytearray(self.passthrough_chunk_size))
+
+        try:
+            while conns and not self.channel.should_exit.is_set():
+                r = mitmproxy.net.tcp.ssl_read_select(conns, 10)
+                for conn in r:
+                    dst = server if conn == client else client
+
+                    if pipes:
+                        size = splice(conn, dst, pipes[conn], self.passthrough_chunk_size)
+                    else:
+                        size = forward(conn, dst, buf)
+                    if size > 0:
+                        received[conn] += size
+                    elif size == 0:
+                        conns.remove(conn)
+                        if isinstance(conn, SSL.Connection):
+                            return
+                        dst.shutdown(socket.SHUT_WR)
+        except (socket.error, exceptions.TcpException, SSL.Error) as e:
+            self.log("Passthrough connection closed unexpectedly: {}".format(repr(e)), "debug")
         finally:
-            if not self.ignore:
-                self.channel.tell("tcp_end", f)
+            for r, w in pipes.values():
+                os.close(r)
+                os.close(w)
+            self.log(
+                "Passthrough: {} bytes from client, {} bytes from server{}".format(
+                    received[client], received[server], " (spliced)" if pipes else ""
+                ),
+                "debug"
+            )
@@ -1,4 +1,4 @@
-from typing import Optional  # noqa
+from typing import List, Optional  # noqa
 from typing import Union
 
 from mitmproxy import exceptions
@@ -239,7 +239,7 @@ class TlsLayer(base.Layer):
         if self._client_tls:
             # Peek into the connection, read the initial client hello and parse it to obtain SNI and ALPN values.
             try:
-                self._client_hello = net_tls.ClientHello.from_file(self.client_conn.rfile)
+                self._client_hello = self.client_conn.get_client_hello()
             except exceptions.TlsProtocolException as e:
                 self.log("Cannot parse Client Hello: %s" % repr(e), "error")
                 # Without knowning the ClientHello we cannot proceed in this connection.
@@ -258,13 +258,16 @@ class TlsLayer(base.Layer):
         #  2.4 The client wants to negotiate an alternative protocol in its handshake, we need to find out
         #      what is supported by the server
         #  2.5 The client did not sent a SNI value, we don't know the certificate subject.
+        #
+        # If HTTP/1.1 clients are multiplexed over shared HTTP/2 connections, an HTTP/1.1-only
+        # client does not need to know what the server supports (2.4).
         client_tls_requires_server_connection = (
             self._server_tls and
             self.config.options.upstream_cert and
             (
                 self.config.options.add_upstream_certs_to_client_chain or
                 self._client_tls and (
-                    self._client_hello.alpn_protocols or
+                    (self._client_hello.alpn_protocols and not self._multiplexed_alpn()) or
                     not self._client_hello.sni
                 )
             )
@@ -354,8 +357,14 @@ class TlsLayer(base.Layer):
 
     def _establish_tls_with_client_and_server(self):
         try:
-            self.ctx.connect()
-            self._establish_tls_with_server()
+            pooled = (
+                self.config.connection_pool is not None and
+                not self.server_conn.connected() and
+                self.borrow_server_conn()
+            )
+            if not pooled:
+                self.ctx.connect()
+                self._establish_tls_with_server()
         except Exception:
             # If establishing TLS with the server fails, we try to establish TLS with the client nonetheless
             # to send an error message over TLS.
@@ -369,7 +378,7 @@ class TlsLayer(base.Layer):
 
     def _establish_tls_with_client(self):
         self.log("Establish TLS with client", "debug")
-        cert, key, chain_file = self._find_cert()
+        entry = self._find_cert()
 
         if self.config.options.add_upstream_certs_to_client_chain:
             extra_certs = self.server_conn.server_certs
@@ -379,14 +388,16 @@ class TlsLayer(base.Layer):
         try:
             tls_method, tls_options = net_tls.VERSION_CHOICES[self.config.options.ssl_version_client]
             self.client_conn.convert_to_tls(
-                cert, key,
+                entry.cert, entry.privatekey,
+                contexts=entry.contexts,
                 method=tls_method,
                 options=tls_options,
                 cipher_list=self.config.options.ciphers_client or DEFAULT_CLIENT_CIPHERS,
                 dhparams=self.config.certstore.dhparams,
-                chain_file=chain_file,
+                chain_file=entry.chain_file,
                 alpn_select_callback=self.__alpn_select_callback,
                 extra_chain_certs=extra_certs,
+                session_timeout=self.config.options.tls_session_timeout_client,
             )
             # Some TLS clients will not fail the handshake,
             # but will immediately throw an "unexpected eof" error on the first read.
@@ -402,32 +413,90 @@ class TlsLayer(base.Layer):
                 sni_str or repr(self.server_conn.address)
             )
 
+    def _multiplexed_alpn(self):
+        """
+        Will we speak HTTP/1.1 with the client and send its requests over a shared HTTP/2 connection?
+        """
+        return (
+            self.config.multiplex_pool is not None and
+            all(p.startswith(b"http/1.") for p in self._client_hello.alpn_protocols)
+        )
+
+    def _server_alpn(self) -> Optional[List[bytes]]:
+        """
+        The ALPN protocols we offer in the next server TLS handshake.
+        """
+        alpn: Optional[List[bytes]] = None
+        if self._client_tls and self._client_hello:
+            if self._client_hello.alpn_protocols:
+                # We only support http/1.1 and h2.
+                # If the server only supports spdy (next to http/1.1), it may select that
+                # and mitmproxy would enter TCP passthrough mode, which we want to avoid.
+                alpn = [
+                    x for x in self._client_hello.alpn_protocols if
+                    not (x.startswith(b"h2-") or x.startswith(b"spdy"))
+                ]
+            if alpn and b"h2" in alpn and not self.config.options.http2:
+                alpn.remove(b"h2")
+
+        if self.client_conn.tls_established and self.client_conn.get_alpn_proto_negotiated():
+            # If the client has already negotiated an ALP, then force the
+            # server to use the same. This can only happen if the host gets
+            # changed after the initial connection was established. E.g.:
+            #   * the client offers http/1.1 and h2,
+            #   * the initial host is only capable of http/1.1,
+            #   * then the first server connection negotiates http/1.1,
+            #   * but after the server_conn change, the new host offers h2
+            #   * which results in garbage because the layers don' match.
+            alpn = [self.client_conn.get_alpn_proto_negotiated()]
+        return alpn
+
+    def _server_pool_key(self, alpn: Optional[bytes]):
+        """
+        Upstream connection pool key: (address, tls, sni, alpn, client certificates)
+        """
+        if not self._server_tls:
+            return (self.server_conn.address, False, None, None, None)
+        return (
+            self.server_conn.address,
+            True,
+            self.server_sni,
+            alpn,
+            self.config.options.client_certs,
+        )
+
+    def borrow_server_conn(self) -> bool:
+        """
+        Continue with an idle connection from the upstream connection pool
+        that matches our TLS settings instead of establishing a new one.
+
+        Returns:
+            True, if a pooled connection is used from now on.
+        """
+        if not self._server_tls:
+            return self.borrow_from_pool(self._server_pool_key(None))
+        offered = self._server_alpn()
+        if offered is None:
+            candidates: List[Optional[bytes]] = [None]
+        elif b"http/1.1" in offered and b"h2" not in offered:
+            # Pooled connections speak HTTP/1.1. If the client could use h2,
+            # we let the server decide on a new connection.
+            candidates = [b"http/1.1", None]
+        else:
+            return False
+        return any(self.borrow_from_pool(self._server_pool_key(alpn)) for alpn in candidates)
+
+    def release_server_conn(self) -> None:
+        """
+        Hand the current server connection over to the upstream connection pool.
+        """
+        alpn = self.server_conn.get_alpn_proto_negotiated() or None
+        self.return_to_pool(self._server_pool_key(alpn))
+
     def _establish_tls_with_server(self):
         self.log("Establish TLS with server", "debug")
         try:
-            alpn = None
-            if self._client_tls:
-                if self._client_hello.alpn_protocols:
-                    # We only support http/1.1 and h2.
-                    # If the server only supports spdy (next to http/1.1), it may select that
-                    # and mitmproxy would enter TCP passthrough mode, which we want to avoid.
-                    alpn = [
-                        x for x in self._client_hello.alpn_protocols if
-                        not (x.startswith(b"h2-") or x.startswith(b"spdy"))
-                    ]
-                if alpn and b"h2" in alpn and not self.config.options.http2:
-                    alpn.remove(b"h2")
-
-            if self.client_conn.tls_established and self.client_conn.get_alpn_proto_negotiated():
-                # If the client has already negotiated an ALP, then force the
-                # server to use the same. This can only happen if the host gets
-                # changed after the initial connection was established. E.g.:
-                #   * the client offers http/1.1 and h2,
-                #   * the initial host is only capable of http/1.1,
-                #   * then the first server connection negotiates http/1.1,
-                #   * but after the server_conn change, the new host offers h2
-                #   * which results in garbage because the layers don' match.
-                alpn = [self.client_conn.get_alpn_proto_negotiated()]
+            alpn = self._server_alpn()
 
             # We pass through the list of ciphers send by the client, because some HTTP/2 servers
             # will select a non-HTTP/2 compatible cipher from our default list and then hang up
@@ -470,6 +539,9 @@ class TlsLayer(base.Layer):
         """
         This function determines the Common Name (CN), Subject Alternative Names (SANs) and Organization Name
         our certificate should have and then fetches a matching cert from the certstore.
+
+        Returns:
+            A certs.CertStoreEntry
         """
         host = None
         sans = set()
@@ -505,4 +577,18 @@ class TlsLayer(base.Layer):
         # In other words, the Common Name is irrelevant then.
         if host:
             sans.add(host)
-        return self.config.certstore.get_cert(host, list(sans), organization)
+
+        certstore = self.config.certstore
+        entry = certstore.find_entry(host, list(sans))
+        if entry:
+            return entry
+        # Before generating a new certificate, use one that was generated ahead of
+        # time for the name the client verifies (see the certpregen addon).
+        client_name = self._client_hello.sni
+        if not client_name and self.server_conn.address:
+            client_name = self.server_conn.address[0].encode("idna")
+        if client_name:
+            entry = certstore.get_generated(client_name)
+            if entry:
+                return entry
+        return certstore.get_entry(host, list(sans), organization)
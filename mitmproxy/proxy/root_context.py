@@ -53,12 +53,15 @@ class RootContext:
             is_filtered = self.config.check_filter(top_layer.server_conn.address)
             if not is_filtered and client_tls:
                 try:
-                    client_hello = tls.ClientHello.from_file(self.client_conn.rfile)
+                    client_hello = self.client_conn.get_client_hello()
                 except exceptions.TlsProtocolException as e:
                     self.log("Cannot parse Client Hello: %s" % repr(e), "error")
                 else:
                     sni_str = client_hello.sni and client_hello.sni.decode("idna")
                     is_filtered = self.config.check_filter((sni_str, 443))
+                    if is_filtered:
+                        # We never establish TLS with the client, but addons may want to know.
+                        self.client_conn.sni = sni_str
             if is_filtered:
                 return protocol.RawTCPLayer(top_layer, ignore=True)
 
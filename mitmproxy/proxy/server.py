@@ -1,5 +1,6 @@
 import sys
 import traceback
+import typing
 
 from mitmproxy import exceptions
 from mitmproxy import connections
@@ -37,17 +38,35 @@ class ProxyServer(tcp.TCPServer):
     bound = True
     channel: controller.Channel
 
-    def __init__(self, config: config.ProxyConfig) -> None:
+    def __init__(
+        self,
+        config: config.ProxyConfig,
+        listen_port: typing.Optional[int] = None,
+        reuse_port: bool = False,
+    ) -> None:
         """
             Raises ServerException if there's a startup problem.
+
+            listen_port overrides the listen_port option, reuse_port binds
+            with SO_REUSEPORT so that several servers can share the address.
         """
         self.config = config
+        self.pool: typing.Optional[tcp.WorkerPool] = None
+        if listen_port is None:
+            listen_port = config.options.listen_port
         try:
             super().__init__(
-                (config.options.listen_host, config.options.listen_port)
+                (config.options.listen_host, listen_port),
+                reuse_port=reuse_port,
             )
             if config.options.mode == "transparent":
                 platform.init_transparent_mode()
+            if config.options.connection_workers > 0:
+                self.pool = tcp.WorkerPool(
+                    "ProxyServer",
+                    config.options.connection_workers,
+                    config.options.connection_backlog,
+                )
         except Exception as e:
             if self.socket:
                 self.socket.close()
@@ -58,6 +77,62 @@ class ProxyServer(tcp.TCPServer):
     def set_channel(self, channel):
         self.channel = channel
 
+    def serve_forever(self, poll_interval=0.1):
+        if self.config.options.async_accept:
+            super().serve_forever_async(poll_interval)
+        else:
+            super().serve_forever(poll_interval)
+
+    def can_process(self):
+        # With the "queue" policy, we stop taking connections while the pool is saturated.
+        return (
+            not self.pool or
+            self.config.options.connection_overload != "queue" or
+            not self.pool.saturated
+        )
+
+    def process_connection(self, connection, client_address):
+        if not self.pool:
+            return super().process_connection(connection, client_address)
+        policy = self.config.options.connection_overload
+        if not self.pool.submit(self.connection_thread, connection, client_address):
+            self.handle_overload(connection, client_address, policy)
+
+    def handle_overload(self, connection, client_address, policy):
+        """
+            Called for connections that cannot be admitted because all
+            connection workers are busy and the backlog is full.
+        """
+        self.channel.tell("log", log.LogEntry(
+            "{}: Connection workers saturated ({} active, {} queued), {} connection.".format(
+                human.format_address(client_address),
+                self.pool.active_workers,
+                self.pool.queue_depth,
+                "rejecting" if policy == "reject" else "resetting",
+            ),
+            "info"
+        ))
+        if policy == "reject":
+            try:
+                connection.settimeout(1)
+                error_response = http.make_error_response(503, "Proxy overloaded, please try again later.")
+                connection.sendall(http1.assemble_response(error_response))
+            except OSError:
+                pass
+            tcp.close_socket(connection)
+        else:
+            tcp.reset_socket(connection)
+
+    def shutdown(self):
+        if self.pool:
+            self.pool.shutdown()
+        if self.config.connection_pool is not None:
+            self.config.connection_pool.clear()
+        if self.config.multiplex_pool is not None:
+            self.config.multiplex_pool.clear()
+        self.config.certstore.shutdown()
+        super().shutdown()
+
     def handle_client_connection(self, conn, client_address):
         h = ConnectionHandler(
             conn,
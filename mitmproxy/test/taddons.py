@@ -19,6 +19,9 @@ class TestAddons(addonmanager.AddonManager):
             self.master.logs.append(args[0])
         super().trigger(event, *args, **kwargs)
 
+    def handles(self, event, message):
+        return event == "log" or super().handles(event, message)
+
 
 class RecordingMaster(mitmproxy.master.Master):
     def __init__(self, *args, **kwargs):
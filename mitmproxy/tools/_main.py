@@ -11,6 +11,7 @@ import signal
 import typing
 
 from mitmproxy.tools import cmdline
+from mitmproxy.tools import workers
 from mitmproxy import exceptions, master
 from mitmproxy import options
 from mitmproxy import optmanager
@@ -95,7 +96,10 @@ def run(
         server: typing.Any = None
         if pconf.options.server:
             try:
-                server = proxy.server.ProxyServer(pconf)
+                if pconf.options.workers > 1:
+                    server = workers.WorkerServer(pconf)
+                else:
+                    server = proxy.server.ProxyServer(pconf)
             except exceptions.ServerException as v:
                 print(str(v), file=sys.stderr)
                 sys.exit(1)
@@ -111,6 +115,8 @@ def run(
             sys.exit(0)
         if extra:
             opts.update(**extra(args))
+        if isinstance(server, workers.WorkerServer):
+            server.spawn(master)
 
         loop = asyncio.get_event_loop()
         for signame in ('SIGINT', 'SIGTERM'):
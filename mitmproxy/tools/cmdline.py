@@ -110,6 +110,7 @@ def mitmdump(opts):
 
     common_options(parser, opts)
     opts.make_parser(parser, "flow_detail", metavar = "LEVEL")
+    opts.make_parser(parser, "workers", metavar = "N")
     parser.add_argument(
         'filter_args',
         nargs="...",
@@ -0,0 +1,252 @@
+"""
+    Multi-process mode for mitmdump.
+
+    With --workers N, the proxy binds N listening sockets to the same address
+    using SO_REUSEPORT and forks one worker process per socket. Each worker
+    runs its own event loop and the full addon chain, so the kernel spreads
+    client connections across CPU cores. All workers use the CA and
+    certificate options of the parent, which are loaded before forking.
+
+    Output addons (dumper, save, ...) only run in the master process: workers
+    stream every finished flow back over a socket pair, and the master feeds
+    the merged stream to its addons just like flows read from a file.
+"""
+import asyncio
+import concurrent.futures
+import os
+import signal
+import socket
+import sys
+import time
+import typing
+
+from mitmproxy import controller
+from mitmproxy import exceptions
+from mitmproxy import io
+from mitmproxy import log
+from mitmproxy.addons import core
+from mitmproxy.addons import dumper
+from mitmproxy.addons import keepserving
+from mitmproxy.addons import readfile
+from mitmproxy.addons import save
+from mitmproxy.addons import termlog
+from mitmproxy.addons import termstatus
+from mitmproxy.coretypes import basethread
+from mitmproxy.proxy import config as proxy_config
+from mitmproxy.proxy import server as proxy_server
+from mitmproxy.tools import dump
+
+SINKS = (
+    dumper.Dumper,
+    save.Save,
+    termstatus.TermStatus,
+    keepserving.KeepServing,
+    readfile.ReadFile,
+    dump.ErrorCheck,
+)
+"""Addons that only consume finished flows. They run in the master process."""
+
+SHARED = (
+    core.Core,
+    termlog.TermLog,
+)
+"""Addons that run in both the master and the worker processes."""
+
+
+def is_supported() -> bool:
+    return hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")
+
+
+class FlowForwarder:
+    """
+        Runs in a worker process and writes every finished flow to the master.
+    """
+    def __init__(self, fo):
+        self.writer = io.FlowWriter(fo)
+
+    def add(self, f):
+        self.writer.add(f)
+        self.writer.fo.flush()
+
+    def response(self, f):
+        self.add(f)
+
+    def error(self, f):
+        if not f.response:
+            self.add(f)
+
+    def tcp_end(self, f):
+        self.add(f)
+
+    def websocket_end(self, f):
+        self.add(f)
+
+
+class FlowCollector(basethread.BaseThread):
+    """
+        Runs in the master process and replays the flows of one worker to the
+        master's addons.
+    """
+    def __init__(self, channel: controller.Channel, pid: int, fo) -> None:
+        super().__init__("FlowCollector (worker {})".format(pid))
+        self.daemon = True
+        self.channel = channel
+        self.pid = pid
+        self.fo = fo
+
+    def load(self, f):
+        fut = asyncio.run_coroutine_threadsafe(
+            self.channel.master.load_flow(f),
+            self.channel.loop,
+        )
+        while not self.channel.should_exit.is_set():
+            try:
+                return fut.result(0.1)
+            except concurrent.futures.TimeoutError:
+                pass
+
+    def run(self):
+        try:
+            for f in io.FlowReader(self.fo).stream():
+                self.load(f)
+        except (exceptions.FlowReadException, OSError) as e:
+            self.channel.tell("log", log.LogEntry(
+                "Worker process {}: {}".format(self.pid, e), "error"
+            ))
+        finally:
+            self.fo.close()
+        if not self.channel.should_exit.is_set():
+            self.channel.tell("log", log.LogEntry(
+                "Worker process {} exited.".format(self.pid), "warn"
+            ))
+
+
+class WorkerServer:
+    """
+        Takes the place of the proxy server in the master process. It owns
+        the listening sockets until they are handed over to the workers in
+        spawn(), and collects the flow streams of all workers afterwards.
+
+        Raises ServerException if there's a startup problem.
+    """
+    bound = True
+
+    def __init__(self, config: proxy_config.ProxyConfig) -> None:
+        if not is_supported():
+            raise exceptions.ServerException(
+                "Multiple workers are not supported on this platform."
+            )
+        self.config = config
+        self.channel: typing.Optional[controller.Channel] = None
+        self.servers: typing.List[proxy_server.ProxyServer] = []
+        self.workers: typing.List[typing.Tuple[int, typing.Any]] = []
+        try:
+            # Bind all sockets before forking, so that no connection is lost
+            # and an ephemeral listen port is shared by all workers.
+            self.servers.append(proxy_server.ProxyServer(config, reuse_port=True))
+            for _ in range(config.options.workers - 1):
+                self.servers.append(proxy_server.ProxyServer(
+                    config,
+                    listen_port=self.servers[0].address[1],
+                    reuse_port=True,
+                ))
+        except exceptions.ServerException:
+            self.close_sockets()
+            raise
+        self.address = self.servers[0].address
+
+    def close_sockets(self, keep=None):
+        for s in self.servers:
+            if s is not keep:
+                s.socket.close()
+
+    def set_channel(self, channel):
+        self.channel = channel
+
+    def spawn(self, m) -> None:
+        """
+            Fork one worker process per listening socket. Afterwards, the
+            master only keeps the addons that consume finished flows.
+        """
+        if not isinstance(m, dump.DumpMaster):
+            raise exceptions.OptionsError("Multiple workers are only supported by mitmdump.")
+        if m.options.client_replay:
+            raise exceptions.OptionsError("Client replay is not supported with multiple workers.")
+        for s in self.servers:
+            master_end, worker_end = socket.socketpair()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:  # pragma: no cover
+                master_end.close()
+                for _, fo in self.workers:
+                    fo.close()
+                self.close_sockets(keep=s)
+                code = 0
+                try:
+                    run_worker(m, s, worker_end.makefile("wb"))
+                except Exception as e:
+                    # The worker's TermLog writes this to stderr.
+                    m.addons.trigger("log", log.LogEntry(
+                        "Worker process {}: {!r}".format(os.getpid(), e), "error"
+                    ))
+                    code = 1
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(code)
+            worker_end.close()
+            self.workers.append((pid, master_end.makefile("rb")))
+            master_end.close()
+        self.close_sockets()
+        for a in list(m.addons.chain):
+            if not isinstance(a, SINKS + SHARED):
+                m.addons.remove(a)
+
+    def serve_forever(self):
+        collectors = [FlowCollector(self.channel, pid, fo) for pid, fo in self.workers]
+        for c in collectors:
+            c.start()
+        for c in collectors:
+            c.join()
+
+    def shutdown(self, timeout=5):
+        for pid, _ in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:  # pragma: no cover
+                pass
+        deadline = time.time() + timeout
+        pending = [pid for pid, _ in self.workers]
+        while pending:
+            for pid in list(pending):
+                try:
+                    done, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:  # pragma: no cover
+                    done = pid
+                if done:
+                    pending.remove(pid)
+            if pending and time.time() > deadline:  # pragma: no cover
+                for pid in pending:
+                    os.kill(pid, signal.SIGKILL)
+                deadline = float("inf")
+            if pending:
+                time.sleep(0.05)
+
+
+def run_worker(m, server: proxy_server.ProxyServer, fo) -> None:  # pragma: no cover
+    """
+        Entry point of a forked worker process: give the inherited master a
+        fresh event loop, drop its output addons and serve the socket.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    m.channel = controller.Channel(m, loop, m.should_exit)
+    m.server = server
+    for a in list(m.addons.chain):
+        if isinstance(a, SINKS):
+            m.addons.remove(a)
+    m.addons.add(FlowForwarder(fo))
+    for signame in ('SIGINT', 'SIGTERM'):
+        loop.add_signal_handler(getattr(signal, signame), m.shutdown)
+    m.run()
@@ -0,0 +1,46 @@
+import bisect
+import threading
+import typing
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+"""Default bucket bounds in seconds."""
+
+
+class Histogram:
+    """
+        Counts observations in buckets with fixed upper bounds, plus one
+        bucket for everything above the largest bound. This class is
+        thread-safe.
+    """
+    def __init__(self, bounds: typing.Sequence[float] = LATENCY_BUCKETS) -> None:
+        self.lock = threading.Lock()
+        self.bounds = tuple(sorted(bounds))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def buckets(self) -> typing.List[typing.Tuple[float, int]]:
+        """
+            Returns a list of (upper bound, count) tuples. The last bound is
+            infinity.
+        """
+        with self.lock:
+            return list(zip(self.bounds + (float("inf"),), self.counts))
+
+    def __str__(self):
+        return ", ".join(
+            "<={}: {}".format(bound, count)
+            for bound, count in self.buckets()
+            if count
+        ) or "empty"
@@ -0,0 +1,75 @@
+import io
+import timeit
+import typing
+
+from kaitaistruct import KaitaiStream
+
+from mitmproxy import ctx
+from mitmproxy.contrib.kaitaistruct import tls_client_hello
+from mitmproxy.net import tls
+
+DATA = bytes.fromhex(
+    "03033b70638d2523e1cba15f8364868295305e9c52aceabda4b5147210abc783e6e1000022c02bc02fc02cc030"
+    "cca9cca8cc14cc13c009c013c00ac014009c009d002f0035000a0100006cff0100010000000010000e00000b65"
+    "78616d706c652e636f6d0017000000230000000d00120010060106030501050304010403020102030005000501"
+    "00000000001200000010000e000c02683208687474702f312e3175500000000b00020100000a00080006001d00"
+    "170018"
+)
+
+
+def kaitai():
+    return tls_client_hello.TlsClientHello(KaitaiStream(io.BytesIO(DATA)))
+
+
+def struct():
+    c = tls.ClientHello(DATA)
+    return c.sni, c.alpn_protocols
+
+
+class ClientHelloTester:
+
+    """
+    Compare the ClientHello parser in mitmproxy.net.tls with
+    the generated Kaitai Struct parser that it replaced.
+    """
+
+    def __init__(self):
+        self.done = False
+
+    def load(self, loader):
+        loader.add_option(
+            "clienthello_parses",
+            int,
+            20000,
+            "Number of parses per measurement"
+        )
+        loader.add_option(
+            "benchmark_save_path",
+            typing.Optional[str],
+            None,
+            "Destination for the stats result file"
+        )
+
+    def running(self):
+        if self.done:
+            return
+        self.done = True
+        ctx.log("<== ClientHello Benchmark Enabled ==>")
+        number = ctx.options.clienthello_parses
+        results = []
+        for f in (kaitai, struct):
+            t = min(timeit.repeat(f, number=number, repeat=5))
+            results.append(f"{f.__name__}: {t / number * 1e6:.2f} us/parse")
+        for r in results:
+            ctx.log(r)
+        if ctx.options.benchmark_save_path:
+            ctx.log(f"Storing results to {ctx.options.benchmark_save_path}")
+            with open(ctx.options.benchmark_save_path, "w") as out:
+                out.write("\n".join(results) + "\n")
+        ctx.log("<== Benchmark Ended. Shutting down... ==>")
+        ctx.master.shutdown()
+
+
+addons = [
+    ClientHelloTester()
+]
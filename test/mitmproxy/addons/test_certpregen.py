@@ -0,0 +1,141 @@
+from unittest import mock
+
+import pytest
+
+from mitmproxy import certs
+from mitmproxy import exceptions
+from mitmproxy import io
+from mitmproxy.addons import certpregen
+from mitmproxy.proxy import protocol
+from mitmproxy.test import taddons
+from mitmproxy.test import tflow
+
+
+def ignored_layer(sni):
+    layer = mock.Mock(spec=protocol.RawTCPLayer)
+    layer.ignore = True
+    layer.client_conn = mock.Mock(sni=sni)
+    return layer
+
+
+class TestCertPregen:
+    def setup_method(self):
+        self.a = certpregen.CertPregen()
+
+    def teardown_method(self):
+        self.a.done()
+
+    def certstore(self, tctx, tmpdir):
+        tctx.master.server = mock.Mock()
+        tctx.master.server.config.certstore = certs.CertStore.from_store(str(tmpdir), "test", 2048)
+        return tctx.master.server.config.certstore
+
+    def wait(self):
+        self.a.executor.shutdown()
+        self.a.executor = None
+
+    def test_predict(self, tmpdir):
+        with taddons.context(self.a) as tctx:
+            store = self.certstore(tctx, tmpdir)
+            f = tflow.tflow()
+            f.request.host = "connect.example.com"
+            self.a.predict(f.request.host)
+            assert not self.a.executor
+
+            tctx.configure(self.a, cert_pregen=True)
+            tctx.master.addons.trigger("http_connect", f)
+            tctx.master.addons.trigger("http_connect", f)
+            tctx.master.addons.trigger("next_layer", ignored_layer("IGNORED.example.com"))
+            tctx.master.addons.trigger("next_layer", ignored_layer(None))
+            tctx.master.addons.trigger("next_layer", mock.Mock())
+            self.a.predict("\udcff")
+            self.wait()
+            assert set(store.certs) == {
+                (b"connect.example.com", (b"connect.example.com",)),
+                (b"ignored.example.com", (b"ignored.example.com",)),
+            }
+            assert not store.wildcards
+
+            self.a.submit(store.get_entry, b"done.example.com", [])
+            self.a.done()
+            assert not self.a.executor
+
+    def test_hooks(self):
+        with taddons.context(self.a) as tctx:
+            assert not tctx.master.addons.handles("next_layer", None)
+            tctx.configure(self.a, cert_pregen=True)
+            assert tctx.master.addons.handles("next_layer", None)
+            tctx.configure(self.a, cert_pregen=False)
+            assert not tctx.master.addons.handles("next_layer", None)
+
+    def test_new_certstore(self, tmpdir):
+        with taddons.context(self.a) as tctx:
+            self.certstore(tctx, tmpdir)
+            tctx.configure(self.a, cert_pregen=True)
+            self.a.predict("example.com")
+            self.wait()
+            store = self.certstore(tctx, tmpdir)
+            self.a.predict("example.com")
+            self.wait()
+            assert store.get_generated(b"example.com")
+
+    def test_seen_cap(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(certpregen, "SEEN_CAP", 2)
+        with taddons.context(self.a) as tctx:
+            self.certstore(tctx, tmpdir)
+            tctx.configure(self.a, cert_pregen=True, cert_pregen_wildcard=5)
+            self.a.predict_all(["a.one.com", "a.two.com", "a.three.com", "a.one.com"])
+            self.wait()
+            assert list(self.a.seen) == ["a.three.com", "a.one.com"]
+            assert list(self.a.subdomains) == ["three.com", "one.com"]
+
+    def test_wildcard(self, tmpdir):
+        with taddons.context(self.a) as tctx:
+            store = self.certstore(tctx, tmpdir)
+            tctx.configure(self.a, cert_pregen=True, cert_pregen_wildcard=2)
+            self.a.predict_all([
+                "a.example.com", "b.example.com", "c.example.com",
+                "a.co.uk", "b.co.uk",
+                "10.0.0.1", "10.0.0.2",
+                "localhost",
+            ])
+            self.wait()
+            assert store.wildcards == {b"*.example.com"}
+            assert store.get_cert(b"d.example.com", [])[0].cn == b"*.example.com"
+
+    def test_warmup(self, tmpdir):
+        path = str(tmpdir.join("flows"))
+        with open(path, "wb") as f:
+            w = io.FlowWriter(f)
+            w.add(tflow.tflow())
+            f2 = tflow.tflow()
+            f2.server_conn.sni = None
+            f2.server_conn.address = ("flow.example.com", 443)
+            w.add(f2)
+            f3 = tflow.tflow()
+            f3.server_conn.sni = None
+            f3.server_conn.address = None
+            w.add(f3)
+
+        with taddons.context(self.a) as tctx:
+            store = self.certstore(tctx, tmpdir)
+            tctx.configure(self.a, cert_pregen=True, cert_pregen_hosts=["host.example.com"], cert_pregen_flows=[path])
+            assert not self.a.executor
+            self.a.running()
+            self.wait()
+            assert (b"host.example.com", (b"host.example.com",)) in store.certs
+            assert (b"address", (b"address",)) in store.certs
+            assert (b"flow.example.com", (b"flow.example.com",)) in store.certs
+
+            tctx.configure(self.a, cert_pregen_hosts=["later.example.com"])
+            self.wait()
+            assert (b"later.example.com", (b"later.example.com",)) in store.certs
+
+            with pytest.raises(exceptions.OptionsError):
+                tctx.configure(self.a, cert_pregen_flows=[str(tmpdir.join("missing"))])
+
+    def test_no_server(self):
+        with taddons.context(self.a) as tctx:
+            tctx.configure(self.a, cert_pregen=True)
+            self.a.predict("example.com")
+            assert not self.a.executor
@@ -3,6 +3,7 @@ from unittest import mock
 from mitmproxy.addons import core
 from mitmproxy.test import taddons
 from mitmproxy.test import tflow
+from mitmproxy.utils import histogram
 from mitmproxy import exceptions
 import pytest
 
@@ -18,6 +19,18 @@ def test_set():
             tctx.command(sa.set, "nonexistent")
 
 
+def test_cert_latency():
+    sa = core.Core()
+    with taddons.context() as tctx:
+        with pytest.raises(exceptions.CommandError, match="not running"):
+            sa.cert_latency()
+        tctx.master.server = mock.Mock()
+        h = tctx.master.server.config.certstore.generation_latency = histogram.Histogram([1])
+        assert sa.cert_latency() == "0 certificates, 0.000s mean: empty"
+        h.observe(0.5)
+        assert sa.cert_latency() == "1 certificates, 0.500s mean: <=1: 1"
+
+
 def test_resume():
     sa = core.Core()
     with taddons.context(loadcore=False):
@@ -3,6 +3,7 @@ from unittest.mock import Mock
 import pytest
 
 from mitmproxy import exceptions
+from mitmproxy.net import tcp
 from mitmproxy.net.http import Headers
 from mitmproxy.net.http.http1.read import (
     read_request, read_response, read_request_head,
@@ -353,6 +354,12 @@ class TestReadHeaders:
         assert headers.fields == ((b"bar", b""),)
 
 
+class TestReadHeadersReader(TestReadHeaders):
+    @staticmethod
+    def _read(data):
+        return _read_headers(tcp.Reader(BytesIO(data)))
+
+
 def test_read_chunked():
     req = treq(content=None)
     req.headers["Transfer-Encoding"] = "chunked"
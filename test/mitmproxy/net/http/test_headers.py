@@ -52,6 +52,41 @@ class TestHeaders:
             headers["foobar"] = 42
         assert len(headers) == 3
 
+    def test_index(self):
+        headers = Headers([
+            [b"Host", b"example.com"],
+            [b"Accept", b"text/html"],
+            [b"accept", b"application/xml"],
+        ])
+        assert headers["ACCEPT"] == "text/html, application/xml"
+        assert "accept" in headers
+        assert b"HOST" in headers
+        assert "foo" not in headers
+        assert len(headers) == 2
+
+        headers["X-Foo"] = "1"
+        headers.add("x-foo", "2")
+        assert headers.get_all("x-foo") == ["1", "2"]
+        headers["Accept"] = "text/plain"
+        assert headers.get_all("accept") == ["text/plain"]
+        del headers["host"]
+        assert "host" not in headers
+        headers.insert(0, "Host", "example.org")
+        assert headers["host"] == "example.org"
+        headers.replace("example.org", "example.net")
+        assert headers["host"] == "example.net"
+        headers.fields = ((b"Foo", b"bar"),)
+        assert "host" not in headers
+        assert headers["foo"] == "bar"
+        headers.set_all("foo", [])
+        assert "foo" not in headers
+        assert headers.fields == ()
+
+        headers = Headers([[b"B", b"1"], [b"a", b"2"], [b"b", b"3"]])
+        headers.set_all("A", ["4", "5"])
+        headers.set_all("C", ["6"])
+        assert bytes(headers) == b"B: 1\r\na: 4\r\nb: 3\r\nA: 5\r\nC: 6\r\n"
+
     def test_bytes(self):
         headers = Headers(Host="example.com")
         assert bytes(headers) == b"Host: example.com\r\n"
@@ -0,0 +1,141 @@
+import socket
+import threading
+from unittest import mock
+
+import pytest
+
+from mitmproxy.net import resolver
+
+
+class FakeGetaddrinfo:
+    def __init__(self, error=None):
+        self.calls = []
+        self.error = error
+
+    def __call__(self, host, port, *args):
+        self.calls.append(host)
+        if self.error:
+            raise self.error
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", port))]
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    f = FakeGetaddrinfo()
+    monkeypatch.setattr(socket, "getaddrinfo", f)
+    return f
+
+
+class TestResolver:
+    def test_cache(self, fake):
+        r = resolver.Resolver()
+        assert r.getaddrinfo("example.com", 80)[0][4] == ("127.0.0.1", 80)
+        assert r.getaddrinfo("example.com", 80)[0][4] == ("127.0.0.1", 80)
+        assert r.getaddrinfo("example.com", 443)[0][4] == ("127.0.0.1", 443)
+        assert fake.calls == ["example.com", "example.com"]
+        assert r.hits == 1
+        assert r.misses == 2
+        assert len(r) == 2
+        r.clear()
+        assert not len(r)
+
+    def test_ttl(self, fake):
+        r = resolver.Resolver(ttl=10)
+        with mock.patch("time.time", return_value=100):
+            r.getaddrinfo("example.com", 80)
+        with mock.patch("time.time", return_value=109):
+            r.getaddrinfo("example.com", 80)
+        assert len(fake.calls) == 1
+        with mock.patch("time.time", return_value=111):
+            r.getaddrinfo("example.com", 80)
+        assert len(fake.calls) == 2
+
+    def test_disabled(self, fake):
+        r = resolver.Resolver(ttl=0)
+        r.getaddrinfo("example.com", 80)
+        r.getaddrinfo("example.com", 80)
+        assert len(fake.calls) == 2
+        assert not len(r)
+
+    def test_size(self, fake):
+        r = resolver.Resolver(size=2)
+        r.getaddrinfo("a", 80)
+        r.getaddrinfo("b", 80)
+        r.getaddrinfo("a", 80)
+        r.getaddrinfo("c", 80)
+        assert len(r) == 2
+        r.getaddrinfo("a", 80)
+        r.getaddrinfo("b", 80)
+        assert fake.calls == ["a", "b", "c", "b"]
+
+    def test_negative(self, monkeypatch):
+        fake = FakeGetaddrinfo(socket.gaierror("nope"))
+        monkeypatch.setattr(socket, "getaddrinfo", fake)
+        r = resolver.Resolver(negative_ttl=5)
+        errors = []
+        for _ in range(2):
+            with pytest.raises(socket.gaierror, match="nope") as e:
+                r.getaddrinfo("example.com", 80)
+            errors.append(e.value)
+        assert errors[0] is not errors[1]
+        assert len(fake.calls) == 1
+        assert r.hits == 1
+
+        r.configure(60, 0, 1000)
+        for _ in range(2):
+            with pytest.raises(socket.gaierror):
+                r.getaddrinfo("example.com", 80)
+        assert len(fake.calls) == 3
+
+    def test_other_error(self, monkeypatch):
+        fake = FakeGetaddrinfo(OSError("interrupted"))
+        monkeypatch.setattr(socket, "getaddrinfo", fake)
+        r = resolver.Resolver()
+        for _ in range(2):
+            with pytest.raises(OSError, match="interrupted"):
+                r.getaddrinfo("example.com", 80)
+        assert len(fake.calls) == 2
+        assert not len(r)
+
+    def test_hosts(self):
+        r = resolver.Resolver(hosts={"Example.com": "127.0.0.1", "v6.example.com": "::1"})
+        assert r.getaddrinfo("example.COM", 80)[0][4] == ("127.0.0.1", 80)
+        info = r.getaddrinfo("v6.example.com", 443)
+        assert info[0][0] == socket.AF_INET6
+        assert info[0][4][:2] == ("::1", 443)
+
+    def test_family(self):
+        r = resolver.Resolver(size=1)
+        assert r.preferred_family("a") is None
+        r.remember_family("a", socket.AF_INET6)
+        assert r.preferred_family("a") == socket.AF_INET6
+        r.remember_family("b", socket.AF_INET)
+        assert r.preferred_family("a") is None
+        assert r.preferred_family("b") == socket.AF_INET
+
+    def test_single_flight(self, monkeypatch):
+        release = threading.Event()
+        calls = []
+
+        def getaddrinfo(host, port, *args):
+            calls.append(host)
+            release.wait()
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", port))]
+
+        monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+        r = resolver.Resolver()
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(r.getaddrinfo("example.com", 80)))
+            for _ in range(5)
+        ]
+        for t in threads:
+            t.start()
+        while r.misses < 5:
+            release.wait(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+        assert calls == ["example.com"]
+        assert len(results) == 5
+        assert r.misses == 5
@@ -1,4 +1,6 @@
 from io import BytesIO
+import errno
+import os
 import re
 import queue
 import time
@@ -10,6 +12,7 @@ from unittest import mock
 from OpenSSL import SSL
 
 from mitmproxy import certs
+from mitmproxy.net import resolver
 from mitmproxy.net import tcp
 from mitmproxy import exceptions
 from mitmproxy.utils import data
@@ -93,6 +96,50 @@ class TestServer(tservers.ServerTestBase):
                 assert "nonewthread" in self.q.get_nowait()
         self.test_echo()
 
+    def test_can_process(self):
+        server = self.server.server
+        c = tcp.TCPClient(("127.0.0.1", self.port))
+        with c.connect():
+            with mock.patch.object(server, "can_process", return_value=False):
+                c.wfile.write(b"echo!\n")
+                c.wfile.flush()
+                time.sleep(0.2)
+                assert server.handler_counter.count == 0
+            assert c.rfile.readline() == b"echo!\n"
+
+
+class TestServerAsync(tservers.ServerTestBase):
+    handler = EchoHandler
+    serve_async = True
+
+    def test_echo(self):
+        testval = b"echo!\n"
+        c = tcp.TCPClient(("127.0.0.1", self.port))
+        with c.connect():
+            c.wfile.write(testval)
+            c.wfile.flush()
+            assert c.rfile.readline() == testval
+
+    def test_idle_connection_has_no_thread(self):
+        c = tcp.TCPClient(("127.0.0.1", self.port))
+        with c.connect():
+            time.sleep(0.1)
+            assert self.server.server.handler_counter.count == 0
+            c.wfile.write(b"echo!\n")
+            c.wfile.flush()
+            assert c.rfile.readline() == b"echo!\n"
+
+    def test_can_process(self):
+        server = self.server.server
+        c = tcp.TCPClient(("127.0.0.1", self.port))
+        with c.connect():
+            with mock.patch.object(server, "can_process", return_value=False):
+                c.wfile.write(b"echo!\n")
+                c.wfile.flush()
+                time.sleep(0.2)
+                assert server.handler_counter.count == 0
+            assert c.rfile.readline() == b"echo!\n"
+
 
 class TestServerBind(tservers.ServerTestBase):
 
@@ -313,6 +360,18 @@ class TestSSLUpstreamCertVerificationWBadHostname(tservers.ServerTestBase):
                 )
             assert c.ssl_verification_error
 
+    def test_shared_context_should_fail(self, tdata):
+        # The hostname must be checked per connection, even if the context is reused.
+        ca_pemfile = tdata.path("mitmproxy/net/data/verificationcerts/trusted-root.crt")
+        c = tcp.TCPClient(("127.0.0.1", self.port))
+        with c.connect():
+            c.convert_to_tls(sni="example.mitmproxy.org", verify=SSL.VERIFY_PEER, ca_pemfile=ca_pemfile)
+            assert c.ssl_verification_error is None
+        c = tcp.TCPClient(("127.0.0.1", self.port))
+        with c.connect():
+            with pytest.raises(exceptions.InvalidCertificateException):
+                c.convert_to_tls(sni="mitmproxy.org", verify=SSL.VERIFY_PEER, ca_pemfile=ca_pemfile)
+
 
 class TestSSLUpstreamCertVerificationWValidCertChain(tservers.ServerTestBase):
     handler = EchoHandler
@@ -613,6 +672,39 @@ class TestDHParams(tservers.ServerTestBase):
             assert ret[0] == "DHE-RSA-AES256-SHA"
 
 
+class StallingSocket(socket.socket):
+    def connect_ex(self, address):
+        # A listening socket never becomes writable.
+        self.bind(("127.0.0.1", 0))
+        self.listen(1)
+        return errno.EINPROGRESS
+
+
+class RefusingSocket(socket.socket):
+    def connect_ex(self, address):
+        return errno.ECONNREFUSED
+
+
+class HighFdSocket(socket.socket):
+    # A socket with a file descriptor above select's FD_SETSIZE.
+    def __init__(self, family, type, proto):
+        s = socket.socket(family, type, proto)
+        fd = os.dup2(s.fileno(), 2000)
+        s.close()
+        super().__init__(family, type, proto, fileno=fd)
+
+
+class MockSocketClient(tcp.TCPClient):
+    def __init__(self, address, sockets, **kwargs):
+        super().__init__(address, **kwargs)
+        self.sockets = sockets
+
+    def makesocket(self, family, type, proto):
+        if self.sockets:
+            return self.sockets.pop(0)(family, type, proto)
+        return super().makesocket(family, type, proto)
+
+
 class TestTCPClient(tservers.ServerTestBase):
 
     def test_conerr(self):
@@ -630,6 +722,83 @@ class TestTCPClient(tservers.ServerTestBase):
         with pytest.raises(exceptions.TcpException, match="Failed to spoof"):
             c.connect()
 
+    def test_happy_eyeballs(self, monkeypatch):
+        addresses = [
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", self.port)),
+            (socket.AF_INET6, socket.SOCK_STREAM, 6, "", ("::1", 0, 0, 0)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", self.port)),
+        ]
+        r = resolver.Resolver()
+        monkeypatch.setattr(r, "getaddrinfo", lambda host, port: list(addresses))
+        c = MockSocketClient(("example.com", self.port), [StallingSocket], resolver=r)
+        c.happy_eyeballs_delay = 0.01
+        with c.connect():
+            assert c.ip_address[0] == "127.0.0.1"
+            assert c.connection.gettimeout() is None
+        assert not c.sockets
+        assert r.preferred_family("example.com") == socket.AF_INET
+
+        del addresses[1:]
+        c = MockSocketClient(("example.com", self.port), [StallingSocket], resolver=r)
+        with pytest.raises(socket.timeout):
+            c.create_connection(timeout=0.1)
+
+        addresses[:] = [
+            (socket.AF_INET6, socket.SOCK_STREAM, 6, "", ("::1", 0, 0, 0)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", self.port)),
+        ]
+        c = MockSocketClient(
+            ("example.com", self.port), [socket.socket, RefusingSocket], source_address=("::1", 0), resolver=r
+        )
+        with pytest.raises(exceptions.TcpException, match="Error connecting"):
+            c.connect()
+
+    def test_happy_eyeballs_failure(self, monkeypatch):
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        closed_port = s.getsockname()[1]
+        s.close()
+        addresses = [
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", closed_port)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", self.port)),
+        ]
+        r = resolver.Resolver()
+        monkeypatch.setattr(r, "getaddrinfo", lambda host, port: list(addresses))
+        # A failed attempt starts the next one without waiting for the delay.
+        c = tcp.TCPClient(("example.com", self.port), resolver=r)
+        c.happy_eyeballs_delay = 60
+        start = time.time()
+        with c.connect():
+            assert c.ip_address[1] == self.port
+        assert time.time() - start < 30
+
+    @pytest.mark.skipif(
+        not hasattr(os, "dup2") or os.name == "nt", reason="Needs a file descriptor above FD_SETSIZE"
+    )
+    def test_high_fd(self):
+        c = MockSocketClient(("127.0.0.1", self.port), [HighFdSocket])
+        with c.connect():
+            assert c.connection.fileno() == 2000
+
+    def test_resolver(self):
+        r = resolver.Resolver()
+        c = tcp.TCPClient(("localhost", self.port))
+        with c.connect():
+            pass
+        assert not r.misses
+        c = tcp.TCPClient(("localhost", self.port), resolver=r)
+        with c.connect():
+            pass
+        assert r.misses == 1
+        assert r.preferred_family("localhost")
+
+    def test_sort_addresses(self):
+        v4 = [(socket.AF_INET, i) for i in range(3)]
+        v6 = [(socket.AF_INET6, i) for i in range(2)]
+        assert tcp.sort_addresses([]) == []
+        assert tcp.sort_addresses(v6 + v4) == [v6[0], v4[0], v6[1], v4[1], v4[2]]
+        assert tcp.sort_addresses(v6 + v4, socket.AF_INET) == [v4[0], v6[0], v4[1], v6[1], v4[2]]
+
 
 class TestTCPServer:
 
@@ -645,6 +814,56 @@ class TestTCPServer:
             s.shutdown()
 
 
+class TestWorkerPool:
+
+    def test_simple(self):
+        p = tcp.WorkerPool("test", 2, 0)
+        q = queue.Queue()
+        assert p.submit(q.put, 1)
+        assert q.get(timeout=1) == 1
+        assert p.dispatched == 1
+        assert p.mean_wait >= 0
+        p.shutdown()
+        assert not p.submit(q.put, 2)
+
+    def test_saturation(self):
+        p = tcp.WorkerPool("test", 1, 1)
+        assert p.mean_wait == 0
+        release = threading.Event()
+        assert p.submit(release.wait)
+        for _ in range(50):
+            if p.active_workers == 1:
+                break
+            time.sleep(0.01)
+        assert p.active_workers == 1
+        assert not p.saturated
+        assert p.submit(release.wait)
+        assert p.saturated
+        assert not p.submit(release.wait)
+        assert p.queue_depth == 1
+        release.set()
+        for _ in range(50):
+            if not p.saturated:
+                break
+            time.sleep(0.01)
+        assert p.submit(release.wait)
+        p.shutdown()
+
+    def test_idle_timeout(self):
+        p = tcp.WorkerPool("test", 2, 0, idle_timeout=0.01)
+        q = queue.Queue()
+        assert p.submit(q.put, 1)
+        assert q.get(timeout=1) == 1
+        for _ in range(100):
+            if not p._workers:
+                break
+            time.sleep(0.01)
+        assert not p._workers
+        assert p.submit(q.put, 2)
+        assert q.get(timeout=1) == 2
+        p.shutdown()
+
+
 class TestFileLike:
 
     def test_blocksize(self):
@@ -667,6 +886,12 @@ class TestFileLike:
         # Test __getattr__
         assert s.isatty
 
+    def test_read_until_blank_line(self):
+        s = tcp.Reader(BytesIO(b"foo\r\nbar\r\n\r\nbody"))
+        assert s.read_until_blank_line() == b"foo\r\nbar\r\n\r\n"
+        assert s.read_until_blank_line() == b"body"
+        assert s.read_until_blank_line() == b""
+
     def test_limit(self):
         s = BytesIO(b"foobar\nfoobar")
         s = tcp.Reader(s)
@@ -806,3 +1031,63 @@ class TestPeekSSL(TestPeek):
         with c.connect() as conn:
             c.convert_to_tls()
             return conn.pop()
+
+
+class LineEchoHandler(tcp.BaseHandler):
+
+    def handle(self):
+        while True:
+            v = self.rfile.readline()
+            if not v:
+                return
+            self.wfile.write(v)
+            self.wfile.flush()
+
+
+class TestReadline(tservers.ServerTestBase):
+    handler = LineEchoHandler
+
+    def _connect(self, c):
+        return c.connect()
+
+    def test_readline(self):
+        c = tcp.TCPClient(("127.0.0.1", self.port))
+        with self._connect(c):
+            c.rfile.BLOCKSIZE = 3
+            c.wfile.write(b"foo\r\nbar: baz\r\nx\n\r\nbody\n\nmore\n")
+            c.wfile.flush()
+
+            assert c.rfile.readline(2) == b"fo"
+            assert c.rfile.readline() == b"o\r\n"
+            assert c.rfile.read_until_blank_line() == b"bar: baz\r\nx\n\r\n"
+            assert c.rfile.read_until_blank_line() == b"body\n\n"
+            assert c.rfile.read(5) == b"more\n"
+
+            c.wfile.write(b"\r\nfoo\n")
+            c.wfile.flush()
+            assert c.rfile.read_until_blank_line() == b"\r\n"
+            assert c.rfile.readline() == b"foo\n"
+
+            c.settimeout(0.01)
+            with pytest.raises(exceptions.TcpTimeout):
+                c.rfile.readline()
+
+            c.close()
+            with pytest.raises(exceptions.NetlibException):
+                c.rfile.readline()
+
+
+class TestReadlineSSL(TestReadline):
+    ssl = True
+
+    def _connect(self, c):
+        with c.connect() as conn:
+            c.convert_to_tls()
+            return conn.pop()
+
+    def test_readline_error(self):
+        c = tcp.TCPClient(("127.0.0.1", self.port))
+        with self._connect(c):
+            with mock.patch.object(SSL.Connection, "recv", side_effect=SSL.Error()):
+                with pytest.raises(exceptions.TlsException):
+                    c.rfile.readline()
@@ -1,7 +1,11 @@
 import io
+import struct
+import time
 
+import OpenSSL
 import pytest
 
+from mitmproxy import certs
 from mitmproxy import exceptions
 from mitmproxy.net import tls
 from mitmproxy.net.tcp import TCPClient
@@ -54,6 +58,196 @@ class TestMasterSecretLogger(tservers.ServerTestBase):
         assert not tls.MasterSecretLogger.create_logfun(False)
 
 
+class NoSNIEchoHandler(EchoHandler):
+    # Contexts with SNI handlers are not cached.
+    handle_sni = None
+
+
+class TestCachedServerContext(tservers.ServerTestBase):
+    handler = NoSNIEchoHandler
+    ssl = dict(
+        contexts={},
+        alpn_select_callback=lambda conn, options: options[-1],
+    )
+
+    def test_handshake(self):
+        for alpn in [[b"h2", b"http/1.1"], [b"foo", b"bar"]]:
+            c = TCPClient(("127.0.0.1", self.port))
+            with c.connect():
+                c.convert_to_tls(alpn_protos=alpn)
+                assert c.get_alpn_proto_negotiated() == alpn[-1]
+                c.wfile.write(b"echo!\n")
+                c.wfile.flush()
+                assert c.rfile.readline() == b"echo!\n"
+        assert len(self.ssl["contexts"]) == 1
+
+
+class TestSessionResumption(tservers.ServerTestBase):
+    handler = NoSNIEchoHandler
+    ssl = dict(
+        contexts={},
+        session_timeout=300,
+        request_client_cert=True,
+    )
+
+    def handshakes(self, monkeypatch, alpns):
+        cache = tls.SessionCache()
+        monkeypatch.setattr(tls, "default_session_cache", cache)
+        for alpn in alpns:
+            c = TCPClient(("127.0.0.1", self.port))
+            with c.connect():
+                c.convert_to_tls(sni="example.com", alpn_protos=alpn)
+                c.wfile.write(b"echo!\n")
+                c.wfile.flush()
+                assert c.rfile.readline() == b"echo!\n"
+                # Sessions of connections that are not shut down cleanly can't be resumed.
+                c.finish()
+        return cache
+
+    def test_resume(self, monkeypatch):
+        cache = self.handshakes(monkeypatch, [[b"h2"], [b"h2"], [b"http/1.1"]])
+        assert cache.hits == 1
+        assert cache.misses == 2
+        assert len(cache) == 2
+
+
+class TestSessionResumptionDisabled(TestSessionResumption):
+    ssl = dict(
+        contexts={},
+        session_timeout=0,
+    )
+
+    def test_resume(self, monkeypatch):
+        cache = self.handshakes(monkeypatch, [[b"h2"], [b"h2"]])
+        assert cache.hits == 0
+
+
+def test_session_cache():
+    c = tls.SessionCache(size=2)
+    assert c.get("a") is None
+    c.put("a", "session-a")
+    c.put("b", "session-b")
+    assert c.get("a") == ("session-a", None)
+    c.put("c", "session-c", resumed=True)
+    assert c.get("b") is None
+    assert len(c) == 2
+    assert (c.hits, c.misses) == (1, 2)
+    c.clear()
+    assert not c.get("a")
+
+    c.configure(0)
+    c.put("a", "session-a")
+    assert not len(c)
+
+
+class TestHostnameCache(tservers.ServerTestBase):
+    handler = EchoHandler
+    ssl = dict(
+        cert=tservers.cdata.path("data/verificationcerts/trusted-leaf.crt"),
+        key=tservers.cdata.path("data/verificationcerts/trusted-leaf.key")
+    )
+
+    def handshake(self, sni, ca):
+        c = TCPClient(("127.0.0.1", self.port))
+        with c.connect():
+            c.convert_to_tls(
+                sni=sni,
+                verify=OpenSSL.SSL.VERIFY_PEER,
+                ca_pemfile=tservers.cdata.path("data/verificationcerts/" + ca)
+            )
+
+    def test_cache(self, monkeypatch):
+        cache = tls.HostnameCache()
+        monkeypatch.setattr(tls, "default_hostname_cache", cache)
+        monkeypatch.setattr(tls, "default_session_cache", tls.SessionCache(size=0))
+        self.handshake("example.mitmproxy.org", "trusted-root.crt")
+        self.handshake("example.mitmproxy.org", "trusted-root.crt")
+        assert (cache.hits, cache.misses) == (1, 1)
+        with pytest.raises(exceptions.InvalidCertificateException):
+            self.handshake("mitmproxy.org", "trusted-root.crt")
+        # The chain is still verified for cached certificates.
+        with pytest.raises(exceptions.InvalidCertificateException):
+            self.handshake("example.mitmproxy.org", "self-signed.crt")
+        assert len(cache) == 1
+
+
+def test_hostname_cache(monkeypatch):
+    c = tls.HostnameCache(ttl=60, size=2)
+    assert not c.get("a")
+    c.put("a")
+    c.put("b")
+    assert c.get("a")
+    c.put("c")
+    assert not c.get("b")
+    assert len(c) == 2
+    assert (c.hits, c.misses) == (1, 2)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 60)
+    assert not c.get("a")
+    assert len(c) == 1
+    c.clear()
+    assert not len(c)
+
+    c.configure(0, 10)
+    c.put("a")
+    assert not len(c)
+
+
+def test_cached_server_context_rotation(monkeypatch):
+    cert = tservers.cdata.path("data/server.crt")
+    with open(tservers.cdata.path("data/server.key")) as f:
+        key = OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM, f.read())
+    contexts = {}
+    a = tls.cached_server_context(contexts, cert, key, session_timeout=60)
+    assert tls.cached_server_context(contexts, cert, key, session_timeout=60) is a
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 60)
+    b = tls.cached_server_context(contexts, cert, key, session_timeout=60)
+    assert b is not a
+    assert tls.cached_server_context(contexts, cert, key, session_timeout=60) is b
+    assert len(contexts) == 1
+
+
+def test_cached_server_context():
+    cert = tservers.cdata.path("data/server.crt")
+    with open(tservers.cdata.path("data/server.key")) as f:
+        key = OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM, f.read())
+    contexts = {}
+    a = tls.cached_server_context(contexts, cert, key, cipher_list="AES256-SHA")
+    assert tls.cached_server_context(contexts, cert, key, cipher_list="AES256-SHA") is a
+    assert tls.cached_server_context(contexts, cert, key, cipher_list="AES128-SHA") is not a
+    assert len(contexts) == 2
+
+    # Extra chain certificates are not cached.
+    with open(cert, "rb") as f:
+        extra = [certs.Cert.from_pem(f.read())]
+    b = tls.cached_server_context(contexts, cert, key, extra_chain_certs=extra)
+    assert tls.cached_server_context(contexts, cert, key, extra_chain_certs=extra) is not b
+    assert len(contexts) == 2
+    assert tls.cached_server_context(contexts, cert, key, cipher_list="AES256-SHA", extra_chain_certs=[]) is a
+
+
+def test_client_context_cache(monkeypatch):
+    monkeypatch.setattr(tls, "CLIENT_CONTEXT_CACHE_SIZE", 2)
+    monkeypatch.setattr(tls, "_client_contexts", type(tls._client_contexts)())
+    a = tls.create_client_context(alpn_protos=[b"h2"])
+    assert tls.create_client_context(sni="example.com", alpn_protos=[b"h2"]) is a
+    assert tls.create_client_context(alpn_protos=[b"http/1.1"]) is not a
+    assert tls.create_client_context(cipher_list="AES256-SHA") is not a
+    assert len(tls._client_contexts) == 2
+    assert tls.create_client_context(alpn_protos=[b"h2"]) is not a
+
+    class Unhashable:
+        __hash__ = None
+
+        def __call__(self, conn, options):
+            return options[0]
+
+    b = tls.create_client_context(alpn_select_callback=Unhashable())
+    assert tls.create_client_context(alpn_select_callback=Unhashable()) is not b
+    assert len(tls._client_contexts) == 2
+
+
 class TestTLSInvalid:
     def test_invalid_ssl_method_should_fail(self):
         fake_ssl_method = 100500
@@ -136,6 +330,49 @@ class TestClientHello:
             (10, b'\x00\x06\x00\x1d\x00\x17\x00\x18')
         ]
 
+    @pytest.mark.parametrize("data", [
+        CLIENT_HELLO_NO_EXTENSIONS[:20],  # random
+        CLIENT_HELLO_NO_EXTENSIONS[:36],  # session id
+        CLIENT_HELLO_NO_EXTENSIONS[:70],  # cipher suites
+        CLIENT_HELLO_NO_EXTENSIONS[:-1],  # compression methods
+        CLIENT_HELLO_NO_EXTENSIONS + b"\x00\x05\x00\x00\x00\x02",  # extension body
+        CLIENT_HELLO_NO_EXTENSIONS + b"\x00\x05\x00\x00\x00\x01\x00",  # server name list
+        CLIENT_HELLO_NO_EXTENSIONS + b"\x00\x08\x00\x00\x00\x04\x00\x02\x00\x00",  # server name
+        CLIENT_HELLO_NO_EXTENSIONS + b"\x00\x05\x00\x10\x00\x01\x00",  # protocol name list
+        CLIENT_HELLO_NO_EXTENSIONS + b"\x00\x07\x00\x10\x00\x03\x00\x01\x02",  # protocol name
+    ])
+    def test_truncated(self, data):
+        with pytest.raises(EOFError):
+            tls.ClientHello(data)
+
+    def test_sni_alpn_variants(self):
+        def ext(ext_type, body):
+            return struct.pack("!HH", ext_type, len(body)) + body
+
+        def client_hello(*extensions):
+            data = b"".join(extensions)
+            return CLIENT_HELLO_NO_EXTENSIONS + struct.pack("!H", len(data)) + data
+
+        # Only a single, valid host name is accepted, the first valid SNI extension wins.
+        two_names = b"\x00\x10" + b"\x00\x00\x05a.com" + b"\x00\x00\x05b.com"
+        invalid = b"\x00\x08\x00\x00\x05a_c!m"
+        valid = b"\x00\x08\x00\x00\x05c.com"
+        c = tls.ClientHello(client_hello(
+            ext(0, two_names),
+            ext(0, invalid),
+            ext(0, valid),
+            ext(0, b"\x00\x08\x00\x00\x05d.com"),
+            ext(16, b"\x00\x03\x02h2"),
+            ext(16, b"\x00\x09\x08http/1.1"),
+        ))
+        assert c.sni == b"c.com"
+        assert c.alpn_protocols == [b"h2"]
+        assert len(c.extensions) == 6
+
+        c = tls.ClientHello(client_hello(ext(16, b"\x00\x00"), ext(0, b"\x00\x00")))
+        assert c.sni is None
+        assert c.alpn_protocols == []
+
     def test_from_file(self):
         rfile = io.BufferedReader(io.BytesIO(
             FULL_CLIENT_HELLO_NO_EXTENSIONS
@@ -11,12 +11,16 @@ cdata = data.Data(__name__)
 
 class _ServerThread(threading.Thread):
 
-    def __init__(self, server):
+    def __init__(self, server, serve_async=False):
         self.server = server
+        self.serve_async = serve_async
         threading.Thread.__init__(self)
 
     def run(self):
-        self.server.serve_forever()
+        if self.serve_async:
+            self.server.serve_forever_async()
+        else:
+            self.server.serve_forever()
 
 
 class _TServer(tcp.TCPServer):
@@ -62,6 +66,11 @@ class _TServer(tcp.TCPServer):
             else:
                 method = OpenSSL.SSL.SSLv23_METHOD
                 options = None
+            kwargs = {}
+            if "contexts" in self.ssl:
+                kwargs["contexts"] = self.ssl["contexts"]
+                kwargs["alpn_select_callback"] = self.ssl.get("alpn_select_callback")
+                kwargs["session_timeout"] = self.ssl.get("session_timeout")
             h.convert_to_tls(
                 cert,
                 key,
@@ -72,7 +81,8 @@ class _TServer(tcp.TCPServer):
                 cipher_list=self.ssl.get("cipher_list", None),
                 dhparams=self.ssl.get("dhparams", None),
                 chain_file=self.ssl.get("chain_file", None),
-                alpn_select=self.ssl.get("alpn_select", None)
+                alpn_select=self.ssl.get("alpn_select", None),
+                **kwargs
             )
         h.handle()
         h.finish()
@@ -87,13 +97,14 @@ class ServerTestBase:
     ssl = None
     handler = None
     addr = ("127.0.0.1", 0)
+    serve_async = False
 
     @classmethod
     def setup_class(cls, **kwargs):
         cls.q = queue.Queue()
         s = cls.makeserver(**kwargs)
         cls.port = s.address[1]
-        cls.server = _ServerThread(s)
+        cls.server = _ServerThread(s, cls.serve_async)
         cls.server.start()
 
     @classmethod
@@ -105,7 +116,7 @@ class ServerTestBase:
     def teardown_class(cls):
         cls.server.server.shutdown()
 
-    def teardown(self):
+    def teardown_method(self):
         self.server.server.wait_for_silence()
 
     @property
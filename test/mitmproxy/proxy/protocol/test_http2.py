@@ -3,6 +3,8 @@
 
 import os
 import tempfile
+import time
+from unittest import mock
 import traceback
 import pytest
 import h2
@@ -13,6 +15,7 @@ import mitmproxy.net
 from ...net import tservers as net_tservers
 from mitmproxy import exceptions
 from mitmproxy.net.http import http1, http2
+from mitmproxy.proxy.protocol import http1 as http1layer
 from pathod.language import generators
 
 from ... import tservers
@@ -110,11 +113,11 @@ class _Http2TestBase:
     def master(self):
         return self.proxy.tmaster
 
-    def setup(self):
+    def setup_method(self):
         self.master.reset([])
         self.server.server.handle_server_event = self.handle_server_event
 
-    def teardown(self):
+    def teardown_method(self):
         if self.client:
             self.client.close()
         self.server.server.wait_for_silence()
@@ -813,6 +816,255 @@ class TestMaxConcurrentStreams(_Http2Test):
             assert b"Stream-ID " in flow.response.content
 
 
+class TestStreamPool(_Http2Test):
+
+    def setup_method(self):
+        super().setup_method()
+        self.options.http2_max_concurrent_streams = 2
+
+    def teardown_method(self):
+        self.options.http2_max_concurrent_streams = 100
+        super().teardown_method()
+
+    @classmethod
+    def handle_server_event(cls, event, h2_conn, rfile, wfile):
+        if isinstance(event, h2.events.ConnectionTerminated):
+            return False
+        elif isinstance(event, h2.events.RequestReceived):
+            h2_conn.send_headers(event.stream_id, [(':status', '200')], end_stream=True)
+            wfile.write(h2_conn.data_to_send())
+            wfile.flush()
+        return True
+
+    def _request(self, h2_conn, stream_id):
+        self._send_request(self.client.wfile, h2_conn, stream_id=stream_id, headers=[
+            (':authority', "127.0.0.1:{}".format(self.server.server.address[1])),
+            (':method', 'GET'),
+            (':scheme', 'https'),
+            (':path', '/'),
+        ])
+        events = []
+        while not any(isinstance(e, (h2.events.StreamEnded, h2.events.StreamReset)) for e in events):
+            header, body = http2.read_raw_frame(self.client.rfile)
+            events.extend(h2_conn.receive_data(b''.join([header, body])))
+            self.client.wfile.write(h2_conn.data_to_send())
+            self.client.wfile.flush()
+        return events
+
+    def _close(self, h2_conn):
+        h2_conn.close_connection()
+        self.client.wfile.write(h2_conn.data_to_send())
+        self.client.wfile.flush()
+
+    def test_stream_pool(self):
+        h2_conn = self.setup_connection()
+        events = []
+        for stream_id in [1, 3, 5, 7, 9]:
+            events.extend(self._request(h2_conn, stream_id))
+        self._close(h2_conn)
+
+        max_streams = [
+            e.changed_settings[h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS].new_value
+            for e in events if isinstance(e, h2.events.RemoteSettingsChanged)
+        ]
+        # our own settings, then the server's settings (limited to our maximum)
+        assert max_streams == [2, 2]
+        assert len(self.master.state.flows) == 5
+        assert all(f.response.status_code == 200 for f in self.master.state.flows)
+
+    def test_refused(self):
+        h2_conn = self.setup_connection()
+        with mock.patch("mitmproxy.net.tcp.WorkerPool.submit", return_value=False):
+            events = self._request(h2_conn, 1)
+        self._close(h2_conn)
+
+        resets = [e for e in events if isinstance(e, h2.events.StreamReset)]
+        assert resets[0].error_code == h2.errors.ErrorCodes.REFUSED_STREAM
+        assert not self.master.state.flows
+
+
+class TestFlowControl(_Http2Test):
+
+    def setup_method(self):
+        super().setup_method()
+        self.options.http2_stream_buffer_size = 16384
+
+    def teardown_method(self):
+        self.options.http2_stream_buffer_size = 1024 * 1024
+        super().teardown_method()
+
+    @classmethod
+    def handle_server_event(cls, event, h2_conn, rfile, wfile):
+        if isinstance(event, h2.events.ConnectionTerminated):
+            return False
+        elif isinstance(event, h2.events.DataReceived):
+            h2_conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            h2_conn.received_length = getattr(h2_conn, "received_length", 0) + len(event.data)
+        elif isinstance(event, h2.events.StreamEnded):
+            h2_conn.send_headers(event.stream_id, [(':status', '200')])
+            h2_conn.send_data(event.stream_id, str(h2_conn.received_length).encode(), end_stream=True)
+        wfile.write(h2_conn.data_to_send())
+        wfile.flush()
+        return True
+
+    def _read(self, h2_conn):
+        header, body = http2.read_raw_frame(self.client.rfile)
+        events = h2_conn.receive_data(b''.join([header, body]))
+        self.client.wfile.write(h2_conn.data_to_send())
+        self.client.wfile.flush()
+        return events
+
+    def test_large_body(self):
+        h2_conn = self.setup_connection()
+        events = []
+        while not any(isinstance(e, h2.events.RemoteSettingsChanged) for e in events):
+            events.extend(self._read(h2_conn))
+        self._send_request(self.client.wfile, h2_conn, end_stream=False, headers=[
+            (':authority', "127.0.0.1:{}".format(self.server.server.address[1])),
+            (':method', 'POST'),
+            (':scheme', 'https'),
+            (':path', '/'),
+        ])
+
+        # The body is much larger than the stream's flow control window,
+        # so we can only send all of it if the proxy keeps reopening it.
+        body = generators.RandomGenerator("bytes", 200 * 1024)[:]
+        sent = 0
+        while sent < len(body):
+            window = min(h2_conn.local_flow_control_window(1), h2_conn.max_outbound_frame_size)
+            if window:
+                h2_conn.send_data(1, body[sent:sent + window])
+                sent += window
+                self.client.wfile.write(h2_conn.data_to_send())
+                self.client.wfile.flush()
+            else:
+                events.extend(self._read(h2_conn))
+        h2_conn.end_stream(1)
+        self.client.wfile.write(h2_conn.data_to_send())
+        self.client.wfile.flush()
+
+        while not any(isinstance(e, h2.events.StreamEnded) for e in events):
+            events.extend(self._read(h2_conn))
+        h2_conn.close_connection()
+        self.client.wfile.write(h2_conn.data_to_send())
+        self.client.wfile.flush()
+
+        window_sizes = [
+            e.changed_settings[h2.settings.SettingCodes.INITIAL_WINDOW_SIZE].new_value
+            for e in events if isinstance(e, h2.events.RemoteSettingsChanged)
+            and h2.settings.SettingCodes.INITIAL_WINDOW_SIZE in e.changed_settings
+        ]
+        assert window_sizes and all(w == 16384 for w in window_sizes)
+        data = b''.join(e.data for e in events if isinstance(e, h2.events.DataReceived))
+        assert data == str(len(body)).encode()
+        assert len(self.master.state.flows) == 1
+        assert self.master.state.flows[0].request.content == body
+
+
+class TestUpstreamMultiplexing(_Http2Test):
+
+    def setup_method(self):
+        super().setup_method()
+        self.options.upstream_http2_multiplex = True
+        type(self).h2_requests = []
+        self.client = None
+        self.clients = []
+
+    def teardown_method(self):
+        for client in self.clients:
+            client.close()
+        self.options.upstream_http2_multiplex = False
+        super().teardown_method()
+
+    @classmethod
+    def handle_server_event(cls, event, h2_conn, rfile, wfile):
+        if isinstance(event, h2.events.ConnectionTerminated):
+            return False
+        elif isinstance(event, h2.events.RequestReceived):
+            cls.h2_requests.append((id(h2_conn), dict(event.headers)))
+        elif isinstance(event, h2.events.DataReceived):
+            h2_conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+            h2_conn.send_headers(event.stream_id, [(':status', '200')])
+            h2_conn.send_data(event.stream_id, b'stream %d' % event.stream_id, end_stream=True)
+        wfile.write(h2_conn.data_to_send())
+        wfile.flush()
+        return True
+
+    def _client(self):
+        client = mitmproxy.net.tcp.TCPClient(("127.0.0.1", self.proxy.port))
+        client.connect()
+        self.clients.append(client)
+        client.wfile.write(b"CONNECT localhost:%d HTTP/1.1\r\n\r\n" % self.server.server.address[1])
+        client.wfile.flush()
+        while client.rfile.readline() != b"\r\n":
+            pass
+        client.convert_to_tls(sni="localhost", alpn_protos=[b'http/1.1'])
+        return client
+
+    def _request(self, client, request):
+        client.wfile.write(request)
+        client.wfile.flush()
+        return http1.read_response(client.rfile, mitmproxy.net.http.Request.make("GET", "https://example.com/"))
+
+    def test_multiplexing(self):
+        a, b = self._client(), self._client()
+        assert self._request(a, b"GET /a HTTP/1.1\r\nHost: example.com\r\n\r\n").content == b"stream 1"
+        assert self._request(b, b"GET /b HTTP/1.1\r\nHost: example.com\r\n\r\n").content == b"stream 3"
+        resp = self._request(a, b"POST /c HTTP/1.1\r\nHost: example.com\r\nContent-Length: 3\r\n"
+                                b"Connection: keep-alive\r\n\r\nfoo")
+        assert resp.http_version == "HTTP/1.1"
+        assert resp.headers["transfer-encoding"] == "chunked"
+        assert resp.content == b"stream 5"
+
+        requests = self.h2_requests
+        assert len({conn for conn, _ in requests}) == 1
+        assert [headers[b':path'] for _, headers in requests] == [b'/a', b'/b', b'/c']
+        assert requests[0][1][b':authority'] == b'example.com'
+        assert b'host' not in requests[0][1]
+        assert b'connection' not in requests[2][1]
+
+        flows = self.master.state.flows
+        assert len(flows) == 3
+        assert flows[0].server_conn is flows[1].server_conn
+        assert flows[0].server_conn.alpn_proto_negotiated == b"h2"
+        assert len(self.proxy.tmaster.server.config.multiplex_pool) == 1
+
+    def test_server_events(self):
+        class Recorder:
+            def __init__(self):
+                self.events = []
+
+            def serverconnect(self, conn):
+                self.events.append(("connect", conn))
+
+            def serverdisconnect(self, conn):
+                self.events.append(("disconnect", conn))
+
+        recorder = Recorder()
+        self.master.reset([recorder])
+        pool = self.proxy.tmaster.server.config.multiplex_pool
+        pool.clear()
+        a = self._client()
+        assert self._request(a, b"GET /a HTTP/1.1\r\nHost: example.com\r\n\r\n").content == b"stream 1"
+        pool.clear()
+        for _ in range(100):
+            if len(recorder.events) == 2:
+                break
+            time.sleep(0.01)
+        (connect, conn), (disconnect, conn2) = recorder.events
+        assert (connect, disconnect) == ("connect", "disconnect")
+        assert conn is conn2
+
+    def test_connect_error(self):
+        channel = mock.Mock()
+        layer = mock.Mock(config=self.proxy.tmaster.server.config, channel=channel)
+        with pytest.raises(exceptions.ProtocolException, match="failed"):
+            http1layer.Http1Layer._connect_upstream(layer, ("127.0.0.1", 0), None)
+        assert [c[0][0] for c in channel.ask.call_args_list] == ["serverconnect"]
+        assert [c[0][0] for c in channel.tell.call_args_list] == ["serverdisconnect"]
+
+
 class TestConnectionTerminated(_Http2Test):
 
     @classmethod
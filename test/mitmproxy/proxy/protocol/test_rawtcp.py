@@ -1 +1,91 @@
-# TODO: write tests
+import os
+import socket
+
+import pytest
+
+from mitmproxy import exceptions
+from mitmproxy.proxy.protocol import rawtcp
+
+
+@pytest.fixture
+def sockets():
+    a, b = socket.socketpair()
+    c, d = socket.socketpair()
+    yield a, b, c, d
+    for s in (a, b, c, d):
+        s.close()
+
+
+class FakeSplice:
+    """os.splice emulation for platforms that don't have it."""
+    def __init__(self, block=0):
+        self.block = block
+
+    def __call__(self, src, dst, count, flags=0):
+        if self.block:
+            self.block -= 1
+            raise BlockingIOError()
+        data = os.read(src, count)
+        return os.write(dst, data)
+
+
+@pytest.fixture
+def fake_splice(monkeypatch):
+    def install(block=0):
+        monkeypatch.setattr(os, "splice", FakeSplice(block), raising=False)
+        monkeypatch.setattr(os, "SPLICE_F_MOVE", 1, raising=False)
+        monkeypatch.setattr(os, "SPLICE_F_NONBLOCK", 2, raising=False)
+    return install
+
+
+def test_can_splice(monkeypatch, sockets, fake_splice):
+    monkeypatch.delattr(os, "splice", raising=False)
+    assert not rawtcp.can_splice(*sockets)
+    fake_splice()
+    assert rawtcp.can_splice(*sockets)
+
+
+def test_forward(sockets):
+    a, b, c, d = sockets
+    buf = memoryview(bytearray(4))
+    a.sendall(b"foobar")
+    assert rawtcp.forward(b, c, buf) == 4
+    assert rawtcp.forward(b, c, buf) == 2
+    assert d.recv(10) == b"foobar"
+    a.shutdown(socket.SHUT_WR)
+    assert rawtcp.forward(b, c, buf) == 0
+
+
+def test_splice(sockets, fake_splice):
+    a, b, c, d = sockets
+    r, w = os.pipe()
+    try:
+        fake_splice()
+        a.sendall(b"foobar")
+        assert rawtcp.splice(b, c, (r, w), 4) == 4
+        assert rawtcp.splice(b, c, (r, w), 4) == 2
+        assert d.recv(10) == b"foobar"
+
+        fake_splice(block=1)
+        assert rawtcp.splice(b, c, (r, w), 4) == -1
+
+        # the destination is busy for a moment
+        splice = FakeSplice()
+        calls = iter([splice, FakeSplice(block=1), splice])
+        os.splice = lambda *args, **kwargs: next(calls)(*args, **kwargs)
+        a.sendall(b"foo")
+        assert rawtcp.splice(b, c, (r, w), 4) == 3
+        assert d.recv(10) == b"foo"
+
+        calls = iter([splice, FakeSplice(block=1)])
+        c.setblocking(False)
+        with pytest.raises(BlockingIOError):
+            while True:
+                c.send(b"x" * 65536)
+        c.settimeout(0.01)
+        a.sendall(b"foo")
+        with pytest.raises(exceptions.TcpTimeout):
+            rawtcp.splice(b, c, (r, w), 4)
+    finally:
+        os.close(r)
+        os.close(w)
@@ -1,8 +1,12 @@
 import pytest
-
 from mitmproxy import options
 from mitmproxy import exceptions
-from mitmproxy.proxy.config import ProxyConfig
+from mitmproxy.net import resolver
+from mitmproxy.net import tls
+import re
+
+from mitmproxy.proxy import config
+from mitmproxy.proxy.config import HostMatcher, ProxyConfig
 
 
 class TestProxyConfig:
@@ -26,3 +30,157 @@ class TestProxyConfig:
                                                           "mutually exclusive; please choose "
                                                           "one."):
             ProxyConfig(opts)
+
+    def test_connection_pool(self):
+        opts = options.Options()
+        c = ProxyConfig(opts)
+        assert c.connection_pool is None
+        opts.upstream_pool = True
+        pool = c.connection_pool
+        assert pool is not None
+        opts.upstream_pool_max_idle = 5
+        assert c.connection_pool is not pool
+        assert c.connection_pool.max_idle == 5
+        opts.mode = "upstream:http://example.com"
+        assert c.connection_pool is None
+        opts.mode = "reverse:http://example.com"
+        assert c.connection_pool is not None
+
+    def test_multiplex_pool(self):
+        opts = options.Options()
+        c = ProxyConfig(opts)
+        assert c.multiplex_pool is None
+        opts.upstream_http2_multiplex = True
+        pool = c.multiplex_pool
+        assert pool is not None
+        opts.http2_stream_buffer_size = 65535
+        assert c.multiplex_pool is not pool
+        opts.http2 = False
+        assert c.multiplex_pool is None
+
+    def test_cert_cache(self, tmpdir):
+        opts = options.Options(cert_cache_size=5, cert_cache_dir=str(tmpdir))
+        c = ProxyConfig(opts)
+        assert c.certstore.store_cap == 5
+        assert c.certstore.cache_dir == str(tmpdir)
+
+    def test_certstore_reuse(self, tmpdir):
+        opts = options.Options(confdir=str(tmpdir))
+        c = ProxyConfig(opts)
+        store = c.certstore
+        store.generation_latency.observe(1)
+        opts.ignore_hosts = ["example.com"]
+        assert c.certstore is store
+        opts.cert_cache_size = 5
+        assert c.certstore is not store
+        assert c.certstore.generation_latency is store.generation_latency
+        with pytest.raises(exceptions.OptionsError):
+            opts.certs = [str(tmpdir.join("missing.pem"))]
+        assert c.certstore.store_cap == 5
+
+    def test_tls_session_cache(self):
+        opts = options.Options()
+        c = ProxyConfig(opts)
+        opts.upstream_tls_session_cache_size = 10
+        assert tls.default_session_cache.size == c.options.upstream_tls_session_cache_size == 10
+        opts.upstream_tls_session_cache_size = 1000
+
+    def test_tls_verify_cache(self):
+        opts = options.Options()
+        c = ProxyConfig(opts)
+        opts.upstream_tls_verify_cache_ttl = 10
+        assert tls.default_hostname_cache.ttl == c.options.upstream_tls_verify_cache_ttl == 10
+        opts.upstream_tls_verify_cache_ttl = 300
+
+    def test_dns(self):
+        opts = options.Options()
+        c = ProxyConfig(opts)
+        opts.update(dns_cache_ttl=10, dns_hosts=["example.com=127.0.0.1"])
+        assert resolver.default_resolver.ttl == 10
+        assert resolver.default_resolver.hosts == {"example.com": "127.0.0.1"}
+        for spec in ["example.com", "=127.0.0.1", "example.com=example.org"]:
+            with pytest.raises(exceptions.OptionsError, match="Invalid DNS host override"):
+                opts.dns_hosts = [spec]
+        opts.update(dns_cache_ttl=60, dns_hosts=[])
+        assert c.options is opts
+
+    def test_host_matcher(self):
+        opts = options.Options(ignore_hosts=["example.com"])
+        c = ProxyConfig(opts)
+        matcher = c.check_filter
+        assert matcher(("example.com", 443))
+        opts.upstream_pool_max_idle = 5
+        assert c.check_filter is matcher
+        opts.ignore_hosts = []
+        opts.allow_hosts = ["example.com"]
+        assert c.check_filter is not matcher
+        assert c.check_filter.handle == "allow"
+
+
+class TestHostMatcher:
+    patterns = [
+        r"^example\.com:443$",
+        r"^(.+\.)?apple\.com:443$",
+        r"^any-port\.org:",
+        r"^(.+\.)?any-port\.net:\d+$",
+        r"^example.com:",
+        r"17\.178\.\d+\.\d+:443",
+        r"^(a)\1\.com:80$",
+        r"^(?![0-9\.]+:)(?!([^\.:]+\.)*mitmproxy\.org:)",
+    ]
+    addresses = [
+        ("example.com", 443),
+        ("EXAMPLE.com", 443),
+        ("example.com", 80),
+        ("www.example.com", 443),
+        ("exampleXcom", 8080),
+        ("apple.com", 443),
+        ("a.b.apple.com", 443),
+        (".apple.com", 443),
+        ("notapple.com", 443),
+        ("apple.com.evil", 443),
+        ("apple.com", 80),
+        ("any-port.org", 1),
+        ("x.any-port.org", 1),
+        ("x.any-port.net", 22),
+        ("17.178.96.59", 443),
+        ("17.178.96.59", 80),
+        ("aa.com", 80),
+        ("mitmproxy.org", 443),
+        ("docs.mitmproxy.org", 443),
+        ("::1", 443),
+        ("x\n.apple.com", 443),
+        ("apple.com", "443\n"),
+    ]
+
+    @pytest.mark.parametrize("handle", ["ignore", "allow"])
+    def test_equivalent_to_regexes(self, handle):
+        regexes = [re.compile(p, re.IGNORECASE) for p in self.patterns]
+        m = HostMatcher(handle, self.patterns)
+        assert m.hosts
+        assert m.domains
+        for address in self.addresses:
+            matches = [bool(rex.search("%s:%s" % address)) for rex in regexes]
+            expected = any(matches) if handle == "ignore" else not all(matches)
+            assert m(address) == expected, address
+            assert m(address) == expected, address
+
+    def test_combined(self):
+        m = HostMatcher("ignore", ["foo", "bar"])
+        assert len(m.other_regexes) == 1
+        assert m(("xbarx", 80))
+        assert not m(("baz", 80))
+        m = HostMatcher("ignore", ["(?P<x>foo)", "(?P<x>bar)"])
+        assert len(m.other_regexes) == 2
+        assert m(("bar", 80))
+        assert not m(None)
+        assert not HostMatcher(False)
+
+    def test_cache(self, monkeypatch):
+        monkeypatch.setattr(config, "HOST_MATCHER_CACHE_SIZE", 2)
+        m = HostMatcher("ignore", [r"^example\.com:443$"])
+        assert m(("example.com", 443))
+        assert not m(("example.org", 443))
+        assert m(("example.com", 443))
+        assert not m(("example.net", 443))
+        assert list(m.cache) == [("example.com", 443), ("example.net", 443)]
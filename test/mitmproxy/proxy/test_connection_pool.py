@@ -0,0 +1,173 @@
+import socket
+from unittest import mock
+
+import pytest
+
+from mitmproxy import connections
+from mitmproxy.proxy import connection_pool
+
+
+@pytest.fixture
+def conn():
+    socks = []
+
+    def make(address=("example.com", 80)):
+        a, b = socket.socketpair()
+        socks.append(b)
+        c = connections.ServerConnection(address)
+        c.connection = a
+        c._makefile()
+        c.peer = b
+        return c
+
+    yield make
+    for s in socks:
+        s.close()
+
+
+def key(host="example.com"):
+    return ((host, 80), False, None, None, None)
+
+
+def test_is_reusable(conn):
+    c = conn()
+    assert connection_pool.is_reusable(c)
+
+    c.peer.send(b"unsolicited")
+    assert not connection_pool.is_reusable(c)
+
+    c = conn()
+    c.peer.close()
+    assert not connection_pool.is_reusable(c)
+
+    c = connections.ServerConnection(("example.com", 80))
+    assert not connection_pool.is_reusable(c)
+
+    c = conn()
+    c.tls_established = True
+    c.connection = mock.Mock()
+    c.connection.pending.return_value = 1
+    assert not connection_pool.is_reusable(c)
+    c.connection.pending.side_effect = OSError
+    assert not connection_pool.is_reusable(c)
+
+
+class TestConnectionPool:
+    def test_get_put(self, conn):
+        p = connection_pool.ConnectionPool(10, 10, 30)
+        assert p.get(key()) is None
+        assert p.misses == 1
+
+        a, b = conn(), conn()
+        assert p.put(key(), a)
+        assert p.put(key(), b)
+        assert len(p) == 2
+        assert p.get(key("other")) is None
+        # most recently released first
+        assert p.get(key()) is b
+        assert p.get(key()) is a
+        assert p.get(key()) is None
+        assert p.hits == 2
+        assert p.misses == 3
+        assert not len(p)
+
+    def test_stale(self, conn):
+        p = connection_pool.ConnectionPool(10, 10, 30)
+        a, b = conn(), conn()
+        p.put(key(), a)
+        p.put(key(), b)
+        b.peer.close()
+        assert p.get(key()) is a
+        assert not b.connected()
+
+    def test_max_per_host(self, conn):
+        p = connection_pool.ConnectionPool(10, 1, 30)
+        assert p.put(key(), conn())
+        assert not p.put(key(), conn())
+        assert p.put(key("other"), conn())
+        assert len(p) == 2
+
+    def test_max_idle(self, conn):
+        p = connection_pool.ConnectionPool(2, 10, 30)
+        a = conn()
+        p.put(key("a"), a)
+        p.put(key("b"), conn())
+        p.put(key("c"), conn())
+        assert len(p) == 2
+        assert not a.connected()
+        assert p.get(key("a")) is None
+
+        p = connection_pool.ConnectionPool(0, 10, 30)
+        assert not p.put(key(), conn())
+
+    def test_idle_timeout(self, conn):
+        p = connection_pool.ConnectionPool(10, 10, 30)
+        a = conn()
+        with mock.patch("time.time", return_value=100):
+            p.put(key(), a)
+            assert len(p) == 1
+        with mock.patch("time.time", return_value=131):
+            assert p.get(key()) is None
+        assert not len(p)
+        assert not a.connected()
+
+    def test_clear(self, conn):
+        p = connection_pool.ConnectionPool(10, 10, 30)
+        a, b = conn(), conn()
+        p.put(key(), a)
+        p.put(key("other"), b)
+        p.clear()
+        assert not len(p)
+        assert not a.connected()
+        assert not b.connected()
+
+
+class FakeMultiplexed:
+    def __init__(self, free=True):
+        self.closed = False
+        self.free = free
+
+    def available(self):
+        return self.free
+
+    def close(self):
+        self.closed = True
+
+
+class TestMultiplexPool:
+    def test_get(self):
+        pool = connection_pool.MultiplexPool()
+        key = (("example.com", 443), "example.com", None)
+        assert pool.get(key) is None
+        assert pool.begin_connect(key) is None
+        connecting = pool.begin_connect(key)
+        assert not connecting.is_set()
+
+        full, free = FakeMultiplexed(free=False), FakeMultiplexed()
+        pool.end_connect(key, full)
+        assert connecting.is_set()
+        assert pool.get(key) is None
+        pool.begin_connect(key)
+        pool.end_connect(key, free)
+        assert len(pool) == 2
+        assert pool.get(key) is free
+        assert pool.hits == 1
+        assert pool.misses == 2
+
+        free.closed = True
+        assert pool.get(key) is None
+        assert len(pool) == 1
+
+        pool.clear()
+        assert full.closed
+        assert len(pool) == 0
+
+    def test_unsupported(self):
+        pool = connection_pool.MultiplexPool(max_unsupported=1)
+        a = (("a.example.com", 443), "a.example.com", None)
+        b = (("b.example.com", 443), "b.example.com", None)
+        for key in (a, b):
+            pool.begin_connect(key)
+            pool.end_connect(key, unsupported=True)
+        assert not pool.unsupported(a)
+        assert pool.unsupported(b)
@@ -11,6 +11,7 @@ from mitmproxy import certs
 from mitmproxy import exceptions
 from mitmproxy import http
 from mitmproxy import options
+from mitmproxy.addons import certpregen
 from mitmproxy.addons import script
 from mitmproxy.net import socks
 from mitmproxy.net import tcp
@@ -121,6 +122,19 @@ class TcpMixin:
 
         self._ignore_off()
 
+    def test_ignore_splice(self, monkeypatch):
+        def splice(src, dst, count, flags=0):
+            return os.write(dst, os.read(src, count))
+        monkeypatch.setattr(os, "splice", splice, raising=False)
+        monkeypatch.setattr(os, "SPLICE_F_MOVE", 1, raising=False)
+        monkeypatch.setattr(os, "SPLICE_F_NONBLOCK", 2, raising=False)
+        self._ignore_on()
+        try:
+            assert self.pathod("305:b@100000").status_code == 305
+        finally:
+            self._ignore_off()
+        assert not any(f.response.status_code == 305 for f in self.master.state.flows)
+
     def test_allow(self):
         n = self.pathod("304")
         self._allow_on()
@@ -136,14 +150,13 @@ class TcpMixin:
         assert any(f.response.status_code == 305 for f in self.master.state.flows)
         assert any(f.response.status_code == 306 for f in self.master.state.flows)
 
-        # Test that we get the original SSL cert
+        # All connections are intercepted, with the same generated cert
         if self.ssl:
             i_cert = certs.Cert(i.sslinfo.certchain[0])
             i2_cert = certs.Cert(i2.sslinfo.certchain[0])
             n_cert = certs.Cert(n.sslinfo.certchain[0])
 
-            assert i_cert == i2_cert
-            assert i_cert != n_cert
+            assert i_cert == i2_cert == n_cert
 
         # Test Non-HTTP traffic
         spec = "200:i0,@100:d0"  # this results in just 100 random bytes
@@ -179,14 +192,13 @@ class TcpMixin:
         assert not any(f.response.status_code == 305 for f in self.master.state.flows if isinstance(f, http.HTTPFlow))
         assert not any(f.response.status_code == 306 for f in self.master.state.flows if isinstance(f, http.HTTPFlow))
 
-        # Test that we get the original SSL cert
+        # TLS is still intercepted, with the same generated cert
         if self.ssl:
             i_cert = certs.Cert(i.sslinfo.certchain[0])
             i2_cert = certs.Cert(i2.sslinfo.certchain[0])
             n_cert = certs.Cert(n.sslinfo.certchain[0])
 
-            assert i_cert == i2_cert
-            assert i_cert != n_cert
+            assert i_cert == i2_cert == n_cert
 
         # Make sure that TCP messages are in the event log.
         # Re-enable and fix this when we start keeping TCPFlows in the state.
@@ -289,6 +301,123 @@ class TestHTTP(tservers.HTTPProxyTest, CommonMixin):
             assert self.server.last_log()["request"]["first_line_format"] == "relative"
 
 
+class TestHTTPAsyncAccept(tservers.HTTPProxyTest, CommonMixin):
+    @classmethod
+    def get_options(cls):
+        opts = super().get_options()
+        opts.async_accept = True
+        return opts
+
+
+class TestHTTPConnectionWorkers(tservers.HTTPProxyTest, CommonMixin):
+    @classmethod
+    def get_options(cls):
+        opts = super().get_options()
+        opts.connection_workers = 2
+        opts.connection_backlog = 0
+        opts.connection_overload = "reject"
+        return opts
+
+    def test_overload(self):
+        pool = self.proxy.tmaster.server.pool
+        blocking = [tcp.TCPClient(("127.0.0.1", self.proxy.port)) for _ in range(2)]
+        for c in blocking:
+            c.connect()
+        try:
+            for _ in range(100):
+                if pool.active_workers == 2:
+                    break
+                time.sleep(0.01)
+            t = tcp.TCPClient(("127.0.0.1", self.proxy.port))
+            with t.connect():
+                assert b"503" in t.rfile.readline()
+        finally:
+            for c in blocking:
+                c.close()
+
+
+class TestHTTPConnectionWorkersQueue(tservers.HTTPProxyTest):
+    @classmethod
+    def get_options(cls):
+        opts = super().get_options()
+        opts.connection_workers = 1
+        opts.connection_backlog = 0
+        opts.connection_overload = "queue"
+        return opts
+
+    def test_queue(self):
+        server = self.proxy.tmaster.server
+        blocking = tcp.TCPClient(("127.0.0.1", self.proxy.port))
+        blocking.connect()
+        try:
+            for _ in range(100):
+                if not server.can_process():
+                    break
+                time.sleep(0.01)
+            assert not server.can_process()
+            t = tcp.TCPClient(("127.0.0.1", self.proxy.port))
+            with t.connect():
+                t.wfile.write(b"GET %s/p/200 HTTP/1.1\r\n\r\n" % self.server.urlbase.encode())
+                t.wfile.flush()
+                time.sleep(0.2)
+                assert server.pool.dispatched == 1
+                blocking.close()
+                assert t.rfile.readline().startswith(b"HTTP/1.1 200")
+        finally:
+            blocking.close()
+
+
+class ConnectionPoolMixin:
+    @classmethod
+    def get_options(cls):
+        opts = super().get_options()
+        opts.upstream_pool = True
+        return opts
+
+    def teardown(self):
+        # Idle pooled connections keep pathod's handler threads alive.
+        pool = self.proxy.tmaster.server.config.connection_pool
+        for _ in range(50):
+            pool.clear()
+            try:
+                self.server.wait_for_silence(timeout=0.1)
+                break
+            except exceptions.Timeout:
+                pass
+        super().teardown()
+
+    def test_reuse(self):
+        pool = self.proxy.tmaster.server.config.connection_pool
+        pool.clear()
+        hits = pool.hits
+        for _ in range(3):
+            assert self.pathod("200").status_code == 200
+            for _ in range(100):
+                if len(pool):
+                    break
+                time.sleep(0.01)
+        assert pool.hits == hits + 2
+        assert len(pool) == 1
+
+    def test_close(self):
+        pool = self.proxy.tmaster.server.config.connection_pool
+        pool.clear()
+        assert self.pathod('200:h"Connection"="close"').status_code == 200
+        assert not len(pool)
+
+
+class TestHTTPConnectionPool(ConnectionPoolMixin, tservers.HTTPProxyTest, CommonMixin):
+    pass
+
+
+class TestHTTPSConnectionPool(ConnectionPoolMixin, tservers.HTTPProxyTest, CommonMixin):
+    ssl = True
+
+
+class TestReverseConnectionPool(ConnectionPoolMixin, tservers.ReverseProxyTest, CommonMixin):
+    reverse = True
+
+
 class TestHTTPS(tservers.HTTPProxyTest, CommonMixin, TcpMixin):
     ssl = True
     ssloptions = pathod.SSLOptions(request_client_cert=True)
@@ -414,6 +543,26 @@ class TestHTTPSUpstreamServerVerificationWBadCert(tservers.HTTPProxyTest):
         assert b"Certificate verification error" in r.raw_content
 
 
+class TestHTTPSCertPregen(tservers.HTTPProxyTest):
+    ssl = True
+
+    def test_pregenerated(self):
+        a = certpregen.CertPregen()
+        self.set_addons(a)
+        self.options.update(cert_pregen=True, cert_pregen_hosts=["127.0.0.1"])
+        a.executor.shutdown()
+        store = self.master.server.config.certstore
+        entry = store.get_generated(b"127.0.0.1")
+        assert entry
+        generated = store.generation_latency.count
+
+        f = self.pathod("202")
+        assert f.status_code == 202
+        assert certs.Cert(f.sslinfo.certchain[0]) == entry.cert
+        assert store.generation_latency.count == generated
+        self.options.update(cert_pregen=False, cert_pregen_hosts=[])
+
+
 class TestHTTPSNoCommonName(tservers.HTTPProxyTest):
 
     """
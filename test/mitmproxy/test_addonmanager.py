@@ -151,6 +151,62 @@ async def test_simple():
         assert ta in a
 
 
+def test_dispatch():
+    o = options.Options()
+    m = master.Master(o)
+    a = addonmanager.AddonManager(m)
+
+    one = TAddon("one")
+    halt = THalt()
+    a.add(one, halt)
+    a.trigger("running")
+    assert [x for x, _ in a.dispatch["running"]] == a.chain
+    assert "request" not in a.dispatch
+    a.trigger("done")
+    assert [x for x, _ in a.dispatch["done"]] == [one]
+
+    two = TAddon("two")
+    one.addons = [two]
+    a.trigger("running")
+    assert not two.running_called
+    a.invalidate()
+    a.trigger("running")
+    assert two.running_called
+
+    # Handlers that are not callable yet are looked up when the event fires.
+    a.trigger("response", 42)
+    one.response = mock.Mock()
+    a.trigger("response", 42)
+    one.response.assert_called_once_with(42)
+    with pytest.raises(exceptions.AddonManagerError, match="Unknown event"):
+        a.invoke_addon(one, "nonexistent")
+
+    a.remove(halt)
+    assert not a.dispatch
+    a.trigger("request")
+    assert a.dispatch["request"] == []
+
+
+def test_handles():
+    o = options.Options()
+    m = master.Master(o)
+    a = addonmanager.AddonManager(m)
+    a.add(TAddon("one"))
+
+    f = tflow.tflow()
+    assert a.handles("running", None)
+    assert not a.handles("request", f)
+    assert a.handles("nonexistent", f)
+
+    class Update:
+        def update(self, flows):
+            pass
+
+    a.add(Update())
+    assert a.handles("request", f)
+    assert not a.handles("request", None)
+
+
 def test_load_option():
     o = options.Options()
     m = master.Master(o)
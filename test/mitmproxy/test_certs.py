@@ -1,4 +1,8 @@
+import collections
 import os
+import threading
+import time
+
 from mitmproxy import certs
 from ..conftest import skip_windows
 
@@ -70,9 +74,16 @@ class TestCertStore:
         cert, key, chain_file = ca.get_cert(b"foo.bar.com", [b"*.baz.com"])
         assert b"*.baz.com" in cert.altnames
 
-    def test_expire(self, tmpdir):
+    def test_get_entry(self, tmpdir):
         ca = certs.CertStore.from_store(str(tmpdir), "test", 2048)
-        ca.STORE_CAP = 3
+        entry = ca.get_entry(b"foo.com", [])
+        assert entry.privatekey == ca.default_privatekey
+        assert entry.contexts == {}
+        assert ca.get_entry(b"foo.com", []) is entry
+        assert ca.get_cert(b"foo.com", [])[0] is entry.cert
+
+    def test_expire(self, tmpdir):
+        ca = certs.CertStore.from_store(str(tmpdir), "test", 2048, store_cap=3)
         ca.get_cert(b"one.com", [])
         ca.get_cert(b"two.com", [])
         ca.get_cert(b"three.com", [])
@@ -89,10 +100,140 @@ class TestCertStore:
 
         ca.get_cert(b"four.com", [])
 
-        assert (b"one.com", ()) not in ca.certs
-        assert (b"two.com", ()) in ca.certs
+        assert (b"one.com", ()) in ca.certs
+        assert (b"two.com", ()) not in ca.certs
         assert (b"three.com", ()) in ca.certs
         assert (b"four.com", ()) in ca.certs
+        assert len(ca.expire_queue) == 3
+
+    def test_cache_dir(self, tmpdir):
+        cache_dir = str(tmpdir.join("cache"))
+        ca = certs.CertStore.from_store(str(tmpdir), "test", 2048, cache_dir=cache_dir)
+        c1 = ca.get_cert(b"foo.com", [b"foo.com"], b"Org")[0]
+        assert len(os.listdir(cache_dir)) == 1
+
+        ca2 = certs.CertStore.from_store(str(tmpdir), "test", 2048, cache_dir=cache_dir)
+        assert ca2.get_cert(b"foo.com", [b"foo.com"], b"Org")[0].serial == c1.serial
+        assert ca2.get_cert(b"foo.com", [b"foo.com"])[0].serial == c1.serial
+        assert ca2.get_cert(b"bar.com", [])[0].serial != c1.serial
+        assert len(os.listdir(cache_dir)) == 2
+
+        # Certificates of another CA are not reused.
+        ca3 = certs.CertStore.from_store(str(tmpdir.join("ca3")), "test", 2048, cache_dir=cache_dir)
+        assert ca3.get_cert(b"foo.com", [b"foo.com"], b"Org")[0].serial != c1.serial
+
+    def test_sans_order(self, tmpdir):
+        cache_dir = str(tmpdir.join("cache"))
+        ca = certs.CertStore.from_store(str(tmpdir), "test", 2048, cache_dir=cache_dir)
+        c1 = ca.get_cert(b"foo.com", [b"foo.com", b"b.com", b"a.com"])[0]
+        assert ca.get_cert(b"foo.com", [b"a.com", b"foo.com", b"b.com", b"a.com"])[0] is c1
+        assert len(ca.expire_queue) == 1
+
+        ca2 = certs.CertStore.from_store(str(tmpdir), "test", 2048, cache_dir=cache_dir)
+        assert ca2.get_cert(b"foo.com", [b"b.com", b"a.com", b"foo.com"])[0].serial == c1.serial
+        assert ca2.generation_latency.count == 0
+        assert len(os.listdir(cache_dir)) == 1
+
+    def test_cache_dir_invalid(self, tmpdir, monkeypatch):
+        cache_dir = tmpdir.join("cache")
+        ca = certs.CertStore.from_store(str(tmpdir), "test", 2048, cache_dir=str(cache_dir))
+        path = ca._cache_path(b"foo.com", [], None)
+        cache_dir.mkdir()
+        with open(path, "wb") as f:
+            f.write(b"invalid")
+        c1 = ca.get_cert(b"foo.com", [])[0]
+        with open(path, "rb") as f:
+            assert certs.Cert.from_pem(f.read()).serial == c1.serial
+
+        monkeypatch.setattr(certs.Cert, "has_expired", True)
+        ca2 = certs.CertStore.from_store(str(tmpdir), "test", 2048, cache_dir=str(cache_dir))
+        assert ca2.get_cert(b"foo.com", [])[0].serial != c1.serial
+
+        ca.cache_dir = str(tmpdir.join("test-ca.pem"))
+        assert ca.get_cert(b"bar.com", [])
+
+    def test_single_flight(self, tmpdir, monkeypatch):
+        ca = certs.CertStore.from_store(str(tmpdir), "test", 2048)
+        sign = ca._sign
+        calls = []
+
+        def slow_sign(*args):
+            calls.append(args)
+            time.sleep(0.1)
+            if args[0] == b"error.com":
+                raise ValueError("signing failed")
+            return sign(*args)
+
+        monkeypatch.setattr(ca, "_sign", slow_sign)
+
+        def get(host):
+            try:
+                results.append(ca.get_entry(host, []))
+            except ValueError as e:
+                results.append(e)
+
+        for host in [b"foo.com", b"error.com"]:
+            results = []
+            threads = [threading.Thread(target=get, args=(host,)) for _ in range(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert len(results) == 5
+            assert all(r is results[0] for r in results)
+        assert len(calls) == 2
+        assert ca.generation_latency.count == 1
+        assert not ca._pending
+        assert (b"error.com", ()) not in ca.certs
+
+    def test_processes(self, tmpdir):
+        ca = certs.CertStore.from_store(str(tmpdir), "test", 2048, processes=1)
+        try:
+            cert = ca.get_cert(b"foo.com", [b"foo.com"], b"Org")[0]
+            assert cert.cn == b"foo.com"
+            assert cert.altnames == [b"foo.com"]
+            assert cert.issuer == ca.get_cert(b"bar.com", [])[0].issuer
+            assert ca._executor is not None
+
+            # Fall back to signing in this thread if the pool is gone.
+            ca._executor.shutdown()
+            assert ca.get_cert(b"baz.com", [])[0].cn == b"baz.com"
+            assert ca.generation_latency.count == 3
+        finally:
+            ca.shutdown()
+        assert ca._executor is None
+        assert ca.processes == 0
+        ca.shutdown()
+
+    def test_add_wildcard(self, tmpdir):
+        ca = certs.CertStore.from_store(str(tmpdir), "test", 2048, store_cap=3)
+        entry = ca.add_wildcard(b"example.com")
+        assert entry.cert.cn == b"*.example.com"
+        assert entry.cert.altnames == [b"*.example.com", b"example.com"]
+        assert ca.get_entry(b"foo.example.com", [b"foo.example.com"]) is entry
+        assert ca.get_entry(b"a.b.example.com", [b"a.b.example.com"]) is not entry
+        assert ca.get_entry(b"example.com", []) is not entry
+
+        ca.get_cert(b"one.com", [])
+        assert b"*.example.com" not in ca.wildcards
+        assert b"*.example.com" not in ca.certs
+
+    def test_get_generated(self, tmpdir):
+        ca = certs.CertStore.from_store(str(tmpdir), "test", 2048)
+        assert ca.get_generated(b"foo.com") is None
+        ca.add_cert_file("foo.com", os.path.join(str(tmpdir), "test-ca.pem"))
+        assert ca.get_generated(b"foo.com") is None
+        assert ca.find_entry(b"bar.com", [b"bar.com"]) is None
+        entry = ca.get_entry(b"bar.com", [b"bar.com"])
+        assert ca.find_entry(b"bar.com", [b"bar.com", b"bar.com"]) is entry
+        assert ca.get_generated(b"bar.com") is entry
+        assert ca.get_generated(b"www.bar.com") is None
+        wildcard = ca.add_wildcard(b"bar.com")
+        assert ca.get_generated(b"www.bar.com") is wildcard
+        assert ca.get_generated(b"a.www.bar.com") is None
+        assert ca.get_generated(b"bar.com") is entry
+        ca.certs[(b"baz.com", (b"baz.com",))] = entry
+        assert ca.get_generated(b"baz.com") is entry
 
     def test_overrides(self, tmpdir):
         ca1 = certs.CertStore.from_store(str(tmpdir.join("ca1")), "test", 2048)
@@ -175,6 +316,31 @@ class TestCert:
 
         assert c1 != c2
 
+    def test_parsed_fields(self, tdata, monkeypatch):
+        monkeypatch.setattr(certs, "PARSED_CAP", 1)
+        monkeypatch.setattr(certs, "_parsed", collections.OrderedDict())
+        with open(tdata.path("mitmproxy/net/data/text_cert"), "rb") as f:
+            d = f.read()
+        c1 = certs.Cert.from_pem(d)
+        c2 = certs.Cert.from_pem(d)
+        assert c1.x509 is not c2.x509
+        c1.altnames.append(b"foo")
+        assert len(c1.altnames) == 436
+        assert c2._fields is None
+        assert c2.cn == b"google.com"
+        assert c1._fields is c2._fields
+
+        with open(tdata.path("mitmproxy/net/data/text_cert_2"), "rb") as f:
+            c3 = certs.Cert.from_pem(f.read())
+        assert c3.cn == b"www.inode.co.nz"
+        assert c3._fields is not c1._fields
+        assert list(certs._parsed) == [c3.digest("sha256")]
+        c3.cn
+        assert len(certs._parsed) == 1
+
+        c3.set_state(c1.get_state())
+        assert c3.cn == b"google.com"
+
     def test_err_broken_sans(self, tdata):
         with open(tdata.path("mitmproxy/net/data/text_cert_weird1"), "rb") as f:
             d = f.read()
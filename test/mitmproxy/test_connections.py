@@ -7,6 +7,7 @@ from unittest import mock
 
 from mitmproxy import connections
 from mitmproxy import exceptions
+from mitmproxy.net import resolver
 from mitmproxy.net import tcp
 from mitmproxy.net.http import http1
 from mitmproxy.test import tflow
@@ -157,6 +158,10 @@ class TestServerConnection:
         c.connection.flush = mock.Mock(side_effect=exceptions.TcpDisconnect)
         d.shutdown()
 
+    def test_resolver(self):
+        c = connections.ServerConnection(('', 1234))
+        assert c.resolver is resolver.default_resolver
+
     def test_sni(self):
         c = connections.ServerConnection(('', 1234))
         with pytest.raises(ValueError, match='sni must be str, not '):
@@ -211,9 +216,13 @@ class TestClientConnectionTLS:
         key = OpenSSL.crypto.load_privatekey(
             OpenSSL.crypto.FILETYPE_PEM,
             raw_key)
+        client_hello = c.get_client_hello()
+        assert client_hello.sni == (sni and sni.encode())
+        assert c.get_client_hello() is client_hello
         c.convert_to_tls(cert, key)
         assert c.connected()
         assert c.sni == sni
+        assert c._client_hello is None
         assert c.tls_established
         assert c.rfile.read(6) == b'foobar'
         c.finish()
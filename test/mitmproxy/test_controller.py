@@ -5,6 +5,7 @@ import pytest
 from mitmproxy.exceptions import Kill, ControlException
 from mitmproxy import controller
 from mitmproxy.test import taddons
+from mitmproxy.test import tflow
 import mitmproxy.ctx
 
 
@@ -26,6 +27,19 @@ async def test_master():
         assert ctx.master.should_exit.is_set()
 
 
+def test_channel_unhandled():
+    with taddons.context(loadcore=False) as tctx:
+        loop = asyncio.new_event_loop()
+        channel = controller.Channel(tctx.master, loop, tctx.master.should_exit)
+        f = tflow.ttcpflow()
+        # The loop is not running, so this would block if it was not handled locally.
+        assert channel.ask("tcp_message", f) is f
+        assert f.reply.state == "committed"
+        channel.tell("tcp_message", f)
+        assert not loop._ready
+        loop.close()
+
+
 class TestReply:
     def test_simple(self):
         reply = controller.Reply(42)
@@ -0,0 +1,129 @@
+import asyncio
+import socket
+import threading
+from io import BytesIO
+
+import pytest
+
+from mitmproxy import exceptions
+from mitmproxy import io
+from mitmproxy import options
+from mitmproxy.proxy.config import ProxyConfig
+from mitmproxy.test import taddons
+from mitmproxy.test import tflow
+from mitmproxy.tools import dump
+from mitmproxy.tools import workers
+
+
+class Recorder:
+    def __init__(self):
+        self.flows = []
+
+    def response(self, f):
+        self.flows.append(f)
+
+    def error(self, f):
+        self.flows.append(f)
+
+
+def test_forwarder():
+    fo = BytesIO()
+    fw = workers.FlowForwarder(fo)
+    fw.response(tflow.tflow(resp=True))
+    fw.error(tflow.tflow(err=True))
+    fw.error(tflow.tflow(resp=True, err=True))
+    fw.tcp_end(tflow.ttcpflow())
+    fw.websocket_end(tflow.twebsocketflow())
+    fo.seek(0)
+    flows = list(io.FlowReader(fo).stream())
+    assert len(flows) == 4
+
+
+@pytest.mark.asyncio
+async def test_collector():
+    m = dump.DumpMaster(options.Options(), with_termlog=False, with_dumper=False)
+    rec = Recorder()
+    m.addons.add(rec)
+    a, b = socket.socketpair()
+    fw = workers.FlowForwarder(a.makefile("wb"))
+    fw.response(tflow.tflow(resp=True))
+    fw.error(tflow.tflow(err=True))
+    fw.writer.fo.close()
+    a.close()
+
+    c = workers.FlowCollector(m.channel, 42, b.makefile("rb"))
+    b.close()
+    c.start()
+    while c.is_alive():
+        await asyncio.sleep(0.01)
+    assert len(rec.flows) == 2
+    assert rec.flows[0].response
+    assert rec.flows[1].error
+
+
+def server_options(**kwargs):
+    return options.Options(listen_host="127.0.0.1", listen_port=0, **kwargs)
+
+
+def test_worker_server():
+    s = workers.WorkerServer(ProxyConfig(server_options(workers=3)))
+    try:
+        assert len(s.servers) == 3
+        assert len({x.address for x in s.servers}) == 1
+        assert s.address == s.servers[0].address
+    finally:
+        s.close_sockets()
+
+
+def test_worker_server_unsupported(monkeypatch):
+    monkeypatch.delattr(socket, "SO_REUSEPORT")
+    with pytest.raises(exceptions.ServerException, match="not supported"):
+        workers.WorkerServer(ProxyConfig(server_options(workers=2)))
+
+
+def test_worker_server_bind_error():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    s.listen()
+    try:
+        opts = server_options(workers=2)
+        opts.listen_port = s.getsockname()[1]
+        with pytest.raises(exceptions.ServerException):
+            workers.WorkerServer(ProxyConfig(opts))
+    finally:
+        s.close()
+
+
+def test_spawn_invalid(tmpdir):
+    path = str(tmpdir.join("flows"))
+    with open(path, "wb") as f:
+        io.FlowWriter(f).add(tflow.tflow(resp=True))
+    s = workers.WorkerServer(ProxyConfig(server_options(workers=2)))
+    try:
+        with taddons.context() as tctx:
+            with pytest.raises(exceptions.OptionsError, match="only supported by mitmdump"):
+                s.spawn(tctx.master)
+        m = dump.DumpMaster(server_options(workers=2), with_termlog=False, with_dumper=False)
+        m.options.client_replay = [path]
+        with pytest.raises(exceptions.OptionsError, match="Client replay"):
+            s.spawn(m)
+    finally:
+        s.close_sockets()
+
+
+@pytest.mark.asyncio
+async def test_spawn():
+    opts = server_options(workers=2)
+    m = dump.DumpMaster(opts, with_termlog=False, with_dumper=False)
+    s = workers.WorkerServer(ProxyConfig(opts))
+    m.server = s
+    s.spawn(m)
+    assert len(s.workers) == 2
+    assert all(isinstance(a, workers.SINKS + workers.SHARED) for a in m.addons.chain)
+
+    t = threading.Thread(target=s.serve_forever)
+    t.start()
+    m.should_exit.set()
+    s.shutdown()
+    while t.is_alive():
+        await asyncio.sleep(0.01)
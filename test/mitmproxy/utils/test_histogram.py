@@ -0,0 +1,15 @@
+from mitmproxy.utils import histogram
+
+
+def test_histogram():
+    h = histogram.Histogram([1, 0.1])
+    assert h.mean == 0
+    assert str(h) == "empty"
+    h.observe(0.05)
+    h.observe(0.1)
+    h.observe(0.5)
+    h.observe(3)
+    assert h.buckets() == [(0.1, 2), (1, 1), (float("inf"), 1)]
+    assert h.count == 4
+    assert h.mean == 3.65 / 4
+    assert str(h) == "<=0.1: 2, <=1: 1, <=inf: 1"